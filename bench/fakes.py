@@ -0,0 +1,363 @@
+"""In-process stand-ins for Telegram, Gemini and Chroma used by the benchmark harness."""
+
+import asyncio
+import contextvars
+import hashlib
+import json
+import math
+import re
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, Optional
+
+import dspy
+from aiohttp import web
+from litellm import ModelResponse
+
+
+# Fake Telegram Bot API
+
+
+class FakeBotAPI:
+    """Minimal Bot API server implementing the methods the bot calls. Every call is answered immediately
+    (plus `latency`), files registered with `add_file` can be downloaded through the file endpoint.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.files: dict[str, bytes] = {}
+        self.calls: Counter[str] = Counter()
+        self._message_ids = iter(range(1_000_000, 10_000_000))
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    def add_file(self, file_id: str, data: bytes):
+        self.files[file_id] = data
+
+    async def start(self, host: str = "127.0.0.1") -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _message(self, chat_id: Any, **content) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **content,
+        }
+
+    async def handle_method(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        match method:
+            case "getMe":
+                result = {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            case "sendMessage" | "editMessageText":
+                result = self._message(params.get("chat_id", 0), text=params.get("text", ""))
+            case "sendDocument" | "sendPhoto" | "sendVoice":
+                result = self._message(params.get("chat_id", 0), caption=params.get("caption", ""))
+            case "sendMediaGroup":
+                media = json.loads(str(params.get("media", "[]")))
+                result = [self._message(params.get("chat_id", 0)) for _ in media]
+            case "getFile":
+                file_id = str(params["file_id"])
+                result = {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "file_size": len(self.files.get(file_id, b"")),
+                    "file_path": f"files/{file_id}",
+                }
+            case _:  # sendChatAction, deleteMessage, deleteWebhook, ...
+                result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request):
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        self.calls["download"] += 1
+        if file_id not in self.files:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.files[file_id])
+
+
+# Deterministic LM
+
+
+@dataclass
+class Scenario:
+    """What the fake LM should answer for the message currently being handled."""
+
+    category: str = "INFORMATION"
+    is_data_dump: bool = False
+    is_hard_retrieval: bool = False
+    tool_calls: int = 0
+    tool_name: str = "search_memory"
+    source_documents: list[str] = field(default_factory=list)
+    user_id: int = 1
+
+
+scenario: contextvars.ContextVar[Scenario] = contextvars.ContextVar(
+    "bench_scenario", default=Scenario()
+)
+
+# Arguments the fake LM passes to each tool the scenarios call, they have to match the tool's signature
+TOOL_ARGS = {
+    "search_memory": lambda current: {
+        "queries": ["bench query", "benchmark query"],
+        "user_id": current.user_id,
+    },
+    # The ScheduleAgent's reminder tools are bound to the user and message, the InfoAgent's lookup isn't
+    "insert_reminder": lambda current: {
+        "content": "Benchmark reminder",
+        "remind_at": "2030-01-01T09:00:00",
+    },
+    "get_pending_reminders": lambda current: {"user_id": str(current.user_id)},
+    "get_message_by_id": lambda current: {"message_id": 1},
+}
+
+_OUTPUT_FIELDS = re.compile(r"Your output fields are:(.*?)(?:All interactions|\Z)", re.S)
+_FIELD_NAME = re.compile(r"^\s*\d+\.\s*`(\w+)`", re.M)
+_TOOL_STEP = re.compile(r"tool_name_\d+")
+
+
+class BenchLM(dspy.LM):
+    """LM which answers every ChatAdapter prompt with canned field values after a fixed latency."""
+
+    def __init__(self, latency: float = 0.5, tokens_per_call: int = 800) -> None:
+        super().__init__("bench/dummy", cache=False)
+        self.latency = latency
+        self.tokens_per_call = tokens_per_call
+        self.calls: Counter[str] = Counter()
+
+    def _answer(self, messages: list[dict]) -> tuple[str, str]:
+        system = str(messages[0].get("content", ""))
+        user = str(messages[-1].get("content", ""))
+        fields_block = _OUTPUT_FIELDS.search(system)
+        fields = _FIELD_NAME.findall(fields_block.group(1)) if fields_block else ["response"]
+        current = scenario.get()
+
+        values = {}
+        for name in fields:
+            match name:
+                case "category":
+                    values[name] = current.category
+                case "is_data_dump":
+                    values[name] = current.is_data_dump
+                case "confidence":
+                    values[name] = 0.9
+                case "is_hard_retrieval" | "is_hard_retrieval_o":
+                    values[name] = current.is_hard_retrieval
+                case "source_documents" | "document_ids_o":
+                    values[name] = current.source_documents
+                case "next_tool_name":
+                    done = len(_TOOL_STEP.findall(user))
+                    values[name] = current.tool_name if done < current.tool_calls else "finish"
+                case "next_tool_args":
+                    done = len(_TOOL_STEP.findall(user))
+                    values[name] = (
+                        TOOL_ARGS[current.tool_name](current) if done < current.tool_calls else {}
+                    )
+                case "sections":
+                    values[name] = ["# Benchmark\n\nGenerated by the benchmark harness."]
+                case "file_name":
+                    values[name] = "benchmark.pdf"
+                case "custom_css" | "set_event_reminder" | "output_doc":
+                    values[name] = ""
+                case _:
+                    values[name] = f"Benchmark {name.replace('_', ' ')}."
+
+        stage = "+".join(fields)
+        text = "\n\n".join(
+            f"[[ ## {name} ## ]]\n{value if isinstance(value, str) else json.dumps(value)}"
+            for name, value in values.items()
+        )
+        return stage, text + "\n\n[[ ## completed ## ]]"
+
+    def _response(self, messages: list[dict]) -> ModelResponse:
+        stage, text = self._answer(messages)
+        self.calls[stage] += 1
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        return ModelResponse(
+            model=self.model,
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            usage={
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.tokens_per_call,
+                "total_tokens": prompt_tokens + self.tokens_per_call,
+            },
+        )
+
+    def forward(self, prompt=None, messages=None, **kwargs):
+        time.sleep(self.latency)
+        return self._response(messages or [{"content": prompt}])
+
+    async def aforward(self, prompt=None, messages=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._response(messages or [{"content": prompt}])
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+# Gemini client used for voice transcription
+
+
+class FakeGenaiClient:
+    def __init__(self, latency: float = 0.5) -> None:
+        self.latency = latency
+        self.models = SimpleNamespace(generate_content=self.generate_content)
+
+    def generate_content(self, model: str, contents: list):
+        time.sleep(self.latency)  # The bot calls the sync client, keep blocking like the real one
+        return SimpleNamespace(text="This is a benchmark voice transcript. ")
+
+
+# In-process vector store
+
+
+def embed(text: str, dims: int = 256) -> list[float]:
+    vec = [0.0] * dims
+    for token in re.findall(r"\w+", text.lower()):
+        vec[int(hashlib.md5(token.encode()).hexdigest(), 16) % dims] += 1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def _matches(metadata: dict, where: Optional[dict]) -> bool:
+    if not where:
+        return True
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(_matches(metadata, sub) for sub in cond):
+                return False
+        elif key == "$or":
+            if not any(_matches(metadata, sub) for sub in cond):
+                return False
+        elif isinstance(cond, dict):
+            op, value = next(iter(cond.items()))
+            if op == "$in" and metadata.get(key) not in value:
+                return False
+            if op == "$nin" and metadata.get(key) in value:
+                return False
+            if op == "$eq" and metadata.get(key) != value:
+                return False
+            if op == "$ne" and metadata.get(key) == value:
+                return False
+        elif metadata.get(key) != cond:
+            return False
+    return True
+
+
+class InProcessCollection:
+    def __init__(self, name: str, client: "InProcessChroma") -> None:
+        self.name = name
+        self.client = client
+        self.rows: dict[str, tuple[list[float], str, dict]] = {}
+
+    async def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        new = [idx for idx, row_id in enumerate(ids) if row_id not in self.rows]
+        pick = lambda col: [col[idx] for idx in new] if col else None  # noqa: E731
+        await self.upsert(pick(ids), pick(documents), pick(metadatas), pick(embeddings))
+
+    async def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        for idx, row_id in enumerate(ids):
+            doc = documents[idx] if documents else self.rows.get(row_id, (None, "", {}))[1]
+            vec = embeddings[idx] if embeddings else embed(doc)
+            self.rows[row_id] = (list(vec), doc, dict(metadatas[idx]) if metadatas else {})
+
+    async def update(self, ids, documents=None, metadatas=None, embeddings=None):
+        for idx, row_id in enumerate(ids):
+            if row_id not in self.rows:
+                continue
+            vec, doc, meta = self.rows[row_id]
+            if documents:
+                doc = documents[idx]
+                vec = embed(doc)
+            if embeddings:
+                vec = list(embeddings[idx])
+            if metadatas:
+                meta = {**meta, **metadatas[idx]}
+            self.rows[row_id] = (vec, doc, meta)
+
+    async def delete(self, ids=None, where=None):
+        for row_id in list(ids or self.rows):
+            if row_id in self.rows and _matches(self.rows[row_id][2], where):
+                del self.rows[row_id]
+
+    async def get(self, ids=None, where=None, include=None, limit=None, offset=None):
+        selected = [
+            (row_id, row) for row_id, row in self.rows.items()
+            if (ids is None or row_id in ids) and _matches(row[2], where)
+        ][offset or 0 :][: limit or None]
+        return {
+            "ids": [row_id for row_id, _ in selected],
+            "documents": [row[1] for _, row in selected],
+            "metadatas": [row[2] for _, row in selected],
+        }
+
+    async def count(self):
+        return len(self.rows)
+
+    async def modify(self, name=None, **kwargs):
+        if name:
+            self.client.collections.pop(self.name, None)
+            self.client.collections[name] = self
+            self.name = name
+
+    async def query(self, query_texts=None, query_embeddings=None, n_results=10, where=None, include=None):
+        queries = query_embeddings or [embed(text) for text in query_texts or []]
+        result = defaultdict(list)
+        for qvec in queries:
+            scored = sorted(
+                (1 - sum(a * b for a, b in zip(qvec, vec)), row_id, doc, meta)
+                for row_id, (vec, doc, meta) in self.rows.items()
+                if _matches(meta, where)
+            )[:n_results]
+            result["ids"].append([row_id for _, row_id, _, _ in scored])
+            result["distances"].append([dist for dist, _, _, _ in scored])
+            result["documents"].append([doc for _, _, doc, _ in scored])
+            result["metadatas"].append([meta for _, _, _, meta in scored])
+        return dict(result)
+
+
+class InProcessChroma:
+    """Implements the subset of chromadb's AsyncClientAPI used by EmbeddingStore."""
+
+    def __init__(self) -> None:
+        self.collections: dict[str, InProcessCollection] = {}
+
+    async def get_or_create_collection(self, name: str, **kwargs):
+        if name not in self.collections:
+            self.collections[name] = InProcessCollection(name, self)
+        return self.collections[name]
+
+    async def get_collection(self, name: str, **kwargs):
+        return await self.get_or_create_collection(name)
+
+    async def create_collection(self, name: str, **kwargs):
+        return await self.get_or_create_collection(name)
+
+    async def delete_collection(self, name: str):
+        self.collections.pop(name, None)
+
+    async def list_collections(self):
+        return list(self.collections.values())
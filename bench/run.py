@@ -0,0 +1,351 @@
+"""End-to-end benchmark for the message pipeline.
+
+Drives UserHandler and UserSupportAgent against a fake Bot API server, a deterministic LM, an in-process
+vector store and a stub MCP server, then reports latency percentiles, throughput, LLM calls per message and
+peak RSS.
+
+    python -m bench.run --workload bench/workloads/mixed.json --messages 200 --llm-latency 0.3
+    python -m bench.run --save bench_output.json
+    python -m bench.run --compare bench_output.json  # Exit code 1 on regression
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# A one page PDF, poppler rebuilds the missing xref table
+PDF_BYTES = (
+    b"%PDF-1.1\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 200 200]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n%%EOF\n"
+)
+
+
+def png_bytes(size: int = 64) -> bytes:
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    raw = b"".join(b"\x00" + bytes(random.randrange(256) for _ in range(size * 3)) for _ in range(size))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+@dataclass
+class Sample:
+    kind: str
+    latency: float
+    updates: int
+    error: bool = False
+
+
+@dataclass
+class Results:
+    samples: list[Sample] = field(default_factory=list)
+    wall_time: float = 0.0
+    llm_calls: int = 0
+    llm_calls_with_background: int = 0
+    api_calls: dict[str, int] = field(default_factory=dict)
+
+    def report(self) -> dict:
+        latencies = sorted(s.latency for s in self.samples if not s.error)
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        messages = len(self.samples)
+        per_kind = {}
+        for kind in sorted({s.kind for s in self.samples}):
+            kind_lat = sorted(s.latency for s in self.samples if s.kind == kind and not s.error)
+            per_kind[kind] = {
+                "count": len(kind_lat),
+                "p50": statistics.median(kind_lat) if kind_lat else None,
+            }
+
+        return {
+            "messages": messages,
+            "errors": sum(s.error for s in self.samples),
+            "p50": quantiles[49] if quantiles else None,
+            "p95": quantiles[94] if quantiles else None,
+            "p99": quantiles[98] if quantiles else None,
+            "updates_per_sec": sum(s.updates for s in self.samples) / self.wall_time,
+            "llm_calls_per_message": self.llm_calls / messages,
+            "llm_calls_per_message_with_background": self.llm_calls_with_background / messages,
+            "telegram_calls_per_message": sum(self.api_calls.values()) / messages,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "per_kind": per_kind,
+            "telegram_calls": self.api_calls,
+        }
+
+
+def prepare_environment(workdir: Path):
+    """The bot keeps its state relative to the working directory, run it in a scratch one."""
+    os.chdir(workdir)
+    sys.path[:0] = [str(ROOT / "src"), str(ROOT)]
+    os.environ.setdefault("BOT_TOKEN", "42:BENCH")
+    os.environ.setdefault("GEMINI_KEY", "bench")
+    (workdir / "gen_docs").mkdir(exist_ok=True)
+
+    from db import DBConn
+
+    DBConn().setup_db()
+
+
+class Workload:
+    def __init__(self, spec: dict, api, seed: int) -> None:
+        self.spec = spec
+        self.api = api
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.message_id = 0
+        self.photo = png_bytes()
+
+    def _message(self, user_id: int, **content) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            **content,
+        }
+
+    def _file(self, prefix: str, data: bytes) -> dict:
+        file_id = f"{prefix}-{self.message_id}-{self.rng.randrange(1 << 30)}"
+        # Re-sent media keeps its file_unique_id, model that with a small pool of repeats
+        if self.rng.random() < self.spec.get("repeat_media_ratio", 0.0):
+            file_id = f"{prefix}-repeat-{self.rng.randrange(4)}"
+        self.api.add_file(file_id, data)
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data)}
+
+    def build(self, entry: dict, user_id: int) -> list[dict]:
+        kind = entry["kind"]
+        match kind:
+            case "text" | "reminder":
+                messages = [self._message(user_id, text=entry["text"])]
+            case "album":
+                group = f"mg-{self.message_id}"
+                messages = [
+                    self._message(
+                        user_id,
+                        media_group_id=group,
+                        photo=[{**self._file("photo", self.photo), "width": 64, "height": 64}],
+                    )
+                    for _ in range(entry.get("photos", 3))
+                ]
+            case "photo":
+                messages = [
+                    self._message(
+                        user_id, photo=[{**self._file("photo", self.photo), "width": 64, "height": 64}]
+                    )
+                ]
+            case "pdf":
+                messages = [
+                    self._message(
+                        user_id,
+                        document={
+                            **self._file("pdf", PDF_BYTES),
+                            "file_name": "slides.pdf",
+                            "mime_type": "application/pdf",
+                        },
+                    )
+                ]
+            case "voice":
+                messages = [
+                    self._message(
+                        user_id,
+                        voice={**self._file("voice", b"\x00" * 4096), "duration": 3, "mime_type": "audio/ogg"},
+                    )
+                ]
+            case _:
+                raise ValueError(f"Unknown workload kind: {kind}")
+
+        updates = []
+        for message in messages:
+            self.update_id += 1
+            updates.append({"update_id": self.update_id, "message": message})
+        return updates
+
+    def stream(self, count: int):
+        entries = self.spec["mix"]
+        weights = [entry.get("weight", 1) for entry in entries]
+        users = self.spec.get("users", 10)
+        for _ in range(count):
+            entry = self.rng.choices(entries, weights)[0]
+            user_id = 1000 + self.rng.randrange(users)
+            yield entry, user_id, self.build(entry, user_id)
+
+
+async def build_services(bot, api_latency: float, lm_latency: float) -> dict:
+    import main as bot_main
+    from bench.fakes import FakeGenaiClient, InProcessChroma, embed
+
+    from llm.cache import CompletionCache
+    from llm.modules import UserSupportAgent
+    from src import MediaGroupQueue
+    from src.media_cache import MediaCache
+    from src.ingest import IngestionQueue, IngestionWorker
+    from src.llm.tools import EmbeddingStore, McpClient
+
+    embed_store = EmbeddingStore()
+    embed_store.client = InProcessChroma()  # type: ignore
+    embed_store.embedding_function = lambda texts: [embed(text) for text in texts]
+    wiki_tools = await McpClient.create(sys.executable, [str(ROOT / "bench" / "stub_mcp.py")], {})
+    ingestion_queue = IngestionQueue()
+
+    user_agent = UserSupportAgent(
+        db=bot_main.db_con,
+        embed_store=embed_store,
+        wiki_tools=wiki_tools.tools,
+        cache=CompletionCache(),
+        ingestion_queue=ingestion_queue,
+    )
+
+    for idx in range(int(os.getenv("INGEST_WORKERS") or 2)):
+        worker = IngestionWorker(
+            f"BenchIngestionWorker-{idx}",
+            ingestion_queue,
+            user_agent.ingest,
+            lambda user_id, text: bot.send_message(chat_id=user_id, text=text),
+        )
+        asyncio.create_task(worker.run(), name=worker.name)
+
+    return {
+        "g_client": FakeGenaiClient(latency=lm_latency),
+        "user_agent": user_agent,
+        "media_group_queue": MediaGroupQueue(items={}, work_queue={}),
+        "media_cache": MediaCache(),
+        "ingestion_queue": ingestion_queue,
+    }
+
+
+async def run(args) -> Results:
+    import dspy
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+    from aiogram.types import Update
+
+    import main as bot_main
+    from bench.fakes import BenchLM, FakeBotAPI, Scenario, scenario
+    from llm import routing
+
+    api = FakeBotAPI(latency=args.api_latency)
+    base_url = await api.start()
+    bot = Bot(
+        token=os.environ["BOT_TOKEN"],
+        session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    lm = BenchLM(latency=args.llm_latency)
+    dspy.settings.configure(lm=lm)
+    routing.lm_factory = lambda model, max_tokens: lm  # Every routed stage hits the fake LM too
+
+    services = await build_services(bot, args.api_latency, args.llm_latency)
+    ingestion_queue = services.pop("ingestion_queue")
+    workload = Workload(json.loads(Path(args.workload).read_text()), api, args.seed)
+    results = Results()
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def feed(update: dict, current: Scenario):
+        scenario.set(current)
+        await bot_main.dp.feed_update(bot, Update.model_validate(update, context={"bot": bot}), **services)
+
+    async def play(kind: str, updates: list[dict], current: Scenario):
+        async with slots:
+            started = time.perf_counter()
+            outcome = await asyncio.gather(*(feed(u, current) for u in updates), return_exceptions=True)
+            errors = [e for e in outcome if isinstance(e, BaseException)]
+            for error in errors:
+                logging.error(f"{kind} message failed: {error!r}")
+            results.samples.append(Sample(kind, time.perf_counter() - started, len(updates), bool(errors)))
+
+    started = time.perf_counter()
+    tasks = []
+    for entry, user_id, updates in workload.stream(args.messages):
+        current = Scenario(**entry.get("scenario", {}), user_id=user_id)
+        tasks.append(asyncio.create_task(play(entry["kind"], updates, current)))
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+    results.wall_time = time.perf_counter() - started
+    results.llm_calls = lm.total_calls
+
+    # Let the ingestion workers catch up so background LLM calls are accounted for
+    async with asyncio.timeout(args.drain_timeout):
+        while ingestion_queue.depth().get("pending") or ingestion_queue.depth().get("running"):
+            await asyncio.sleep(0.5)
+    results.llm_calls_with_background = lm.total_calls
+    results.api_calls = dict(api.calls)
+
+    await bot.session.close()
+    await api.stop()
+    return results
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for metric in ("p50", "p95", "p99", "llm_calls_per_message", "telegram_calls_per_message", "peak_rss_mb"):
+        old, new = baseline.get(metric), report.get(metric)
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"{metric}: {old:.3f} -> {new:.3f}")
+    old, new = baseline.get("updates_per_sec"), report.get("updates_per_sec")
+    if old and new and new < old * (1 - tolerance):
+        regressions.append(f"updates_per_sec: {old:.3f} -> {new:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", default=str(ROOT / "bench" / "workloads" / "mixed.json"))
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16, help="Messages in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="Arrival rate in messages/s, 0 sends all at once")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds per fake LLM call")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="Seconds per fake Telegram call")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="Write the report as json")
+    parser.add_argument("--compare", help="Baseline report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+    # The run happens in a scratch directory, pin user supplied paths first
+    args.workload = str(Path(args.workload).resolve())
+    args.save = args.save and str(Path(args.save).resolve())
+    args.compare = args.compare and str(Path(args.compare).resolve())
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+    with tempfile.TemporaryDirectory(prefix="sahoo-bench-") as workdir:
+        prepare_environment(Path(workdir))
+        report = asyncio.run(run(args)).report()
+
+    print(json.dumps(report, indent=2))
+    if args.save:
+        Path(args.save).write_text(json.dumps(report, indent=2))
+    if args.compare:
+        regressions = compare(report, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""Stdio MCP server standing in for wikipedia-mcp during benchmarks."""
+
+from mcp.server.fastmcp import FastMCP
+
+server = FastMCP("wikipedia-stub")
+
+
+@server.tool()
+def search_wikipedia(query: str, limit: int = 5) -> str:
+    """Search Wikipedia for articles matching the query."""
+    return f"Benchmark article about {query}."
+
+
+@server.tool()
+def get_summary(title: str) -> str:
+    """Get a summary of a Wikipedia article."""
+    return f"{title} is a topic used by the benchmark harness."
+
+
+if __name__ == "__main__":
+    server.run()
@@ -8,6 +8,8 @@ from dataclasses import dataclass
 
 class QueryStatusManager:
     _instances: dict[int, list["QueryStatusManager"]] = {}
+    # Set in worker processes so media group ownership is shared, see src/shared.py
+    registry: typing.Optional[typing.Any] = None
 
     def __init__(self, msg: Message) -> None:
         self.msg: Message = msg
@@ -18,6 +20,14 @@ class QueryStatusManager:
             self._instances[msg.chat.id] = [self]
 
     async def set_media_grouped(self, media_group_id: str):
+        if self.registry is not None:
+            if media_group_id:
+                self.registry.claim_media_group(
+                    self.msg.chat.id, media_group_id, self.msg.message_id
+                )
+            self.media_group = media_group_id
+            return
+
         for instance in self._instances[self.msg.chat.id]:
             if instance.media_group == media_group_id:
                 return instance
@@ -69,6 +79,9 @@ class MediaGroupQueue:
         queue = self.work_queue[media_group_id]
         await queue.put(image)
 
+    async def next_item(self, media_group_id: str) -> typing.BinaryIO:
+        return await self.work_queue[media_group_id].get()
+
     async def set_processed(self, media_group_id: str):
         async with self.lock:
             if data := self.items.get(media_group_id):
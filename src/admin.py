@@ -0,0 +1,240 @@
+"""Runtime introspection for the bot's admins.
+
+The commands only answer the users listed in ADMIN (comma separated Telegram user ids):
+    /stats           Queue depths, caches, in-flight pipelines, asyncio tasks and event loop lag.
+    /profile [secs]  Sample every thread's stack and return them in collapsed format (flamegraph.pl, speedscope).
+    /memdiff [secs]  Diff two tracemalloc snapshots taken `secs` apart.
+
+The same data is served on localhost next to /metrics under /debug/. In cluster mode a command is answered by
+whichever worker picks the update up, and each worker serves its own /debug/ endpoints.
+"""
+
+import asyncio
+import html
+import json
+import pathlib
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+from collections import Counter, deque
+from contextlib import contextmanager
+from os import getenv
+
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import BufferedInputFile, Message
+from aiohttp import web
+
+from src.metrics import LOOP_LAG, sample_gauges
+
+MAX_CAPTURE_SECS = 120
+
+
+class LoopLagMonitor:
+    """Measures how late a timer on the event loop fires, i.e. how long callbacks block the loop."""
+
+    def __init__(self, interval: float = 0.5, window_secs: float = 60.0) -> None:
+        self.interval = interval
+        self.window_secs = window_secs
+        self.last = 0.0
+        self.samples: deque[tuple[float, float]] = deque()  # (time, lag) over the last window_secs
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.last = max(0.0, now - started - self.interval)
+            LOOP_LAG.observe(self.last)
+
+            self.samples.append((now, self.last))
+            while self.samples[0][0] < now - self.window_secs:
+                self.samples.popleft()
+
+    def stats(self) -> dict[str, float]:
+        # Reading doesn't reset anything, so /metrics scrapes and /stats see the same window
+        worst = max((lag for _, lag in self.samples), default=0.0)
+        return {
+            "lag_ms": round(self.last * 1000, 1),
+            f"max_lag_ms_{int(self.window_secs)}s": round(worst * 1000, 1),
+        }
+
+
+class PipelineTracker:
+    """Agent pipelines currently running in this process."""
+
+    def __init__(self) -> None:
+        self.active: dict[int, tuple[int, str, float]] = {}  # id -> (chat_id, kind, started)
+        self._next = 0
+
+    @contextmanager
+    def track(self, chat_id: int, kind: str):
+        self._next += 1
+        key = self._next
+        self.active[key] = (chat_id, kind, time.monotonic())
+        try:
+            yield
+        finally:
+            del self.active[key]
+
+    def snapshot(self) -> list[dict]:
+        now = time.monotonic()
+        return [
+            {"chat_id": chat_id, "kind": kind, "seconds": round(now - started, 1)}
+            for chat_id, kind, started in sorted(self.active.values(), key=lambda item: item[2])
+        ]
+
+    def stats(self) -> dict[str, float]:
+        oldest = min((started for _, _, started in self.active.values()), default=None)
+        return {
+            "in_flight": len(self.active),
+            "oldest_seconds": round(time.monotonic() - oldest, 1) if oldest is not None else 0,
+        }
+
+
+loop_lag = LoopLagMonitor()
+pipelines = PipelineTracker()
+# Profiles and snapshot diffs slow the whole process down, so only one runs at a time
+_capture = asyncio.Lock()
+
+
+def state_snapshot() -> dict:
+    tasks = Counter(
+        re.sub(r"-?\d+$", "", task.get_name()) or "unnamed" for task in asyncio.all_tasks()
+    )
+    return {
+        "gauges": sample_gauges(),
+        "pipelines": pipelines.snapshot(),
+        "tasks": dict(tasks.most_common()),
+        "threads": sorted(thread.name for thread in threading.enumerate()),
+    }
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{pathlib.Path(code.co_filename).stem}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """Sample the stacks of every other thread for `seconds`. Blocks, so call it on its own thread.
+    Returns:
+        One `thread;outermost;...;innermost count` line per distinct stack, most frequent first.
+    """
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks: Counter[str] = Counter()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if ident not in names:  # Started since, e.g. an executor thread
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stacks[";".join([names.get(ident, str(ident)), *reversed(stack)])] += 1
+        time.sleep(interval)
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+async def profile(seconds: float) -> str:
+    return await asyncio.to_thread(sample_stacks, seconds)
+
+
+async def memory_diff(seconds: float, top: int = 50) -> str:
+    """Allocation growth over `seconds`. Tracing is only switched on for the window unless it was already on."""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(10)
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>")]
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+    lines = [
+        f"tracemalloc diff over {seconds:g}s, traced {current / 2**20:.1f} MiB (peak {peak / 2**20:.1f} MiB)",
+        "",
+        *(str(stat) for stat in stats[:top]),
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def _capture_secs(value: typing.Optional[str], default: float) -> float:
+    try:
+        seconds = float(value) if value else default
+    except ValueError:
+        seconds = default
+    return min(max(seconds, 1.0), MAX_CAPTURE_SECS)
+
+
+def is_admin(message: Message) -> bool:
+    admins = {admin.strip() for admin in (getenv("ADMIN") or "").split(",") if admin.strip()}
+    return message.from_user is not None and str(message.from_user.id) in admins
+
+
+router = Router(name="admin")
+router.message.filter(is_admin)
+
+
+@router.message(Command("stats"))
+async def stats_command(message: Message):
+    text = json.dumps(state_snapshot(), indent=1, default=str)
+    if len(text) > 3900:
+        await message.reply_document(BufferedInputFile(text.encode(), filename="stats.json"))
+        return
+    await message.reply(f"<pre>{html.escape(text)}</pre>")
+
+
+async def _run_capture(message: Message, name: str, seconds: float, capture, filename: str):
+    if _capture.locked():
+        await message.reply("Another capture is still running.")
+        return
+    async with _capture:
+        status = await message.reply(f"Running {name} for {seconds:g}s...")
+        result = await capture(seconds)
+    await status.delete()
+    await message.reply_document(BufferedInputFile(result.encode(), filename=filename))
+
+
+@router.message(Command("profile"))
+async def profile_command(message: Message, command: CommandObject):
+    seconds = _capture_secs(command.args, 10)
+    await _run_capture(message, "the profiler", seconds, profile, f"profile-{int(time.time())}.folded")
+
+
+@router.message(Command("memdiff"))
+async def memdiff_command(message: Message, command: CommandObject):
+    seconds = _capture_secs(command.args, 30)
+    await _run_capture(message, "tracemalloc", seconds, memory_diff, f"memdiff-{int(time.time())}.txt")
+
+
+def debug_routes() -> list[web.RouteDef]:
+    async def state(request: web.Request):
+        return web.json_response(state_snapshot(), dumps=lambda obj: json.dumps(obj, default=str))
+
+    async def capture(request: web.Request, run, default: float):
+        if _capture.locked():
+            return web.Response(status=409, text="Another capture is still running.\n")
+        async with _capture:
+            result = await run(_capture_secs(request.query.get("seconds"), default))
+        return web.Response(text=result, content_type="text/plain", charset="utf-8")
+
+    return [
+        web.get("/debug/state", state),
+        web.get("/debug/profile", lambda request: capture(request, profile, 10)),
+        web.get("/debug/memdiff", lambda request: capture(request, memory_diff, 30)),
+    ]
@@ -4,9 +4,10 @@ import sqlite3
 import pickle
 from typing import BinaryIO, Optional
 from datetime import datetime
+from os import getenv
 
-import dspy
-from src.llm.tools import convert_image
+from src.ingest import create_ingest_jobs
+from src.metrics import instrument_methods
 
 
 class DocType(StrEnum):
@@ -15,17 +16,56 @@ class DocType(StrEnum):
     VOICE = "V"
 
 
+@instrument_methods("db")
 class DBConn:
     def __init__(self) -> None:
         self.db = sqlite3.connect("data.db")
         self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma busy_timeout=5000")
+        # Cap the WAL file left on disk after a checkpoint
+        self.db.execute("pragma journal_size_limit=67108864")
+        # Cold rows moved out by src/retention.py, see setup_archive
+        self.db.execute(
+            "ATTACH DATABASE ? AS archive", (getenv("ARCHIVE_DB") or "archive.db",)
+        )
+        self.setup_archive()
+
+    def setup_archive(self) -> None:
+        self.db.execute("pragma archive.journal_mode=wal")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS archive.messages (
+                    message_id INTEGER PRIMARY KEY,
+                    sender TEXT NOT NULL,
+                    content TEXT,
+                    imgs BLOB,
+                    file_id TEXT,
+                    doc_type TEXT,
+                    media_group_id TEXT,
+                    timestamp TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+                    """)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS archive.reminders(
+                    reminder_id INTEGER PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    message_id INTEGER,
+                    reminder_text TEXT NOT NULL,
+                    remind_at TIMESTAMP NOT NULL,
+                    created_at TIMESTAMP,
+                    status TEXT NOT NULL,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+                    """)
+        self.db.commit()
 
     def setup_db(self) -> None:
         cur = self.db.cursor()
+        # Lets src/retention.py hand freed pages back to the OS in small steps. Switching an existing
+        # database over takes a full VACUUM, so rerun this with the bot stopped.
+        if cur.execute("pragma auto_vacuum").fetchone()[0] != 2:
+            cur.execute("pragma auto_vacuum=incremental")
+            cur.execute("VACUUM")
         # user_id is the user's telegram username
         cur.execute("""CREATE TABLE IF NOT EXISTS users (
                         user_id TEXT UNIQUE NOT NULL, 
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );""")
 
         cur.execute("""CREATE TABLE IF NOT EXISTS messages (
@@ -47,6 +87,21 @@ class DBConn:
                     FOREIGN KEY(user_id) REFERENCES users (user_id),
                     FOREIGN KEY(message_id) REFERENCES messages(message_id));""")
 
+        # Telegram's (chat_id, message_id) of every stored user message and bot reply, used to resolve replies
+        cur.execute("""CREATE TABLE IF NOT EXISTS telegram_messages(
+                    chat_id INTEGER NOT NULL,
+                    tg_message_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, tg_message_id),
+                    FOREIGN KEY(message_id) REFERENCES messages(message_id)) WITHOUT ROWID;""")
+        # Used to find a stored message's owner when rebuilding embeddings (src/reindex.py)
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS telegram_messages_message ON telegram_messages(message_id)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS information_message ON information(message_id)"
+        )
+
         # status: 'pending', 'triggered', 'completed', 'dismissed'
         cur.execute("""CREATE TABLE IF NOT EXISTS reminders(
                     reminder_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -58,6 +113,33 @@ class DBConn:
                     status TEXT DEFAULT 'pending' NOT NULL,
                     FOREIGN KEY (user_id) REFERENCES users (user_id));
                     """)
+        # A retried ingestion job reruns the ScheduleAgent, a message can set each reminder only once
+        if not cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'reminders_unique'").fetchone():
+            cur.execute("""DELETE FROM reminders WHERE message_id IS NOT NULL AND reminder_id NOT IN (
+                        SELECT MIN(reminder_id) FROM reminders GROUP BY user_id, message_id, remind_at)""")
+        cur.execute("DROP INDEX IF EXISTS reminders_message")
+        cur.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS reminders_unique ON reminders(user_id, message_id, remind_at)"
+        )
+
+        # Topic clusters over the information table, summary is maintained incrementally
+        cur.execute("""CREATE TABLE IF NOT EXISTS info_clusters(
+                    cluster_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    size INTEGER DEFAULT 0 NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY(user_id) REFERENCES users (user_id));""")
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS info_cluster_members(
+                    info_id INTEGER PRIMARY KEY,
+                    cluster_id INTEGER NOT NULL,
+                    FOREIGN KEY(info_id) REFERENCES information(info_id),
+                    FOREIGN KEY(cluster_id) REFERENCES info_clusters(cluster_id));""")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS info_cluster_members_cluster ON info_cluster_members(cluster_id)"
+        )
+        create_ingest_jobs(self.db)
 
         self.db.commit()
         self.db.close()
@@ -87,35 +169,82 @@ class DBConn:
 
     def get_message_by_id(
         self, message_id: int
-    ) -> tuple[
-        Optional[str], Optional[list[dspy.Image]], Optional[str], Optional[DocType]
-    ]:
+    ) -> tuple[Optional[str], Optional[list], Optional[str], Optional[DocType]]:
         """Fetch message content and images by message_id.
             file_id and is_document are used to determine if the message is a document or not.
             LLMS ARE NOT SUPPOSED TO USE THE FILE_ID FOR ANY REASON.
         Returns:
             (content: str | None, images: [dspy.Image] | None, file_id: str | None, is_document: bool).
         """
-        sql = """SELECT content, imgs, file_id, doc_type FROM messages WHERE message_id = ?"""
+        sql = """SELECT content, imgs, file_id, doc_type FROM main.messages WHERE message_id = ?"""
         cur = self.db.cursor()
         cur.execute(sql, (message_id,))
         row = cur.fetchone()
+        if not row:  # Cold messages are moved to the archive by the retention job
+            cur.execute(sql.replace("main.", "archive."), (message_id,))
+            row = cur.fetchone()
 
         if not row:
             logging.warning(f"No message found with id: {message_id}")
             return (None, None, None, None)
 
         if row[1]:
+            from src.llm.tools import convert_image
+
             images = [convert_image(img) for img in pickle.loads(row[1])]
             return (row[0], images, row[2], row[3])
 
         return row
 
+    def get_messages_meta(
+        self, message_ids: list[int]
+    ) -> dict[int, tuple[Optional[str], Optional[str], Optional[DocType], bool]]:
+        """Content, file_id and doc_type of several messages in one query, images are not loaded.
+        Returns:
+            {message_id: (content, file_id, doc_type, has_images)} for the ids which exist.
+        """
+        marks = ", ".join("?" * len(message_ids))
+        columns = "message_id, content, file_id, doc_type, imgs IS NOT NULL"
+        sql = f"""SELECT {columns} FROM main.messages WHERE message_id IN ({marks})
+                UNION ALL
+                SELECT {columns} FROM archive.messages WHERE message_id IN ({marks})"""
+        cur = self.db.cursor()
+        cur.execute(sql, (*message_ids, *message_ids))
+        meta = {}
+        for message_id, *row in cur.fetchall():
+            meta.setdefault(message_id, tuple(row))  # main wins over a stale archive copy
+        return meta
+
+    def link_telegram_message(self, chat_id: int, tg_message_id: int, message_id: int):
+        sql = """INSERT OR REPLACE INTO telegram_messages(chat_id, tg_message_id, message_id) VALUES(?, ?, ?)"""
+        cur = self.db.cursor()
+        cur.execute(sql, (chat_id, tg_message_id, message_id))
+        self.db.commit()
+
+    def get_reply_reference(
+        self, chat_id: int, tg_message_id: int, excerpt_len: int = 300
+    ) -> Optional[tuple[int, str, Optional[str], Optional[DocType]]]:
+        """Resolve the Telegram message being replied to without loading its images.
+        Returns:
+            (message_id, sender, excerpt of the content, doc_type) or None if the message isn't known.
+        """
+        sql = """SELECT t.message_id, COALESCE(m.sender, a.sender), substr(COALESCE(m.content, a.content), 1, ?),
+                    COALESCE(m.doc_type, a.doc_type)
+                FROM telegram_messages t
+                LEFT JOIN main.messages m ON m.message_id = t.message_id
+                LEFT JOIN archive.messages a ON a.message_id = t.message_id
+                WHERE t.chat_id = ? AND t.tg_message_id = ?"""
+        cur = self.db.cursor()
+        cur.execute(sql, (excerpt_len, chat_id, tg_message_id))
+        row = cur.fetchone()
+        return row if row and row[1] else None
+
     def insert_reminder(
         self, user_id: str, content: str, remind_at: datetime, msg_id: int
     ):
-        """Insert a new reminder into the reminders table."""
-        sql = """INSERT INTO reminders(user_id, reminder_text, remind_at, message_id) VALUES(?, ?, ?, ?)"""
+        """Insert a new reminder into the reminders table. A message setting the same reminder again is ignored."""
+        sql = """INSERT OR IGNORE INTO reminders(user_id, reminder_text, remind_at, message_id)
+                VALUES(?, ?, ?, ?)"""
         cur = self.db.cursor()
         cur.execute(sql, (user_id, content, remind_at, msg_id))
         self.db.commit()
@@ -152,12 +281,68 @@ class DBConn:
         self.db.commit()
         return info_id
 
+    def get_info_by_message(self, msg_id: int) -> Optional[int]:
+        sql = """SELECT info_id FROM information WHERE message_id = ?"""
+        cur = self.db.cursor()
+        cur.execute(sql, (msg_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def get_info_cluster(self, info_id: int) -> Optional[int]:
+        sql = """SELECT cluster_id FROM info_cluster_members WHERE info_id = ?"""
+        cur = self.db.cursor()
+        cur.execute(sql, (info_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
     def get_info_with_user(self, user_id: str):
         sql = """SELECT content FROM information WHERE user_id = ?"""
         cur = self.db.cursor()
         cur.execute(sql, (user_id,))
         return cur.fetchall()
 
+    def create_cluster(self, user_id: str, summary: str, info_id: int) -> int:
+        sql = """INSERT INTO info_clusters(user_id, summary, size) VALUES(?, ?, 1) RETURNING cluster_id"""
+        cur = self.db.cursor()
+        cur.execute(sql, (user_id, summary))
+        cluster_id = cur.fetchone()[0]
+        cur.execute(
+            """INSERT OR REPLACE INTO info_cluster_members(info_id, cluster_id) VALUES(?, ?)""",
+            (info_id, cluster_id),
+        )
+        self.db.commit()
+        return cluster_id
+
+    def add_to_cluster(self, cluster_id: int, info_id: int, summary: str):
+        cur = self.db.cursor()
+        cur.execute(
+            """INSERT OR REPLACE INTO info_cluster_members(info_id, cluster_id) VALUES(?, ?)""",
+            (info_id, cluster_id),
+        )
+        cur.execute(
+            """UPDATE info_clusters SET summary = ?, size = size + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE cluster_id = ?""",
+            (summary, cluster_id),
+        )
+        self.db.commit()
+
+    def get_cluster(self, cluster_id: int) -> Optional[tuple[str, int]]:
+        """Returns:
+        (summary, size) of the cluster or None if it doesn't exist.
+        """
+        sql = """SELECT summary, size FROM info_clusters WHERE cluster_id = ?"""
+        cur = self.db.cursor()
+        cur.execute(sql, (cluster_id,))
+        return cur.fetchone()
+
+    def get_unclustered_info(self, user_id: str):
+        sql = """SELECT info.info_id, info.content FROM information info
+                LEFT JOIN info_cluster_members m ON m.info_id = info.info_id
+                WHERE info.user_id = ? AND m.cluster_id IS NULL ORDER BY info.info_id"""
+        cur = self.db.cursor()
+        cur.execute(sql, (user_id,))
+        return cur.fetchall()
+
     def close(self):
         self.db.close()
 
@@ -0,0 +1,133 @@
+import asyncio
+import html
+import logging
+import typing
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import (
+    InputMediaDocument,
+    InputMediaPhoto,
+    Message,
+)
+
+from db import DBConn, DocType
+from src.metrics import span
+
+CAPTION_LIMIT = 1024
+TEXT_LIMIT = 3900  # Same headroom under the 4096 character limit as TelegramReplyStream
+
+# Only items of the same kind can share a media group, voice notes can't be grouped at all
+MEDIA_TYPES = {
+    DocType.DOCUMENT: InputMediaDocument,
+    DocType.PHOTO: InputMediaPhoto,
+}
+
+
+class RetrievalDelivery:
+    """Sends the messages picked by a hard retrieval back to the user.
+
+    Metadata for every id is fetched in one query, documents and photos are batched into media groups of up to
+    10 and text only messages are joined. Batches are independent so they are sent concurrently, at most
+    `max_concurrency` at a time and retried after Telegram's flood wait.
+    """
+
+    MAX_GROUP = 10
+
+    def __init__(self, db: DBConn, max_concurrency: int = 4, max_attempts: int = 3) -> None:
+        self.db = db
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.max_attempts = max_attempts
+
+    def plan(self, doc_ids: list) -> list[tuple[str, list[tuple[int, str, typing.Optional[str]]]]]:
+        """Split the retrieved messages into batches of (kind, [(message_id, caption, file_id)])."""
+        ids = list(dict.fromkeys(int(doc_id) for doc_id in doc_ids if str(doc_id).isdigit()))
+        meta = self.db.get_messages_meta(ids) if ids else {}
+
+        grouped: dict[str, list] = {}
+        for message_id in ids:
+            if message_id not in meta:
+                logging.warning(f"Retrieved message {message_id} does not exist")
+                continue
+            content, file_id, doc_type, _ = meta[message_id]
+            kind = DocType(doc_type).name if file_id and doc_type else "TEXT"
+            grouped.setdefault(kind, []).append((message_id, content or "", file_id))
+
+        batches = []
+        for kind, items in grouped.items():
+            if kind == "TEXT":
+                batches += [(kind, chunk) for chunk in _text_chunks(items)]
+            elif kind == DocType.VOICE.name:
+                batches += [(kind, [item]) for item in items]
+            else:
+                batches += [
+                    (kind, items[idx : idx + self.MAX_GROUP])
+                    for idx in range(0, len(items), self.MAX_GROUP)
+                ]
+        return batches
+
+    async def deliver(self, event: Message, doc_ids: list) -> list[tuple[Message, int]]:
+        """Returns the sent Telegram messages paired with the message_id each one carries."""
+        batches = self.plan(doc_ids)
+        with span("delivery.retrieval", batches=str(len(batches))):
+            sent = await asyncio.gather(
+                *(self._send(event, kind, items) for kind, items in batches),
+                return_exceptions=True,
+            )
+
+        delivered = []
+        for outcome in sent:
+            if isinstance(outcome, BaseException):
+                logging.error(f"Could not deliver a retrieved batch: {outcome!r}")
+                continue
+            delivered += outcome
+        return delivered
+
+    async def _send(self, event: Message, kind: str, items: list) -> list[tuple[Message, int]]:
+        async with self.slots:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    return await self._send_batch(event, kind, items)
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_attempts:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+        return []
+
+    async def _send_batch(self, event: Message, kind: str, items: list) -> list[tuple[Message, int]]:
+        if kind == "TEXT":
+            text = "\n\n".join(html.escape(content[:TEXT_LIMIT]) for _, content, _ in items)
+            return [(await event.reply(text), items[0][0])]
+
+        if len(items) == 1:
+            message_id, content, file_id = items[0]
+            caption = html.escape(content[:CAPTION_LIMIT])
+            match DocType[kind]:
+                case DocType.DOCUMENT:
+                    sent = await event.reply_document(file_id, caption=caption)
+                case DocType.PHOTO:
+                    sent = await event.reply_photo(file_id, caption=caption)
+                case DocType.VOICE:
+                    sent = await event.reply_voice(file_id, caption=caption)
+            return [(sent, message_id)]
+
+        media_type = MEDIA_TYPES[DocType[kind]]
+        sent = await event.reply_media_group(
+            media=[
+                media_type(media=file_id, caption=html.escape(content[:CAPTION_LIMIT]))
+                for _, content, file_id in items
+            ]
+        )
+        return [(message, item[0]) for message, item in zip(sent, items)]
+
+
+def _text_chunks(items: list) -> typing.Iterator[list]:
+    chunk, size = [], 0
+    for item in items:
+        length = len(item[1]) + 2
+        if chunk and size + length > TEXT_LIMIT:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(item)
+        size += length
+    if chunk:
+        yield chunk
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import typing
+from dataclasses import dataclass, field
+
+
+# Stages run in order, a job's `stage` is the next one to run so retries resume where they failed.
+STAGES = ("summarise", "store", "index", "schedule", "done")
+
+FAILED_REPLY = "⚠️ Sorry, I couldn't save the data you sent earlier. Please send it again."
+
+
+@dataclass
+class IngestJob:
+    msg_id: int
+    user_id: int
+    stage: str
+    attempts: int
+    payload: dict = field(default_factory=dict)
+
+
+def create_ingest_jobs(db: sqlite3.Connection):
+    """Also used by setup_db and RetentionManager, which read the table before any queue may have been created."""
+    # status: 'pending', 'running', 'done', 'failed'
+    db.execute("""CREATE TABLE IF NOT EXISTS ingest_jobs(
+                    msg_id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL, -- json fmt
+                    stage TEXT DEFAULT 'summarise' NOT NULL,
+                    status TEXT DEFAULT 'pending' NOT NULL,
+                    attempts INTEGER DEFAULT 0 NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    locked_by TEXT,
+                    locked_until REAL,
+                    error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS ingest_jobs_status ON ingest_jobs(status, next_attempt_at)"
+    )
+
+
+class IngestionQueue:
+    """Durable queue of data dumps waiting to be ingested, stored in SQLite so it survives restarts.
+    Jobs are keyed on msg_id which makes enqueueing the same message twice a no-op.
+    """
+
+    def __init__(
+        self, path: str = "data.db", lease_secs: int = 600, max_attempts: int = 5
+    ) -> None:
+        self.db = sqlite3.connect(path)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma busy_timeout=5000")
+        create_ingest_jobs(self.db)
+        self.db.commit()
+
+        self.lease_secs = lease_secs
+        self.max_attempts = max_attempts
+        self.has_work = asyncio.Event()
+
+    def enqueue(self, msg_id: int, user_id: int, payload: dict) -> bool:
+        sql = """INSERT OR IGNORE INTO ingest_jobs(msg_id, user_id, payload, next_attempt_at) VALUES(?, ?, ?, ?)"""
+        cur = self.db.cursor()
+        cur.execute(sql, (msg_id, user_id, json.dumps(payload), time.time()))
+        self.db.commit()
+        self.has_work.set()
+        return cur.rowcount > 0
+
+    def claim(self, worker: str) -> typing.Optional[IngestJob]:
+        """Lease the oldest runnable job. Jobs whose lease ran out (crashed worker) are runnable again."""
+        now = time.time()
+        sql = """UPDATE ingest_jobs SET status = 'running', locked_by = ?, locked_until = ?, attempts = attempts + 1
+                WHERE msg_id = (
+                    SELECT msg_id FROM ingest_jobs
+                    WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'running' AND locked_until < ?)
+                    ORDER BY next_attempt_at LIMIT 1)
+                RETURNING msg_id, user_id, stage, attempts, payload"""
+        cur = self.db.cursor()
+        cur.execute(sql, (worker, now + self.lease_secs, now, now))
+        row = cur.fetchone()
+        self.db.commit()
+
+        if not row:
+            return None
+        return IngestJob(row[0], row[1], row[2], row[3], json.loads(row[4]))
+
+    def checkpoint(self, job: IngestJob, stage: str):
+        job.stage = stage
+        sql = """UPDATE ingest_jobs SET stage = ?, payload = ? WHERE msg_id = ?"""
+        self.db.execute(sql, (stage, json.dumps(job.payload), job.msg_id))
+        self.db.commit()
+
+    def complete(self, job: IngestJob):
+        sql = """UPDATE ingest_jobs SET status = 'done', stage = 'done', locked_by = NULL, error = NULL
+                WHERE msg_id = ?"""
+        self.db.execute(sql, (job.msg_id,))
+        self.db.commit()
+
+    def fail(self, job: IngestJob, error: str) -> bool:
+        """Returns:
+        True if the job ran out of attempts and won't be retried.
+        """
+        if job.attempts >= self.max_attempts:
+            status, next_attempt_at = "failed", time.time()
+        else:
+            status, next_attempt_at = "pending", time.time() + 30 * 2**job.attempts
+
+        sql = """UPDATE ingest_jobs SET status = ?, next_attempt_at = ?, locked_by = NULL, error = ?
+                WHERE msg_id = ?"""
+        self.db.execute(sql, (status, next_attempt_at, error, job.msg_id))
+        self.db.commit()
+        return status == "failed"
+
+    def depth(self) -> dict[str, int]:
+        cur = self.db.execute(
+            "SELECT status, COUNT(*) FROM ingest_jobs WHERE status != 'done' GROUP BY status"
+        )
+        counts = dict(cur.fetchall())
+        # Every status is reported, a gauge whose key disappeared would keep showing its last count
+        return {status: counts.get(status, 0) for status in ("pending", "running", "failed")}
+
+    def close(self):
+        self.db.close()
+
+
+class IngestionWorker:
+    def __init__(
+        self,
+        name: str,
+        queue: IngestionQueue,
+        ingest: typing.Callable[[IngestJob, IngestionQueue], typing.Awaitable[str]],
+        notify: typing.Callable[[int, str], typing.Awaitable[typing.Any]],
+        poll_secs: int = 30,
+    ) -> None:
+        self.name = name
+        self.queue = queue
+        self.ingest = ingest
+        self.notify = notify
+        self.poll_secs = poll_secs
+
+    async def run(self):
+        while True:
+            self.queue.has_work.clear()
+            job = self.queue.claim(self.name)
+
+            if job is None:
+                try:
+                    async with asyncio.timeout(self.poll_secs):
+                        await self.queue.has_work.wait()
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            logging.info(
+                f"{self.name} ingesting msg_id: {job.msg_id} from stage {job.stage} (attempt {job.attempts})"
+            )
+            try:
+                reply = await self.ingest(job, self.queue)
+            except Exception as e:
+                logging.exception(f"Ingestion of msg_id: {job.msg_id} failed at {job.stage}")
+                if not self.queue.fail(job, f"{job.stage}: {e}"):
+                    continue
+                reply = FAILED_REPLY  # The user was told they'd hear back once it's saved
+            else:
+                self.queue.complete(job)
+
+            try:
+                await self.notify(job.user_id, reply)
+            except Exception:
+                logging.exception(f"Could not notify user {job.user_id} about msg_id: {job.msg_id}")
@@ -1,6 +1,17 @@
-import dspy
 import os
+from typing import Optional
 
 LLM_API_KEY = os.getenv("GEMINI_KEY")
-model_api = dspy.LM("gemini/gemini-2.5-flash", api_key=LLM_API_KEY, max_tokens=8000)
-dspy.settings.configure(lm=model_api)
+
+
+def configure_lm(callbacks: Optional[list] = None):
+    """Build the global LM. Kept out of import time since dspy and LiteLLM take seconds to import.
+    dspy only allows the task which configured it first to reconfigure it, so everything goes in this one call.
+    """
+    import dspy
+    from llm.routing import FLASH, get_lm
+
+    # Default for anything not routed per stage, see llm/routing.py
+    model_api = get_lm(FLASH, 8000)
+    dspy.settings.configure(lm=model_api, callbacks=callbacks or [])
+    return model_api
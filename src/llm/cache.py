@@ -0,0 +1,208 @@
+import enum
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import time
+from collections import Counter
+from os import getenv
+from typing import Any, Optional
+
+import dspy
+from pydantic import BaseModel
+
+from llm.routing import route_for
+
+
+# Seconds a completion stays valid per signature. Stages missing here (ReAct agents, document generation)
+# have side effects or are expected to vary between runs, so they are never cached.
+CACHE_POLICIES: dict[str, Optional[float]] = {
+    "ClassifyQuery": 7 * 24 * 3600,
+    "Analyzer": 30 * 24 * 3600,
+    "ResponsePolisher": 24 * 3600,
+}
+
+
+class CompletionCache:
+    """Disk backed cache of dspy predictions shared by every bot process using the same file.
+    Entries are evicted least-recently-used once the total payload size goes over max_bytes.
+    """
+
+    def __init__(self, path: str = "llm_cache.db", max_bytes: int = 256 * 1024 * 1024):
+        self.db = sqlite3.connect(path)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma busy_timeout=5000")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS completions(
+                        key TEXT PRIMARY KEY,
+                        signature TEXT NOT NULL,
+                        value BLOB NOT NULL, -- pickle fmt
+                        size INTEGER NOT NULL,
+                        created_at REAL NOT NULL,
+                        accessed_at REAL NOT NULL)""")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions(accessed_at)"
+        )
+        self.db.commit()
+
+        self.max_bytes = max_bytes
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()[0]
+        self.hits: Counter[str] = Counter()
+        self.misses: Counter[str] = Counter()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=getenv("LLM_CACHE_PATH") or "llm_cache.db",
+            max_bytes=int(getenv("LLM_CACHE_MAX_MB") or 256) * 1024 * 1024,
+        )
+
+    def get(self, key: str, signature: str, ttl: float) -> Optional[dict]:
+        row = self.db.execute(
+            "SELECT value, created_at FROM completions WHERE key = ?", (key,)
+        ).fetchone()
+
+        if not row or time.time() - row[1] > ttl:
+            self.misses[signature] += 1
+            return None
+
+        self.hits[signature] += 1
+        self.db.execute(
+            "UPDATE completions SET accessed_at = ? WHERE key = ?", (time.time(), key)
+        )
+        self.db.commit()
+        return pickle.loads(row[0])
+
+    def put(self, key: str, signature: str, value: dict):
+        blob = pickle.dumps(value)
+        now = time.time()
+        # A replaced entry's bytes are freed, otherwise the running size drifts up and evicts early
+        replaced = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions WHERE key = ?", (key,)
+        ).fetchone()[0]
+        self.db.execute(
+            """INSERT OR REPLACE INTO completions(key, signature, value, size, created_at, accessed_at)
+            VALUES(?, ?, ?, ?, ?, ?)""",
+            (key, signature, blob, len(blob), now, now),
+        )
+        self.db.commit()
+        self.size += len(blob) - replaced
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Other processes write to the same file, so re-read the real size before trimming.
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        freed = 0
+        cur = self.db.execute(
+            "SELECT key, size FROM completions ORDER BY accessed_at"
+        )
+        stale = []
+        for key, size in cur:
+            if self.size - freed <= target:
+                break
+            stale.append((key,))
+            freed += size
+
+        self.db.executemany("DELETE FROM completions WHERE key = ?", stale)
+        self.db.commit()
+        self.size -= freed
+        logging.info(f"Evicted {len(stale)} cached completions ({freed} bytes)")
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        stats = {}
+        for signature in self.hits.keys() | self.misses.keys():
+            hits, misses = self.hits[signature], self.misses[signature]
+            stats[signature] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses),
+            }
+        return stats
+
+    def close(self):
+        self.db.close()
+
+
+def _fingerprint(value: Any, h: "hashlib._Hash"):
+    if isinstance(value, dspy.Image):
+        h.update(hashlib.sha256(str(value.url).encode()).digest())
+    elif isinstance(value, BaseModel):
+        h.update(value.model_dump_json().encode())
+    elif isinstance(value, enum.Enum):
+        h.update(repr(value.value).encode())
+    elif isinstance(value, dict):
+        for k in sorted(value, key=str):
+            h.update(str(k).encode())
+            _fingerprint(value[k], h)
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[")
+        for item in value:
+            _fingerprint(item, h)
+            h.update(b",")
+        h.update(b"]")
+    else:
+        h.update(json.dumps(value, default=repr).encode())
+
+
+class CachedModule(dspy.Module):
+    """Wraps a dspy module so identical calls (same signature, model and inputs) are answered from the
+    CompletionCache.
+    """
+
+    def __init__(self, module: dspy.Module, signature: str, cache: CompletionCache):
+        super().__init__()
+        self.module = module
+        self.signature = signature
+        self.cache = cache
+        self.ttl = CACHE_POLICIES.get(signature)
+
+    def cache_key(self, inputs: dict) -> str:
+        h = hashlib.sha256()
+        h.update(self.signature.encode())
+        if (stage := getattr(self.module, "stage", None)) is not None:
+            # Routed stages are answered by their route (any model of the cascade), not the global LM
+            h.update(",".join(route_for(stage).models).encode())
+        else:
+            lm = dspy.settings.lm
+            h.update(str(getattr(lm, "model", lm)).encode())
+        _fingerprint(inputs, h)
+        return h.hexdigest()
+
+    def lookup(self, inputs: dict) -> tuple[Optional[str], Optional[dspy.Prediction]]:
+        if not self.ttl:
+            return None, None
+
+        key = self.cache_key(inputs)
+        if (cached := self.cache.get(key, self.signature, self.ttl)) is not None:
+            logging.debug(f"Completion cache hit for {self.signature}")
+            return key, dspy.Prediction(**cached)
+        return key, None
+
+    def store(self, key: Optional[str], pred: dspy.Prediction):
+        if key is None:
+            return
+        try:
+            self.cache.put(key, self.signature, dict(pred.items()))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.warning(f"Could not cache {self.signature} prediction: {e}")
+
+    def forward(self, **kwargs):
+        key, pred = self.lookup(kwargs)
+        if pred is None:
+            pred = self.module(**kwargs)
+            self.store(key, pred)
+        return pred
+
+    async def aforward(self, **kwargs):
+        key, pred = self.lookup(kwargs)
+        if pred is None:
+            pred = await self.module.acall(**kwargs)
+            self.store(key, pred)
+        return pred
@@ -0,0 +1,37 @@
+import time
+import typing
+
+from dspy.utils.callback import BaseCallback
+
+from src.metrics import SPAN_ERRORS, SPAN_SECONDS, current_category
+
+
+class DspyMetricsCallback(BaseCallback):
+    """Times every dspy module and tool call, so each stage of UserSupportAgent shows up without extra wrapping."""
+
+    def __init__(self) -> None:
+        self.started: dict[str, tuple[str, str, float]] = {}
+
+    def on_module_start(self, call_id, instance, inputs):
+        name = type(instance).__name__
+        if signature := getattr(instance, "signature", None) or getattr(instance, "stage", None):
+            name = f"{name}[{getattr(signature, '__name__', signature)}]"
+        self.started[call_id] = ("dspy.module", name, time.perf_counter())
+
+    def on_module_end(self, call_id, outputs, exception=None):
+        self._finish(call_id, exception)
+
+    def on_tool_start(self, call_id, instance, inputs):
+        self.started[call_id] = ("dspy.tool", instance.name, time.perf_counter())
+
+    def on_tool_end(self, call_id, outputs, exception=None):
+        self._finish(call_id, exception)
+
+    def _finish(self, call_id: str, exception: typing.Optional[Exception]):
+        if (started := self.started.pop(call_id, None)) is None:
+            return
+        stage, name, t0 = started
+        labels = {"name": name, "category": current_category.get()}
+        SPAN_SECONDS.observe(time.perf_counter() - t0, stage=stage, **labels)
+        if exception is not None:
+            SPAN_ERRORS.inc(stage=stage, **labels)
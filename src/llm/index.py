@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+import dspy
+
+from db import DBConn
+from llm.tools import EmbeddingStore
+from llm.signatures import TopicSummary
+from llm.multiplexer import Priority, llm_priority
+from llm.routing import RoutedModule, validate_summary
+
+
+class KnowledgeIndex:
+    """Two level index over a user's information store.
+
+    Every info row belongs to a topic cluster whose summary is folded forward as rows are added. Search picks
+    the closest clusters first and only expands into their rows, so the amount of text handed to the
+    InfoAgent stays about the same no matter how much a user has stored.
+    """
+
+    def __init__(
+        self,
+        db: DBConn,
+        embed_store: EmbeddingStore,
+        join_distance: float = 0.35,
+        cluster_fanout: int = 3,
+        leaf_results: int = 6,
+    ) -> None:
+        self.db = db
+        self.embed_store = embed_store
+        self.join_distance = join_distance
+        self.cluster_fanout = cluster_fanout
+        self.leaf_results = leaf_results
+
+        self.summarizer = RoutedModule(
+            dspy.Predict(TopicSummary), "TopicSummary", validate_summary
+        )
+        self.locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.backfilled: set[int] = set()
+
+    async def add(self, info_id: int, summary: str, user_id: int) -> int:
+        """File an info row under its closest topic (or a new one) and refresh that topic's summary.
+        Returns:
+            cluster_id: The cluster the info row was added to.
+        """
+        async with self.locks[user_id]:
+            # Backfill and live ingestion can both pick up a fresh row, only the first one files it
+            if (cluster_id := self.db.get_info_cluster(info_id)) is not None:
+                return cluster_id
+
+            nearest = await self.embed_store.nearest_clusters(summary, user_id, 1)
+
+            if nearest and nearest[0][1] <= self.join_distance:
+                cluster_id, _, topic_summary = nearest[0]
+                with llm_priority(Priority.BACKGROUND):
+                    merged = (
+                        await self.summarizer.acall(
+                            topic_summary=topic_summary, new_info=summary
+                        )
+                    ).updated_summary
+                self.db.add_to_cluster(cluster_id, info_id, merged)
+            else:
+                merged = summary
+                cluster_id = self.db.create_cluster(str(user_id), summary, info_id)
+
+            await self.embed_store.upsert_cluster_embedding(merged, user_id, cluster_id)
+            logging.info(f"Filed info_id: {info_id} under cluster {cluster_id}")
+            return cluster_id
+
+    async def backfill(self, user_id: int):
+        """Cluster info rows stored before the index existed. If any row fails the user is backfilled again on
+        their next lookup.
+        """
+        failed = 0
+        for info_id, content in self.db.get_unclustered_info(str(user_id)):
+            try:
+                cluster_id = await self.add(info_id, content, user_id)
+                await self.embed_store.set_info_cluster(info_id, cluster_id)
+            except Exception:
+                failed += 1
+                logging.exception(f"Could not backfill info_id: {info_id} into the index")
+
+        if failed:
+            self.backfilled.discard(user_id)
+
+    async def search_memory(self, queries: list[str], user_id: int):
+        """Search everything the user has stored and sent before. Pass two or three different phrasings of what you
+        are looking for, they are all searched at once.
+        Returns:
+            {"topics": [Summary], "results": [(msg_id, Distance, Source, Document)]}: Summaries of the closest topics
+                and the best matches ranked by distance, one per msg_id. Source is "info" for a summary of stored
+                information and "message" for a past message of the user.
+        """
+        if user_id not in self.backfilled:
+            self.backfilled.add(user_id)
+            asyncio.create_task(self.backfill(user_id), name=f"IndexBackfill-{user_id}")
+
+        found = await self.embed_store.search(
+            queries[:4], user_id, self.leaf_results + 2, self.cluster_fanout
+        )
+        return {
+            "topics": [summary for _, _, summary in found["topics"]],
+            "results": found["results"],
+        }
@@ -1,17 +1,36 @@
+from datetime import datetime
 from os import getenv
 import pathlib
 import dspy
 import logging
 
 from db import DBConn
-from typing import Optional, BinaryIO
+from typing import Optional, BinaryIO, Protocol
 from llm.tools import (
     EmbeddingStore,
     create_pdf,
 )
+from llm.cache import CachedModule, CompletionCache
+from llm.index import KnowledgeIndex
+from llm.multiplexer import Priority, llm_priority
+from llm.routing import (
+    RoutedModule,
+    route_for,
+    validate_classification,
+    validate_response,
+    validate_schedule,
+)
+from llm.response import FALLBACK_ANSWER, ProposedResponse, ResponsePolicy
+from llm.tool_adapter import (
+    compact_tool,
+    max_iters_for,
+    message_lookup,
+    trajectory_budget,
+)
 from llm.signatures import (
     Analyzer,
     ClassifyQuery,
+    DataDumpSummary,
     DocumentGenerator,
     ResponsePolisher,
     InfoAgent,
@@ -21,6 +40,14 @@ from llm.signatures import (
 
 from src.llm.tools import convert_image
 from src import QueryStatusManager
+from src.ingest import STAGES, IngestJob, IngestionQueue
+from src.metrics import current_category, record_react_iterations
+
+
+class ResponseStream(Protocol):
+    async def push(self, chunk: str): ...
+
+    def reset(self): ...
 
 
 class UserSupportAgent(dspy.Module):
@@ -29,30 +56,84 @@ class UserSupportAgent(dspy.Module):
         db: DBConn,
         embed_store: EmbeddingStore,
         wiki_tools: list[dspy.Tool],
+        cache: CompletionCache,
+        ingestion_queue: IngestionQueue,
         # docgen_tools: list[dspy.Tool],
     ):
         super().__init__()
         self.db = db
         self.embed_store = embed_store
+        self.cache = cache
+        self.ingestion_queue = ingestion_queue
+        self.knowledge_index = KnowledgeIndex(db, embed_store)
+
+        self.q_classifier = CachedModule(
+            RoutedModule(
+                dspy.Predict(ClassifyQuery), "ClassifyQuery", validate_classification
+            ),
+            "ClassifyQuery",
+            cache,
+        )
+        self.document_generator = RoutedModule(
+            dspy.ChainOfThought(DocumentGenerator), "DocumentGenerator"
+        )
+
+        self.analyzer = CachedModule(
+            RoutedModule(dspy.Predict(Analyzer), "Analyzer"), "Analyzer", cache
+        )
+        self.dump_summarizer = RoutedModule(
+            dspy.Predict(DataDumpSummary), "DataDumpSummary"
+        )
+        self.set_wiki_tools(wiki_tools)
+        self.answer_rephraser = CachedModule(
+            RoutedModule(
+                dspy.Predict(ResponsePolisher), "ResponsePolisher", validate_response
+            ),
+            "ResponsePolisher",
+            cache,
+        )
+        self.response_policy = ResponsePolicy()
+
+    def schedule_agent(self, user_id: int, msg_id: int) -> RoutedModule:
+        """A ScheduleAgent whose tools are bound to the message being handled, the model only chooses what to
+        remind the user of and when.
+        """
 
-        self.q_classifier = dspy.Predict(ClassifyQuery)
-        self.schedule_agent = dspy.ReAct(
-            ScheduleAgent, tools=[db.insert_reminder, db.get_pending_reminders]
-        )  # noqa: F82
-        self.document_generator = dspy.ChainOfThought(DocumentGenerator)
-
-        self.analyzer = dspy.Predict(Analyzer)
-        self.info_agent = dspy.ReAct(
-            InfoAgent,
-            tools=[
-                embed_store.retrieve_relevant_info,
-                embed_store.retrieve_relevant_messages,
-                db.get_pending_reminders,
-                db.get_message_by_id,
-                *wiki_tools,
-            ],
+        def insert_reminder(content: str, remind_at: datetime):
+            """Set a reminder for the user."""
+            self.db.insert_reminder(str(user_id), content, remind_at, msg_id)
+
+        def get_pending_reminders():
+            """Get the user's pending reminders which are due, as (reminder_id, reminder_text, remind_at)."""
+            return self.db.get_pending_reminders(str(user_id))
+
+        return RoutedModule(
+            dspy.ReAct(
+                ScheduleAgent,
+                tools=[compact_tool(insert_reminder), compact_tool(get_pending_reminders)],
+            ),
+            "ScheduleAgent",
+            validate_schedule,
+        )
+
+    def set_wiki_tools(self, wiki_tools: list[dspy.Tool]):
+        """(Re)build the InfoAgent, wikipedia tools can arrive after the agent is already serving."""
+        self.wiki_tools = wiki_tools
+        self.info_agent = RoutedModule(
+            dspy.ReAct(
+                InfoAgent,
+                tools=[
+                    compact_tool(self.knowledge_index.search_memory),
+                    compact_tool(self.db.get_pending_reminders),
+                    compact_tool(
+                        message_lookup(self.db),
+                        raw_when=lambda kwargs: kwargs.get("include_images", False),
+                    ),
+                    *[compact_tool(tool) for tool in wiki_tools],
+                ],
+            ),
+            "InfoAgent",
         )
-        self.answer_rephraser = dspy.Predict(ResponsePolisher)
 
     async def aforward(
         self,
@@ -63,6 +144,8 @@ class UserSupportAgent(dspy.Module):
         msg_id: int,
         chat_history: dict,
         is_grouped_msg: bool = False,
+        response_stream: Optional[ResponseStream] = None,
+        reply_context: Optional[str] = None,
     ):
         [img.seek(0) for img in images] if images else None
 
@@ -71,9 +154,24 @@ class UserSupportAgent(dspy.Module):
         classification = await self.q_classifier.acall(
             user_text=query,
             user_images=imgs,
+            reply_context=reply_context,
         )
 
         logging.info(f"CAT:{classification.category}")
+        current_category.set(classification.category.value)
+
+        if classification.category is QueryCategory.INFORMATION and classification.get(
+            "is_data_dump", False
+        ):
+            # Summarising, embedding and reminder extraction happen in the ingestion workers
+            self.ingestion_queue.enqueue(msg_id, user_id, {"query": query})
+            if is_grouped_msg:
+                return
+            return self.response_policy.format_locally(
+                ProposedResponse(
+                    category=classification.category, answer="", queued_ingest=True
+                )
+            )
 
         if not query:
             query = (await self.analyzer.acall(context_img=imgs)).summary
@@ -83,6 +181,8 @@ class UserSupportAgent(dspy.Module):
         )
         is_hard_retrieval = False
         doc_ids = []
+        output_doc = None
+        queued_ingest = False
 
         match classification.category:
             case QueryCategory.INFORMATION | QueryCategory.ASSIGNMENT_GENERATION:
@@ -92,19 +192,27 @@ class UserSupportAgent(dspy.Module):
                     "🔍 Analyzing and retrieving relevent information..."
                 )
 
-                info = await self.info_agent.acall(
-                    context_txt=query,
-                    context_img=imgs,
-                    user_id=user_id,
-                    history=dspy.History(messages=info_history),
-                )
+                with trajectory_budget():
+                    info = await self.info_agent.acall(
+                        context_txt=query,
+                        context_img=imgs,
+                        user_id=user_id,
+                        reply_context=reply_context,
+                        history=dspy.History(messages=info_history),
+                        max_iters=max_iters_for(
+                            classification.category, bool(reply_context)
+                        ),
+                    )
+                record_react_iterations("InfoAgent", info)
                 await status_manager.edit_last_line("✅ Analyzing and retrieving relevent information...")
                 info_history.append(
                     {
                         "context_txt": query,
                         "context_img": imgs,
                         "user_id": user_id,
-                        **info,
+                        "reply_context": reply_context,
+                        # The trajectory is per run, carrying it in history would resend it on every later call
+                        **{k: v for k, v in info.items() if k != "trajectory"},
                     }
                 )
 
@@ -118,27 +226,19 @@ class UserSupportAgent(dspy.Module):
                     and classification.category
                     is not QueryCategory.ASSIGNMENT_GENERATION
                 ):
-                    await status_manager.update_message("⚪ Updating Information database")
-                    info_id = self.db.insert_info(proposed_ans, msg_id, str(user_id))
-                    await self.embed_store.insert_info_embedding(
-                        summary=proposed_ans,
-                        user_id=user_id,
-                        info_id=info_id,
-                        msg_id=msg_id,
-                        has_img=True if imgs else False,
+                    # Already summarised by the agent, the workers only store, index and schedule it
+                    self.ingestion_queue.enqueue(
+                        msg_id,
+                        user_id,
+                        {
+                            "query": query,
+                            "summary": proposed_ans,
+                            "event_prompt": info.set_event_reminder,
+                            "has_img": bool(imgs),
+                            "message_embedded": True,
+                        },
                     )
-
-                    await status_manager.edit_last_line(
-                        "✅ Information database updated"
-                    )
-
-                    if event_prompt := info.set_event_reminder:
-                        scheduled_pred = await self.schedule_agent.acall(
-                            user_id=user_id,
-                            content_txt=event_prompt,
-                            content_img=imgs,
-                        )
-                        proposed_ans += scheduled_pred.response
+                    queued_ingest = True
 
                 if info.source_documents:
                     await status_manager.update_message(
@@ -169,32 +269,185 @@ class UserSupportAgent(dspy.Module):
                     )
                     logging.info(f"The document has been saved to {o_path}")
                     proposed_ans = f"The document has been generated with file name: {docgen_pred.file_name}"
+                    output_doc = docgen_pred.file_name
 
             case QueryCategory.SCHEDULE:
-                scheduled_pred = await self.schedule_agent.acall(
-                    user_id=user_id,
-                    content_txt=query,
-                    content_img=imgs,
-                )
+                with trajectory_budget():
+                    scheduled_pred = await self.schedule_agent(user_id, msg_id).acall(
+                        user_id=user_id,
+                        content_txt=query,
+                        content_img=imgs,
+                        reply_context=reply_context,
+                        max_iters=max_iters_for(
+                            classification.category, bool(reply_context)
+                        ),
+                    )
+                record_react_iterations("ScheduleAgent", scheduled_pred)
                 proposed_ans = scheduled_pred.response
 
             case _:
-                proposed_ans = "I'm sorry, but I couldn't understand your request."
+                proposed_ans = FALLBACK_ANSWER
 
         if is_grouped_msg:
             return
 
-        final_ans = await self.answer_rephraser.acall(
-            user_query=query,
-            proposed_answer=proposed_ans,
+        proposed = ProposedResponse(
             category=classification.category,
-            is_hard_retrieval=is_hard_retrieval,
+            answer=proposed_ans,
             document_ids=doc_ids,
+            is_hard_retrieval=is_hard_retrieval,
+            output_doc=output_doc,
+            queued_ingest=queued_ingest,
         )
 
-        self.db.insert_message("llm", final_ans.response)  # type: ignore
+        if self.response_policy.needs_polish(proposed):
+            polisher_inputs = dict(
+                user_query=query,
+                proposed_answer=proposed_ans,
+                category=classification.category,
+                is_hard_retrieval=is_hard_retrieval,
+                document_ids=doc_ids,
+            )
+            if response_stream is None:
+                polished = await self.answer_rephraser.acall(**polisher_inputs)
+            else:
+                polished = await self.stream_polished(polisher_inputs, response_stream)
+            final_ans = self.response_policy.finalize(polished, proposed)
+        else:
+            final_ans = self.response_policy.format_locally(proposed)
+
+        # main links the sent Telegram message(s) to this id so replies to them resolve
+        final_ans.msg_id = self.db.insert_message("llm", final_ans.response)  # type: ignore
         await self.embed_store.insert_message_embedding(
             content=query, user_id=user_id, is_llm=True, msg_id=msg_id
         )
         logging.info(final_ans)
         return final_ans
+
+    async def stream_polished(
+        self, polisher_inputs: dict, response_stream: ResponseStream
+    ) -> dspy.Prediction:
+        """Run ResponsePolisher with LiteLLM streaming, pushing the `response` field to the stream as it arrives."""
+        key, cached = self.answer_rephraser.lookup(polisher_inputs)
+        if cached is not None:
+            return cached
+
+        routed = self.answer_rephraser.module
+        models = route_for(routed.stage).models
+        polished = None
+        for attempt, model in enumerate(models, 1):
+            if attempt > 1:  # Start the reply over with the next model's answer
+                response_stream.reset()
+            polished, accepted = await routed.attempt(
+                model,
+                attempt,
+                attempt == len(models),
+                lambda: self._stream_attempt(routed.module, polisher_inputs, response_stream),
+            )
+            if accepted:
+                break
+
+        assert polished is not None
+        self.answer_rephraser.store(key, polished)
+        return polished
+
+    async def _stream_attempt(
+        self, module: dspy.Module, inputs: dict, response_stream: ResponseStream
+    ) -> dspy.Prediction:
+        # A listener follows a single answer, each attempt streams through its own
+        listener = dspy.streaming.StreamListener(signature_field_name="response")
+        # As an async program it runs aforward, the sync path would bypass the schedulers
+        streaming = dspy.streamify(module, stream_listeners=[listener], is_async_program=True)
+
+        pred = None
+        try:
+            async for item in streaming(**inputs):
+                if isinstance(item, dspy.streaming.StreamResponse):
+                    await response_stream.push(item.chunk)
+                elif isinstance(item, dspy.Prediction):
+                    pred = item
+        except ExceptionGroup as group:
+            # streamify runs the module in a task group, the cascade expects the parse error itself
+            if len(group.exceptions) == 1:
+                raise group.exceptions[0]
+            raise
+        assert pred is not None
+        return pred
+
+    async def ingest(self, job: IngestJob, queue: IngestionQueue) -> str:
+        """Summarise, store, index and schedule a data dump. Every stage is checkpointed on the job so a
+        retry resumes after the last completed stage.
+        Returns:
+            The reply to send to the user once the data dump has been stored.
+        """
+        payload = job.payload
+        current_category.set("ingest")
+
+        with llm_priority(Priority.BACKGROUND):
+            for stage in STAGES[STAGES.index(job.stage) :]:
+                match stage:
+                    case "summarise" if "summary" not in payload:
+                        content, imgs, _, _ = self.db.get_message_by_id(job.msg_id)
+                        pred = await self.dump_summarizer.acall(
+                            context_txt=content, context_img=imgs
+                        )
+                        payload["summary"] = pred.summary
+                        payload["event_prompt"] = pred.set_event_reminder
+                        payload["has_img"] = bool(imgs)
+
+                        if not payload.get("message_embedded"):
+                            await self.embed_store.insert_message_embedding(
+                                content=content or pred.summary,
+                                user_id=job.user_id,
+                                is_llm=False,
+                                msg_id=job.msg_id,
+                            )
+                            payload["message_embedded"] = True
+
+                    case "store":
+                        # insert_info is keyed on msg_id, a retried job picks up the row it already wrote
+                        info_id = self.db.get_info_by_message(job.msg_id)
+                        if info_id is None:
+                            info_id = self.db.insert_info(
+                                payload["summary"], job.msg_id, str(job.user_id)
+                            )
+                        payload["info_id"] = info_id
+
+                    case "index":
+                        info_id = payload["info_id"]
+                        cluster_id = self.db.get_info_cluster(info_id)
+                        if cluster_id is None:
+                            cluster_id = await self.knowledge_index.add(
+                                info_id, payload["summary"], job.user_id
+                            )
+                        await self.embed_store.insert_info_embedding(
+                            summary=payload["summary"],
+                            user_id=job.user_id,
+                            info_id=info_id,
+                            msg_id=job.msg_id,
+                            has_img=payload.get("has_img", False),
+                            cluster_id=cluster_id,
+                        )
+
+                    case "schedule" if payload.get("event_prompt"):
+                        _, imgs, _, _ = self.db.get_message_by_id(job.msg_id)
+                        scheduled_pred = await self.schedule_agent(job.user_id, job.msg_id).acall(
+                            user_id=job.user_id,
+                            content_txt=payload["event_prompt"],
+                            content_img=imgs,
+                        )
+                        record_react_iterations("ScheduleAgent", scheduled_pred)
+                        payload["reminder_response"] = scheduled_pred.response
+
+                queue.checkpoint(job, STAGES[STAGES.index(stage) + 1])
+                if job.stage == "done":
+                    break
+
+        return self.response_policy.format_locally(
+            ProposedResponse(
+                category=QueryCategory.INFORMATION,
+                answer=payload["summary"],
+                stored_info=True,
+                reminder_response=payload.get("reminder_response"),
+            )
+        ).response
@@ -0,0 +1,276 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from enum import IntEnum
+from os import getenv
+from typing import Optional
+
+import dspy
+import litellm
+
+from src.metrics import record_llm_usage
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # Replies a user is waiting on
+    BACKGROUND = 1  # Summarisation, indexing and other deferred work
+
+
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "llm_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def llm_priority(priority: Priority):
+    """Run every LLM call made inside the block with the given priority class."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class RequestScheduler:
+    """Client side admission control for a single provider model.
+
+    Requests are admitted in priority order while they fit in the requests/tokens per minute budgets and
+    the current concurrency limit. The limit follows AIMD: it grows by roughly one per window of successful
+    calls and is halved whenever the provider answers with a 429 (or shrinks a little when latency goes over
+    target).
+    """
+
+    def __init__(
+        self,
+        rpm: int = 0,
+        tpm: int = 0,
+        initial_limit: int = 4,
+        max_limit: int = 32,
+        latency_target: float = 30.0,
+    ) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.limit = float(initial_limit)
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+
+        self.in_flight = 0
+        self.throttled = 0
+        self.backoff_until = 0.0
+        self.waiters: list[tuple[int, int, int, asyncio.Future]] = []
+        self.window: deque[list] = deque()  # [timestamp, tokens, in window] per admitted request
+        self.window_tokens = 0
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rpm=int(getenv("GEMINI_RPM") or 0),
+            tpm=int(getenv("GEMINI_TPM") or 0),
+            max_limit=int(getenv("LLM_MAX_CONCURRENCY") or 32),
+            latency_target=float(getenv("LLM_LATENCY_TARGET") or 30.0),
+        )
+
+    async def acquire(self, est_tokens: int) -> list:
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (_priority.get(), next(self._seq), est_tokens, fut))
+        self._dispatch()
+
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():  # Slot was granted right as we got cancelled
+                self.release(fut.result(), 0, time.monotonic())
+            raise
+
+    def release(
+        self,
+        ticket: list,
+        used_tokens: Optional[int],
+        started: float,
+        throttled: bool = False,
+        retry_after: float = 0,
+    ):
+        now = time.monotonic()
+        self.in_flight -= 1
+
+        if used_tokens is not None:
+            # Calls slower than the window already had their estimate expired, correcting it would drift the total
+            if ticket[2]:
+                self.window_tokens += used_tokens - ticket[1]
+            ticket[1] = used_tokens
+
+        if throttled:
+            self.throttled += 1
+            self.limit = max(1.0, self.limit / 2)
+            self.backoff_until = max(self.backoff_until, now + retry_after)
+            logging.warning(
+                f"LLM provider throttled us, concurrency limit lowered to {int(self.limit)}"
+            )
+        elif now - started > self.latency_target:
+            self.limit = max(1.0, self.limit * 0.9)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+        self._dispatch()
+
+    def _expire(self, now: float):
+        while self.window and now - self.window[0][0] >= 60:
+            ticket = self.window.popleft()
+            ticket[2] = False
+            self.window_tokens -= ticket[1]
+
+    def _budget_delay(self, now: float, est_tokens: int) -> float:
+        if self.backoff_until > now:
+            return self.backoff_until - now
+        if not self.window:
+            return 0
+        if self.rpm and len(self.window) >= self.rpm:
+            return self.window[0][0] + 60 - now
+        if self.tpm and self.window_tokens + est_tokens > self.tpm:
+            return self.window[0][0] + 60 - now
+        return 0
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self._expire(now)
+
+        while self.waiters:
+            _, _, est_tokens, fut = self.waiters[0]
+            if fut.done():
+                heapq.heappop(self.waiters)
+                continue
+            if self.in_flight >= int(self.limit):
+                return
+            if (delay := self._budget_delay(now, est_tokens)) > 0:
+                self._schedule_wakeup(delay)
+                return
+
+            heapq.heappop(self.waiters)
+            ticket = [now, est_tokens, True]
+            self.window.append(ticket)
+            self.window_tokens += est_tokens
+            self.in_flight += 1
+            fut.set_result(ticket)
+
+    def _schedule_wakeup(self, delay: float):
+        if self._wakeup is not None and not self._wakeup.cancelled():
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": sum(1 for *_, fut in self.waiters if not fut.done()),
+            "requests_last_min": len(self.window),
+            "tokens_last_min": self.window_tokens,
+            "throttled": self.throttled,
+        }
+
+
+def estimate_tokens(prompt: Optional[str], messages: Optional[list[dict]]) -> int:
+    """Rough pre-flight token estimate (~4 chars per token, flat cost per image)."""
+    chars = len(prompt or "")
+    images = 0
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text") or "")
+    return chars // 4 + images * 258
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Full jitter exponential backoff."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def _retry_after(exc: Exception) -> float:
+    response = getattr(exc, "response", None)
+    try:
+        return float(response.headers.get("retry-after", 0))  # type: ignore
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+RETRYABLE_ERRORS = (
+    litellm.Timeout,
+    litellm.APIConnectionError,
+    litellm.InternalServerError,
+    litellm.ServiceUnavailableError,
+)
+
+
+class RateLimitedLM(dspy.LM):
+    """dspy.LM which routes every async completion through a RequestScheduler and retries 429s and transient
+    provider errors with jittered backoff. LiteLLM's own retries are disabled so they don't bypass the budgets.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        scheduler: Optional[RequestScheduler] = None,
+        max_attempts: int = 5,
+        **kwargs,
+    ):
+        kwargs.setdefault("num_retries", 0)
+        super().__init__(model, **kwargs)
+        self.scheduler = scheduler or RequestScheduler.from_env()
+        self.max_attempts = max_attempts
+
+    async def aforward(self, prompt=None, messages=None, **kwargs):
+        est_tokens = estimate_tokens(prompt, messages)
+
+        for attempt in range(1, self.max_attempts + 1):
+            ticket = await self.scheduler.acquire(est_tokens)
+            started = time.monotonic()
+            try:
+                response = await super().aforward(
+                    prompt=prompt, messages=messages, **kwargs
+                )
+            except litellm.RateLimitError as e:
+                self.scheduler.release(
+                    ticket, None, started, throttled=True, retry_after=_retry_after(e)
+                )
+                if attempt == self.max_attempts:
+                    raise
+            except RETRYABLE_ERRORS as e:
+                self.scheduler.release(ticket, None, started)
+                if attempt == self.max_attempts:
+                    raise
+                logging.warning(f"Transient LLM error (attempt {attempt}): {e}")
+            except BaseException:
+                self.scheduler.release(ticket, None, started)
+                raise
+            else:
+                usage = getattr(response, "usage", None)
+                record_llm_usage(self.model, usage)
+                self.scheduler.release(
+                    ticket, getattr(usage, "total_tokens", None), started
+                )
+                return response
+
+            await asyncio.sleep(backoff_delay(attempt))
+
+    def forward(self, prompt=None, messages=None, **kwargs):
+        # Sync calls are not used by the bot itself, they only get the retry shaping.
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return super().forward(prompt=prompt, messages=messages, **kwargs)
+            except (litellm.RateLimitError, *RETRYABLE_ERRORS):
+                if attempt == self.max_attempts:
+                    raise
+                time.sleep(backoff_delay(attempt))
@@ -0,0 +1,76 @@
+import html
+from dataclasses import dataclass, field
+from typing import Optional
+
+import dspy
+
+from llm.signatures import QueryCategory
+
+
+FALLBACK_ANSWER = "I'm sorry, but I couldn't understand your request."
+
+
+@dataclass
+class ProposedResponse:
+    """Outcome of the agent stages, before anything is sent to the user."""
+
+    category: QueryCategory
+    answer: str
+    document_ids: list[str] = field(default_factory=list)
+    is_hard_retrieval: bool = False
+    output_doc: Optional[str] = None  # File name of a generated document
+    stored_info: bool = False  # The message was a data dump saved to the info store
+    queued_ingest: bool = False  # The message was a data dump handed to the ingestion workers
+    reminder_response: Optional[str] = None
+
+
+class ResponsePolicy:
+    """Decides whether a proposed answer has to go through ResponsePolisher.
+
+    Structured outcomes (fallbacks, generated documents, hard retrievals, saved notes and reminders) are
+    rendered locally, only free form answers and casual conversation are sent back to the LLM.
+    """
+
+    def needs_polish(self, proposed: ProposedResponse) -> bool:
+        if (
+            proposed.output_doc
+            or proposed.is_hard_retrieval
+            or proposed.stored_info
+            or proposed.queued_ingest
+        ):
+            return False
+
+        match proposed.category:
+            case QueryCategory.CASUAL:
+                return True
+            case QueryCategory.INFORMATION:
+                return bool(proposed.answer)
+            case _:  # SCHEDULE replies come from the agent already phrased, OTHER gets the fallback
+                return False
+
+    def format_locally(self, proposed: ProposedResponse) -> dspy.Prediction:
+        if proposed.output_doc:
+            response = f"📄 Your document <b>{html.escape(proposed.output_doc)}</b> has been generated."
+        elif proposed.is_hard_retrieval and proposed.document_ids:
+            count = len(proposed.document_ids)
+            response = f"🔶 Found {count} document{'s' if count > 1 else ''}, sending {'them' if count > 1 else 'it'} now."
+        elif proposed.queued_ingest:
+            response = "📥 Got it! Filing this away, I'll let you know once it's saved."
+        elif proposed.stored_info:
+            response = f"✅ Saved to your notes:\n{html.escape(proposed.answer)}"
+        elif proposed.category is QueryCategory.SCHEDULE:
+            response = html.escape(proposed.answer)
+        else:
+            response = html.escape(proposed.answer or FALLBACK_ANSWER)
+
+        if proposed.reminder_response:
+            response += f"\n\n⏰ {html.escape(proposed.reminder_response)}"
+
+        return self.finalize(dspy.Prediction(response=response), proposed)
+
+    def finalize(self, pred: dspy.Prediction, proposed: ProposedResponse) -> dspy.Prediction:
+        # Delivery decisions come from the pipeline itself, never from the rephrased text.
+        pred.output_doc = proposed.output_doc
+        pred.document_ids_o = proposed.document_ids
+        pred.is_hard_retrieval_o = proposed.is_hard_retrieval
+        return pred
@@ -0,0 +1,203 @@
+import json
+import logging
+import time
+import typing
+from dataclasses import dataclass
+from os import getenv
+
+import dspy
+from dspy.utils.exceptions import AdapterParseError
+
+from llm.multiplexer import RateLimitedLM, RequestScheduler
+from llm.signatures import QueryCategory
+from llm.tool_adapter import fresh_trajectory_budget
+from src.metrics import current_category, span
+
+FLASH = "gemini/gemini-2.5-flash"
+FLASH_LITE = "gemini/gemini-2.5-flash-lite"
+
+route_logger = logging.getLogger("sahoo.routing")
+
+
+@dataclass(frozen=True)
+class Route:
+    """Models tried in order for a stage, the last one is the strongest and its answer is always accepted."""
+
+    models: tuple[str, ...]
+    max_tokens: int
+
+
+# max_tokens includes the thinking budget on the 2.5 models
+ROUTES = {
+    "ClassifyQuery": Route((FLASH_LITE, FLASH), 1000),
+    "Analyzer": Route((FLASH,), 2000),
+    "InfoAgent": Route((FLASH,), 4000),
+    "ScheduleAgent": Route((FLASH_LITE, FLASH), 2000),
+    "DocumentGenerator": Route((FLASH,), 8000),
+    "ResponsePolisher": Route((FLASH_LITE, FLASH), 2000),
+    "DataDumpSummary": Route((FLASH,), 2000),
+    "TopicSummary": Route((FLASH_LITE, FLASH), 1000),
+}
+
+
+def route_for(stage: str) -> Route:
+    """ROUTES with env overrides, e.g. LLM_ROUTE_CLASSIFYQUERY=gemini/gemini-2.5-flash and
+    LLM_MAX_TOKENS_CLASSIFYQUERY=500. LLM_CASCADE=0 sends every stage straight to its strongest model.
+    """
+    route = ROUTES.get(stage, Route((FLASH,), 8000))
+    models = tuple(
+        m.strip() for m in (getenv(f"LLM_ROUTE_{stage.upper()}") or "").split(",") if m.strip()
+    ) or route.models
+    if getenv("LLM_CASCADE") == "0":
+        models = models[-1:]
+    return Route(models, int(getenv(f"LLM_MAX_TOKENS_{stage.upper()}") or route.max_tokens))
+
+
+_schedulers: dict[str, RequestScheduler] = {}
+_lms: dict[tuple[str, int], dspy.LM] = {}
+
+
+def _rate_limited_lm(model: str, max_tokens: int) -> dspy.LM:
+    # Provider limits are per model, so LMs of the same model share a scheduler whatever their token cap
+    scheduler = _schedulers.setdefault(model, RequestScheduler.from_env())
+    return RateLimitedLM(
+        model, scheduler=scheduler, api_key=getenv("GEMINI_KEY"), max_tokens=max_tokens
+    )
+
+
+# Replaced by the benchmark harness to route to its fake LM
+lm_factory: typing.Callable[[str, int], dspy.LM] = _rate_limited_lm
+
+
+def get_lm(model: str, max_tokens: int) -> dspy.LM:
+    if (lm := _lms.get((model, max_tokens))) is None:
+        lm = _lms[(model, max_tokens)] = lm_factory(model, max_tokens)
+    return lm
+
+
+def scheduler_stats() -> dict[str, float]:
+    return {
+        f"{model}.{name}": value
+        for model, scheduler in _schedulers.items()
+        for name, value in scheduler.stats().items()
+    }
+
+
+# Validators return why an answer should be escalated, or None to accept it
+
+
+def validate_classification(pred: dspy.Prediction) -> typing.Optional[str]:
+    if pred.category is QueryCategory.OTHER:
+        return "category OTHER"
+    if (pred.get("confidence") or 0) < float(getenv("LLM_CASCADE_MIN_CONFIDENCE") or 0.7):
+        return f"confidence {pred.get('confidence')}"
+    return None
+
+
+def validate_response(pred: dspy.Prediction) -> typing.Optional[str]:
+    if not (pred.get("response") or "").strip():
+        return "empty response"
+    return None
+
+
+def validate_schedule(pred: dspy.Prediction) -> typing.Optional[str]:
+    # Rerunning after a reminder was stored would store it twice
+    trajectory = pred.get("trajectory") or {}
+    if any(tool == "insert_reminder" for key, tool in trajectory.items() if key.startswith("tool_name_")):
+        return None
+    return validate_response(pred)
+
+
+def validate_summary(pred: dspy.Prediction) -> typing.Optional[str]:
+    if not (pred.get("updated_summary") or "").strip():
+        return "empty summary"
+    return None
+
+
+class RoutedModule(dspy.Module):
+    """Runs a module on its stage's route. On a cascade each model is tried in turn until one gives an answer
+    which parses and passes `validate`. Every attempt is logged as a JSON line on the sahoo.routing logger.
+    """
+
+    def __init__(
+        self,
+        module: dspy.Module,
+        stage: str,
+        validate: typing.Optional[typing.Callable[[dspy.Prediction], typing.Optional[str]]] = None,
+    ):
+        super().__init__()
+        self.module = module
+        self.stage = stage
+        self.validate = validate
+
+    def _log(
+        self,
+        model: str,
+        attempt: int,
+        started: float,
+        accepted: bool,
+        reason: typing.Optional[str],
+        pred: typing.Optional[dspy.Prediction],
+    ):
+        outputs = {}
+        if pred is not None:
+            outputs = {
+                k: str(getattr(v, "value", v))[:200] for k, v in pred.items() if k != "trajectory"
+            }
+        route_logger.info(
+            json.dumps(
+                {
+                    "stage": self.stage,
+                    "model": model,
+                    "attempt": attempt,
+                    "accepted": accepted,
+                    "reason": reason,
+                    "ms": round((time.perf_counter() - started) * 1000),
+                    "category": current_category.get(),
+                    "outputs": outputs,
+                }
+            )
+        )
+
+    async def attempt(
+        self,
+        model: str,
+        attempt: int,
+        last: bool,
+        call: typing.Callable[[], typing.Awaitable[dspy.Prediction]],
+    ) -> tuple[typing.Optional[dspy.Prediction], bool]:
+        """Runs one step of the cascade, `call` runs the module with `model` as the configured LM.
+        Returns:
+            The prediction and whether it was accepted. The last model's answer is always accepted.
+        """
+        started = time.perf_counter()
+        pred = None
+        # Each attempt is a separate trajectory, the next model can't see what the previous one was shown
+        with span("llm.route", signature=self.stage, model=model), fresh_trajectory_budget():
+            with dspy.context(lm=get_lm(model, route_for(self.stage).max_tokens)):
+                try:
+                    pred = await call()
+                    rejected = self.validate(pred) if self.validate else None
+                except (AdapterParseError, ValueError) as e:
+                    if last:
+                        raise
+                    rejected = f"{type(e).__name__}: {str(e)[:200]}"
+
+        accepted = rejected is None or last
+        self._log(model, attempt, started, accepted, rejected, pred)
+        return pred, accepted
+
+    async def aforward(self, **kwargs):
+        models = route_for(self.stage).models
+        for attempt, model in enumerate(models, 1):
+            pred, accepted = await self.attempt(
+                model, attempt, attempt == len(models), lambda: self.module.acall(**kwargs)
+            )
+            if accepted:
+                return pred
+
+    def forward(self, **kwargs):
+        # Sync calls aren't used by the bot, they only get the strongest model of the route
+        route = route_for(self.stage)
+        with dspy.context(lm=get_lm(route.models[-1], route.max_tokens)):
+            return self.module(**kwargs)
@@ -50,8 +50,18 @@ class ClassifyQuery(dspy.Signature):
     user_images: Optional[list[dspy.Image]] = dspy.InputField(
         desc="A set of pictures the user had sent"
     )
+    reply_context: Optional[str] = dspy.InputField(
+        desc="The earlier message the user is replying to (msg_id, sender and an excerpt), if any"
+    )
 
     category: QueryCategory = dspy.OutputField()
+    is_data_dump: bool = dspy.OutputField(
+        desc="True if the message only provides new information to be stored (notes, forwarded content, images with "
+        "no question) and does not ask for anything."
+    )
+    confidence: float = dspy.OutputField(
+        desc="How sure you are of the category, from 0.0 to 1.0"
+    )
 
 
 class InfoAgent(dspy.Signature):
@@ -78,6 +88,9 @@ class InfoAgent(dspy.Signature):
     - Tools which fetch information from wikipedia shall only be used if the information and message store do not yield
         relevant data. Make sure to always cite the resources used.
 
+    - If the user is replying to an earlier message, 'reply_context' already holds its msg_id and an excerpt. Use it
+        directly and only fetch the full message with the msg_id when the excerpt is not enough.
+
     - IF THE USER IS ASKING TO GENERATE A DOCUMENT, YOU SHALL GENERATE CONTENT WHICH WILL BE USED AS THE SOURCE FOR THE FINAL
         DOCUMENT THAT'LL BE GENERATED BY ANOTHER AGENT.
     """
@@ -85,6 +98,9 @@ class InfoAgent(dspy.Signature):
     context_txt: Optional[str] = dspy.InputField()
     context_img: Optional[list[dspy.Image]] = dspy.InputField()
     user_id: str = dspy.InputField()
+    reply_context: Optional[str] = dspy.InputField(
+        desc="The earlier message the user is replying to (msg_id, sender and an excerpt), if any"
+    )
     history: dspy.History = dspy.InputField()
 
     response: Optional[str] = dspy.OutputField()
@@ -104,6 +120,9 @@ class ScheduleAgent(dspy.Signature):
     user_id: str = dspy.InputField()
     content_txt: Optional[str] = dspy.InputField()
     content_img: Optional[list[dspy.Image]] = dspy.InputField()
+    reply_context: Optional[str] = dspy.InputField(
+        desc="The earlier message the user is replying to (msg_id, sender and an excerpt), if any"
+    )
     response: str = dspy.OutputField()
 
 
@@ -174,3 +193,27 @@ class Analyzer(dspy.Signature):
         desc="The text which was provided with image."
     )
     summary: str = dspy.OutputField(desc="The extracted information in concise form.")
+
+
+class TopicSummary(dspy.Signature):
+    """Maintain the summary of one topic in a user's knowledge base. Merge the new information into the existing
+    summary so the summary describes everything filed under the topic. Keep it under 120 words, keep names, dates and
+    numbers, and drop details which are already covered.
+    """
+
+    topic_summary: str = dspy.InputField()
+    new_info: str = dspy.InputField()
+    updated_summary: str = dspy.OutputField()
+
+
+class DataDumpSummary(dspy.Signature):
+    """The user has sent new information to be stored. Summarize it concisely while keeping every piece of data and
+    instruction it contains. If it also has details regarding an event, extract the event details as a prompt to a
+    scheduling agent in 'set_event_reminder', otherwise leave it empty.
+    """
+
+    context_txt: Optional[str] = dspy.InputField()
+    context_img: Optional[list[dspy.Image]] = dspy.InputField()
+
+    summary: str = dspy.OutputField()
+    set_event_reminder: str = dspy.OutputField()
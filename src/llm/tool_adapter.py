@@ -0,0 +1,214 @@
+import contextvars
+import inspect
+import json
+import typing
+from contextlib import contextmanager
+from datetime import datetime
+from enum import Enum
+
+import dspy
+
+from db import DBConn, DocType
+from llm.signatures import QueryCategory
+
+
+BUDGET_SPENT = (
+    "The tool budget for this request is used up. Call finish now and answer with what you already have."
+)
+
+# ReAct iterations per query category. Replies already carry the message they refer to, so they get fewer.
+MAX_ITERS = {
+    QueryCategory.INFORMATION: 5,
+    QueryCategory.ASSIGNMENT_GENERATION: 8,
+    QueryCategory.SCHEDULE: 4,
+}
+
+
+def max_iters_for(category: QueryCategory, has_reply_context: bool = False) -> int:
+    return max(2, MAX_ITERS.get(category, 5) - (2 if has_reply_context else 0))
+
+
+class TrajectoryBudget:
+    """Observation tokens spent and results already shown during one ReAct run."""
+
+    def __init__(self, max_tokens: int) -> None:
+        self.max_tokens = max_tokens
+        self.used = 0
+        self.observations = 0  # Every tool response counts, pointers and refusals included
+        self.calls: dict[str, int] = {}  # Tool call -> observation number which answered it
+        self.seen: set[str] = set()
+
+    @property
+    def spent(self) -> bool:
+        return self.used >= self.max_tokens
+
+    def observe(self) -> int:
+        """Returns the number of the observation being answered now."""
+        self.observations += 1
+        return self.observations - 1
+
+    def record(self, call: str, step: int, text: str):
+        self.calls[call] = step
+        self.used += len(text) // 4
+
+
+_budget: contextvars.ContextVar[typing.Optional[TrajectoryBudget]] = contextvars.ContextVar(
+    "trajectory_budget", default=None
+)
+
+
+@contextmanager
+def trajectory_budget(max_tokens: int = 3000):
+    """Share one TrajectoryBudget between every compact tool called inside the block."""
+    token = _budget.set(TrajectoryBudget(max_tokens))
+    try:
+        yield _budget.get()
+    finally:
+        _budget.reset(token)
+
+
+@contextmanager
+def fresh_trajectory_budget():
+    """Inside a trajectory_budget block, start over with an empty budget of the same size, e.g. when a cascade
+    reruns an agent on another model. Does nothing outside of one.
+    """
+    current = _budget.get()
+    if current is None:
+        yield None
+        return
+
+    token = _budget.set(TrajectoryBudget(current.max_tokens))
+    try:
+        yield _budget.get()
+    finally:
+        _budget.reset(token)
+
+
+def _plain(value: typing.Any) -> typing.Any:
+    """Turn a tool result into small JSON friendly values, binary data is replaced by a marker."""
+    match value:
+        case dspy.Image():
+            return "<image>"
+        case bytes():
+            return f"<{len(value)} bytes>"
+        case float():
+            return round(value, 3)
+        case Enum():
+            return value.value
+        case datetime():
+            return value.isoformat(sep=" ", timespec="minutes")
+        case dict():
+            return {str(k): _plain(v) for k, v in value.items()}
+        case list() | tuple():
+            return [_plain(v) for v in value]
+        case _:
+            return value
+
+
+def _dedupe(value: typing.Any, seen: set[str]) -> tuple[typing.Any, int]:
+    """Drop list items (at the top level or one dict level down) that an earlier observation already showed."""
+    if isinstance(value, dict):
+        dropped = 0
+        for key, item in value.items():
+            value[key], count = _dedupe(item, seen) if isinstance(item, list) else (item, 0)
+            dropped += count
+        return value, dropped
+    if not isinstance(value, list):
+        return value, 0
+
+    kept = []
+    for item in value:
+        key = json.dumps(item, sort_keys=True, default=str)
+        if key not in seen:
+            seen.add(key)
+            kept.append(item)
+    return kept, len(value) - len(kept)
+
+
+def encode(result: typing.Any, max_chars: int, seen: typing.Optional[set[str]] = None) -> str:
+    if result is None or result == [] or result == {}:
+        return "No results."
+    if isinstance(result, str):
+        text = result
+    else:
+        value, dropped = _dedupe(_plain(result), seen if seen is not None else set())
+        text = json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+        if dropped:
+            text += f" ({dropped} item(s) already shown in earlier observations omitted)"
+
+    if len(text) > max_chars:
+        text = text[:max_chars] + f"… [truncated {len(text) - max_chars} chars]"
+    return text
+
+
+def compact_tool(
+    tool: typing.Callable | dspy.Tool,
+    max_chars: int = 1500,
+    raw_when: typing.Optional[typing.Callable[[dict], bool]] = None,
+) -> dspy.Tool:
+    """Wrap a ReAct tool so it returns compact, truncated text and respects the current TrajectoryBudget.
+    Repeating an earlier call returns a pointer to that observation instead of the same result again. Calls
+    for which `raw_when(kwargs)` is true get the tool's result as is.
+    """
+    inner = tool if isinstance(tool, dspy.Tool) else dspy.Tool(tool)
+
+    async def call(**kwargs):
+        budget = _budget.get()
+        key = f"{inner.name}:{json.dumps(kwargs, sort_keys=True, default=str)}"
+        step = 0
+        if budget is not None:
+            step = budget.observe()
+            if budget.spent:
+                return BUDGET_SPENT
+            if (earlier := budget.calls.get(key)) is not None:
+                return f"Same call as observation {earlier}, its result is above. Use it or call finish."
+
+        # kwargs were already parsed against the same args by the wrapping tool, validating them again would
+        # reject parsed values, e.g. a datetime where the schema expects its string
+        result = inner.func(**kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        if raw_when is not None and raw_when(kwargs):
+            if budget is not None:
+                budget.record(key, step, "")
+            return result
+
+        text = encode(result, max_chars, budget.seen if budget is not None else None)
+        if budget is not None:
+            budget.record(key, step, text)
+        return text
+
+    return dspy.Tool(
+        call,
+        name=inner.name,
+        desc=inner.desc,
+        args=inner.args,
+        arg_types=inner.arg_types,
+    )
+
+
+def message_lookup(db: DBConn) -> typing.Callable:
+    """get_message_by_id for the agents, images are only loaded and sent when asked for."""
+
+    def get_message_by_id(message_id: int, include_images: bool = False):
+        """Fetch a stored message by its msg_id.
+        Returns:
+            The message content, its type and whether it has images. Set include_images to True only when you
+            need to look at the images themselves.
+        """
+        if include_images:
+            content, images, _, _ = db.get_message_by_id(message_id)
+            return [content, *(images or [])]
+
+        meta = db.get_messages_meta([message_id])
+        if message_id not in meta:
+            return f"No message with msg_id {message_id}."
+        content, _, doc_type, has_images = meta[message_id]
+        return {
+            "msg_id": message_id,
+            "type": DocType(doc_type).name.lower() if doc_type else "text",
+            "content": content,
+            "has_images": bool(has_images),
+        }
+
+    return get_message_by_id
@@ -1,26 +1,32 @@
+import asyncio
 import base64
 import logging
 from os import getenv
 import dspy
 import pathlib
 
-from chromadb import AsyncHttpClient as ChromaClient
-from chromadb.api import AsyncClientAPI
-from typing import Optional
+from typing import Any, Callable, Optional, TYPE_CHECKING
 from contextlib import AsyncExitStack
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from markdown_pdf import MarkdownPdf, Section
+
+from src.metrics import instrument_methods
+
+# chromadb, mcp and markdown_pdf are slow to import, they are only loaded once the feature is used
+if TYPE_CHECKING:
+    from chromadb.api import AsyncClientAPI
+    from mcp import ClientSession
 
 
 class McpClient:
     def __init__(self):
-        self.session: Optional[ClientSession] = None
+        self.session: Optional["ClientSession"] = None
         self.exit_stack = AsyncExitStack()
         self.tools = []
 
     @classmethod
     async def create(cls, command: str, args: list[str], env: dict[str, str]):
+        from mcp import ClientSession, StdioServerParameters
+        from mcp.client.stdio import stdio_client
+
         self = McpClient()
 
         server_params = StdioServerParameters(command=command, args=args, env=env)
@@ -41,6 +47,8 @@ class McpClient:
 
 
 def create_pdf(file_name: str, sections: list[str], css: str):
+    from markdown_pdf import MarkdownPdf, Section
+
     doc = MarkdownPdf(toc_level=2, optimize=True)
     for section in sections:
         # section = "\n".join(sections)
@@ -53,11 +61,17 @@ def create_pdf(file_name: str, sections: list[str], css: str):
     return file_path
 
 
+@instrument_methods("chroma")
 class EmbeddingStore:
-    client: AsyncClientAPI
+    client: "AsyncClientAPI"
+    # Embeds queries once for every collection, without one chromadb embeds the query again for each `query`
+    embedding_function: Optional[Callable[[list[str]], list[Any]]] = None
 
     @classmethod
     async def create(cls):
+        from chromadb import AsyncHttpClient as ChromaClient
+        from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+
         self = EmbeddingStore()
         ssl = False
         headers = {}
@@ -80,29 +94,83 @@ class EmbeddingStore:
             await self.client.get_or_create_collection(
                 name="bot-msgstore", configuration={"hnsw": {"space": "cosine"}}
             )
+            await self.client.get_or_create_collection(
+                name="bot-clusterstore", configuration={"hnsw": {"space": "cosine"}}
+            )
         except Exception as e:
             logging.exception(f"Error setting up Chroma collections: {e}")
 
+        # Same model the collections were created with, so query embeddings stay comparable
+        self.embedding_function = DefaultEmbeddingFunction()
         return self
 
     async def insert_info_embedding(
-        self, summary: str, user_id: int, info_id: int, msg_id: int, has_img: bool
+        self,
+        summary: str,
+        user_id: int,
+        info_id: int,
+        msg_id: int,
+        has_img: bool,
+        cluster_id: Optional[int] = None,
     ):
         collection = await self.client.get_collection(name="bot-infostore")
         logging.info(f"Inserting embedding for info_id: {info_id}")
 
+        metadata = {
+            "user_id": user_id,
+            "info_id": info_id,
+            "msg_id": msg_id,
+            "has_img": has_img,
+        }
+        if cluster_id is not None:
+            metadata["cluster_id"] = cluster_id
+
         await collection.add(
             ids=[str(info_id)],
             documents=[summary],
-            metadatas=[
-                {
-                    "user_id": user_id,
-                    "info_id": info_id,
-                    "msg_id": msg_id,
-                    "has_img": has_img,
-                }
-            ],
+            metadatas=[metadata],
+        )
+
+    async def set_info_cluster(self, info_id: int, cluster_id: int):
+        collection = await self.client.get_collection(name="bot-infostore")
+        await collection.update(
+            ids=[str(info_id)], metadatas=[{"cluster_id": cluster_id}]
+        )
+
+    async def upsert_cluster_embedding(
+        self, summary: str, user_id: int, cluster_id: int
+    ):
+        collection = await self.client.get_collection(name="bot-clusterstore")
+        await collection.upsert(
+            ids=[str(cluster_id)],
+            documents=[summary],
+            metadatas=[{"user_id": user_id, "cluster_id": cluster_id}],
+        )
+
+    async def nearest_clusters(
+        self, query: str, user_id: int, n_results: int
+    ) -> list[tuple[int, float, str]]:
+        """Returns:
+        [(cluster_id, distance, summary)] sorted by distance.
+        """
+        collection = await self.client.get_collection(name="bot-clusterstore")
+        results = await collection.query(
+            query_texts=[query],
+            n_results=n_results,
+            include=["documents", "metadatas", "distances"],
+            where={"user_id": user_id},
         )
+        if not results["ids"] or not results["ids"][0]:
+            return []
+
+        return [
+            (meta["cluster_id"], dist, doc)
+            for meta, dist, doc in zip(
+                results["metadatas"][0],  # type: ignore
+                results["distances"][0],  # type: ignore
+                results["documents"][0],  # type: ignore
+            )
+        ]  # type: ignore
 
     async def insert_message_embedding(
         self, content: str, user_id: int, is_llm: bool, msg_id: int
@@ -116,56 +184,80 @@ class EmbeddingStore:
             metadatas=[{"user_id": user_id, "msg_id": msg_id, "is_llm": is_llm}],
         )
 
-    async def retrieve_relevant_info(self, query: str, user_id: int):
-        """Retrieve relevant information for a given query and user.
-        Returns:
-            [(msg_id, Distance, Document)]: The id points to the source of the information stored in the database
-                and Document is the summary of the information.
-        """
-        collection = await self.client.get_collection(name="bot-infostore")
-        logging.info(
-            f"Retrieving relevant info for user: {user_id} with query: {query}"
-        )
+    async def _query(
+        self, name: str, queries: dict, n_results: int, where: dict
+    ) -> list[tuple[int, dict, float, str]]:
+        """Run one batched query and flatten it to [(query index, metadata, distance, document)]."""
+        collection = await self.client.get_collection(name=name)
         results = await collection.query(
-            query_texts=[query],
-            n_results=10,
+            **queries,
+            n_results=n_results,
             include=["documents", "metadatas", "distances"],
-            where={"user_id": user_id},
+            where=where,
         )
+        return [
+            (idx, meta, dist, doc)
+            for idx, (metas, dists, docs) in enumerate(
+                zip(results["metadatas"] or [], results["distances"] or [], results["documents"] or [])  # type: ignore
+            )
+            for meta, dist, doc in zip(metas, dists, docs)
+        ]
 
-        if not results["ids"]:
-            return
-
-        data = sorted(
-            [
-                (meta["msg_id"], dist, res)
-                for meta, dist, res in zip(
-                    results["metadatas"][0],  # type: ignore
-                    results["distances"][0],  # type: ignore
-                    results["documents"][0],  # type: ignore
-                )
-            ],
-            key=lambda x: x[1],
+    async def search(
+        self, queries: list[str], user_id: int, n_results: int = 8, n_topics: int = 3
+    ) -> dict:
+        """Search topics, stored information and past messages in one go. The phrasings are embedded once and
+        sent as a single batched query to each collection. Topics and messages are queried concurrently, then
+        stored information only within the closest topics (all of it while the user has none yet).
+        Returns:
+            {"topics": [(cluster_id, distance, summary)], "results": [(msg_id, distance, source, document)]} with
+            results deduplicated by msg_id (closest hit wins) and sorted by distance.
+        """
+        if self.embedding_function is not None:
+            embeddings = await asyncio.to_thread(self.embedding_function, queries)
+            batch: dict = {"query_embeddings": embeddings}
+        else:
+            batch = {"query_texts": queries}
+
+        topics, messages = await asyncio.gather(
+            self._query("bot-clusterstore", batch, n_topics, {"user_id": user_id}),
+            self._query(
+                "bot-msgstore",
+                batch,
+                n_results,
+                {"$and": [{"user_id": user_id}, {"is_llm": False}]},
+            ),
         )
-        logging.info("Retrieved data from msg_ids: %s", [m_id[0] for m_id in data])  # noqa: F821
 
-        return data
+        best_topics: dict[int, tuple[int, float, str]] = {}
+        for _, meta, dist, doc in topics:
+            if meta["cluster_id"] not in best_topics or dist < best_topics[meta["cluster_id"]][1]:
+                best_topics[meta["cluster_id"]] = (meta["cluster_id"], dist, doc)
+        nearest = sorted(best_topics.values(), key=lambda x: x[1])[:n_topics]
 
-    async def retrieve_relevant_messages(self, query: str, user_id: str):
-        """Retrieve relevant past messages for a given query and user.
-        Returns:
-            [Document]: The past messages sent by the user.
-        """
+        info_where: dict = {"user_id": user_id}
+        if nearest:
+            info_where = {
+                "$and": [{"user_id": user_id}, {"cluster_id": {"$in": [c_id for c_id, _, _ in nearest]}}]
+            }
+        infos = await self._query("bot-infostore", batch, n_results, info_where)
+
+        best: dict[int, tuple[int, float, str, str]] = {}
+        for source, hits in (("info", infos), ("message", messages)):
+            for _, meta, dist, doc in hits:
+                msg_id = meta["msg_id"]
+                if msg_id not in best or dist < best[msg_id][1]:
+                    best[msg_id] = (msg_id, dist, source, doc)
+
+        logging.info(f"Search over {len(queries)} phrasings matched msg_ids: {list(best)}")
+        return {
+            "topics": nearest,
+            "results": sorted(best.values(), key=lambda x: x[1])[:n_results],
+        }
+
+    async def delete_message_embeddings(self, msg_ids: list[int]):
         collection = await self.client.get_collection(name="bot-msgstore")
-        results = await collection.query(
-            query_texts=[query],
-            n_results=10,
-            where={"user_id": user_id, "is_llm": False},
-        )
-        if not results["ids"]:
-            return
-        logging.info("Retrieved Messages: %s", results["documents"])  # noqa: F821
-        return [res for res in results["documents"]]  # type: ignore
+        await collection.delete(ids=[str(msg_id) for msg_id in msg_ids])
 
 
 def convert_image(file: bytes) -> dspy.Image:
@@ -2,40 +2,62 @@ import os
 import pathlib
 import sys
 import typing
+import pickle
+import random
 import asyncio
 import logging
+import importlib
+import multiprocessing
 from os import getenv
 from io import BytesIO
 from datetime import datetime
 from aiogram.types.message import Message
 from dotenv import load_dotenv
 
-from pdf2image import convert_from_bytes
-from aiogram.types import Document, BufferedInputFile, ErrorEvent
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Document, BufferedInputFile, ErrorEvent, Update
 from aiogram.handlers import MessageHandler
 from aiogram.enums import ParseMode
-from aiogram import F, Bot, Dispatcher
+from aiogram import F, Bot, Dispatcher, Router
 from aiogram.client.default import DefaultBotProperties
 
-from google.genai import types, Client
-
 from db import DBConn, DocType
-from llm.modules import UserSupportAgent
 from src import MediaGroupQueue, QueryStatusManager
-from src.llm.tools import EmbeddingStore, McpClient
+from src.admin import debug_routes, loop_lag, pipelines, router as admin_router
+from src.startup import Startup
+from src.streaming import TelegramReplyStream
+from src.ingest import IngestionQueue, IngestionWorker
+from src.retention import RetentionManager
+from src.media_cache import MediaCache
+from src.delivery import RetrievalDelivery
+from src.shared import (
+    LeaderLease,
+    SharedMediaGroupQueue,
+    SharedStatusRegistry,
+    UpdateQueue,
+)
+from src.metrics import (
+    TelegramMetricsMiddleware,
+    gauge_sources,
+    instrumented,
+    serve_metrics,
+)
 
 
 load_dotenv(".env")
 
 TOKEN = getenv("BOT_TOKEN")
-ADMIN = getenv("ADMIN")
 C_TOKEN = getenv("CHROMA_KEY")
 
 dp = Dispatcher()
+user_router = Router(name="user")
+# Admin commands are matched first, everything else goes to the agent
+dp.include_routers(admin_router, user_router)
 db_con = DBConn()
+retrieval_delivery = RetrievalDelivery(db_con)
 
 
-@dp.message()
+@user_router.message()
 class UserHandler(MessageHandler):
     def __init__(self, event: Message, **kwargs: typing.Any) -> None:
         self.chat_history = {}
@@ -47,61 +69,97 @@ class UserHandler(MessageHandler):
         else:
             raise AttributeError(f"{name} not found self.data")
 
+    async def service(self, name: str) -> typing.Any:
+        """Services passed in directly are used as is, otherwise wait for the subsystem to finish starting up."""
+        if item := self.data.get(name):
+            return item
+        return await self.startup.get(name)
+
+    def reply_context(self) -> typing.Optional[str]:
+        """Compact reference to the message being replied to, so the agent doesn't have to retrieve it."""
+        if (replied := self.event.reply_to_message) is None:
+            return None
+
+        if ref := db_con.get_reply_reference(replied.chat.id, replied.message_id):
+            ref_id, sender, excerpt, ref_type = ref
+            kind = f"{sender} {DocType(ref_type).name.lower()}" if ref_type else sender
+            return f"msg_id {ref_id} ({kind}): {excerpt or ''}"
+
+        # Sent before messages were indexed, Telegram includes the text in the update anyway
+        if excerpt := (replied.text or replied.caption):
+            return f"unindexed message: {excerpt[:300]}"
+        return None
+
+    @instrumented("handler.parse_document")
     async def parse_document(self, doc_meta: Document):
         file_id = doc_meta.file_id
-        document = await self.bot.download(doc_meta)
         images = []
 
-        assert document is not None
         assert doc_meta.file_name is not None
         assert doc_meta.mime_type is not None
 
         if doc_meta.mime_type == "application/pdf":
             # await status_manager.update_message("Preprocessing pdf document...")
-            pages = convert_from_bytes(document.read())
-            images = []
 
-            for page in pages:
-                img_byte_arr = BytesIO()
-                page.save(img_byte_arr, format="PNG")
-                img_byte_arr.seek(0)
-                images.append(img_byte_arr)
+            async def render_pages() -> bytes:
+                from pdf2image import convert_from_bytes
+
+                document = await self.media_cache.download(self.bot, doc_meta)
+                pages = []
+                for page in await asyncio.to_thread(convert_from_bytes, document.read()):
+                    img_byte_arr = BytesIO()
+                    page.save(img_byte_arr, format="PNG")
+                    pages.append(img_byte_arr.getvalue())
+                return pickle.dumps(pages)
+
+            pages = pickle.loads(
+                await self.media_cache.derived(doc_meta, "pages", render_pages)
+            )
+            images = [BytesIO(page) for page in pages]
 
             query = "The user has sent a PDF document. Please analyze the images extracted from the PDF."
 
         elif doc_meta.mime_type == "application/binary" and doc_meta.file_name.endswith(
             ".md"
         ):
+            document = await self.media_cache.download(self.bot, doc_meta)
             query = f"The user has a markdown file with following content: \n {document.read()}."
 
         elif doc_meta.mime_type.startswith("image"):
             query = f"The user has sent an image file named {doc_meta.file_name}. Please analyze the image."
-            images = [document]
+            images = [await self.media_cache.download(self.bot, doc_meta)]
         else:
             query = f"The given mime type is not supported. {doc_meta.mime_type}"
 
         return query, images, file_id
 
+    @instrumented("handler.parse_voice")
     async def parse_voice(self, m_voice):
         file_id = m_voice.file_id
-        voice = await self.bot.download(m_voice)
-        assert voice is not None
-
-        query = self.g_client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                "Generate a transcript of the speech in the language it was spoken in."
-                "Make sure to only respond with transcription, do not add filler sentences.",
-                types.Part.from_bytes(
-                    data=voice.read(),
-                    mime_type="audio/mp3",
-                ),
-            ],
-        ).text
+
+        async def transcribe() -> bytes:
+            from google.genai import types
+
+            voice = await self.media_cache.download(self.bot, m_voice)
+            g_client = await self.service("g_client")
+            return g_client.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=[
+                    "Generate a transcript of the speech in the language it was spoken in."
+                    "Make sure to only respond with transcription, do not add filler sentences.",
+                    types.Part.from_bytes(
+                        data=voice.read(),
+                        mime_type="audio/mp3",
+                    ),
+                ],
+            ).text.encode()
+
+        query = (await self.media_cache.derived(m_voice, "transcript", transcribe)).decode()
         query += "The above is a transcription of a voice message sent by the user."
         logging.info(f"Transcription: {query}")
         return query, file_id
 
+    @instrumented("handler.handle")
     async def handle(self) -> typing.Any:
         await self.chat.do(action="typing")
         grouped_msg = False
@@ -122,7 +180,7 @@ class UserHandler(MessageHandler):
 
             doc_type = DocType.PHOTO
             file_id = images[0].file_id
-            images = [await self.bot.download(images[-1])]
+            images = [await self.media_cache.download(self.bot, images[-1])]
 
             if (
                 not grouped_msg and self.event.media_group_id is not None
@@ -137,9 +195,9 @@ class UserHandler(MessageHandler):
                                 f"MG ID: {self.event.media_group_id} recieved a new photo"
                             )
                             images.append(
-                                await self.media_group_queue.work_queue[
+                                await self.media_group_queue.next_item(
                                     self.event.media_group_id
-                                ].get()
+                                )
                             )
                     except asyncio.TimeoutError:
                         logging.info(
@@ -176,48 +234,47 @@ class UserHandler(MessageHandler):
             return
 
         msg_id = db_con.insert_message("user", query, images, file_id, doc_type)  # type: ignore
-
-        reply_context = (
-            db_con.get_message_by_id(self.event.reply_to_message.message_id)
-            if self.event.reply_to_message
-            else None
-        )
-
-        answer = await self.user_agent.acall(
-            query=query,
-            images=images,
-            user_id=self.event.chat.id,
-            status_manager=status_manager,
-            msg_id=msg_id,
-            is_grouped_msg=grouped_msg,
-            chat_history=self.chat_history,
-        )
+        db_con.link_telegram_message(self.chat.id, self.event.message_id, msg_id)  # type: ignore
+
+        reply_stream = TelegramReplyStream(self.event)
+        user_agent = await self.service("user_agent")
+        with pipelines.track(self.event.chat.id, doc_type.name if doc_type else "TEXT"):
+            answer = await user_agent.acall(
+                query=query,
+                images=images,
+                user_id=self.event.chat.id,
+                status_manager=status_manager,
+                msg_id=msg_id,
+                is_grouped_msg=grouped_msg,
+                chat_history=self.chat_history,
+                response_stream=reply_stream,
+                reply_context=self.reply_context(),
+            )
+        chat_id = self.chat.id  # type: ignore
 
         if answer.document_ids_o and answer.is_hard_retrieval_o:
-            for doc_id in answer.document_ids_o:
-                (txt, _, file_id, doc_type) = db_con.get_message_by_id(doc_id)
-
-                if file_id is None:
-                    await self.event.reply(txt)  # type: ignore
-                    continue
-
-                match doc_type:
-                    case DocType.DOCUMENT:
-                        await self.event.reply_document(file_id, caption=txt)
-                    case DocType.PHOTO:
-                        await self.event.reply_photo(file_id, caption=txt)
-                    case DocType.VOICE:
-                        await self.event.reply_voice(file_id, caption=txt)
+            for sent, doc_id in await retrieval_delivery.deliver(
+                self.event, answer.document_ids_o
+            ):
+                # Replies to a re-sent document refer to the original message
+                db_con.link_telegram_message(chat_id, sent.message_id, doc_id)
         elif answer.output_doc:
             with open(
                 pathlib.Path.cwd() / "gen_docs" / answer.output_doc,
                 "rb",  # type: ignore
             ) as file:
-                await self.event.reply_document(
+                sent = await self.event.reply_document(
                     BufferedInputFile(file=file.read(), filename=answer.output_doc)
                 )
+            db_con.link_telegram_message(chat_id, sent.message_id, answer.msg_id)
+        elif reply_stream.started:
+            await reply_stream.finish(answer.response)
+            for sent in reply_stream.messages:
+                db_con.link_telegram_message(chat_id, sent.message_id, answer.msg_id)
         else:
-            await self.event.answer(answer.response)
+            sent = await self.event.answer(answer.response)
+            if answer.get("msg_id"):  # Queued data dumps are acknowledged without storing a reply
+                db_con.link_telegram_message(chat_id, sent.message_id, answer.msg_id)
 
         await status_manager.close()
 
@@ -228,8 +285,12 @@ async def error_handler(event: ErrorEvent, msg: Message):
     logging.critical("Critical error caused by %s", event.exception, exc_info=True)
 
 
-async def cron_manager(bot: Bot):
+async def cron_manager(bot: Bot, lease: typing.Optional[LeaderLease] = None, holder: str = ""):
     while True:
+        if lease is not None and not lease.acquire("cron_manager", holder, 120):
+            await asyncio.sleep(60)
+            continue
+
         pending_reminders = db_con.get_all_pending_reminders()
 
         for reminder_id, user_id, reminder_text, remind_at in pending_reminders:
@@ -245,9 +306,17 @@ async def cron_manager(bot: Bot):
         await asyncio.sleep(60)
 
 
-async def media_group_ack(media_queue: MediaGroupQueue, bot: Bot):
+async def media_group_ack(
+    media_queue: MediaGroupQueue | SharedMediaGroupQueue,
+    bot: Bot,
+    lease: typing.Optional[LeaderLease] = None,
+    holder: str = "",
+):
     while True:
         await asyncio.sleep(60)
+        if lease is not None and not lease.acquire("media_group_ack", holder, 120):
+            continue
+
         unprocessed = await media_queue.get_unprocessed()
 
         for mg_id, chat_id in unprocessed:
@@ -258,36 +327,310 @@ async def media_group_ack(media_queue: MediaGroupQueue, bot: Bot):
             )
 
 
-async def main() -> None:
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))  # type: ignore
-    g_client = Client(api_key=getenv("GEMINI_KEY"))
+async def load_agent_stack():
+    """Import dspy, LiteLLM and the agent modules on a worker thread, then configure the LM."""
+    await asyncio.to_thread(importlib.import_module, "llm.modules")
+
+    from llm import configure_lm
+    from src.llm.callbacks import DspyMetricsCallback
+
+    return configure_lm(callbacks=[DspyMetricsCallback()])
+
+
+async def load_genai_client():
+    def create():
+        from google.genai import Client
+
+        return Client(api_key=getenv("GEMINI_KEY"))
+
+    return await asyncio.to_thread(create)
 
-    media_group_queue = MediaGroupQueue(items={}, work_queue={})
-    embed_store = await EmbeddingStore.create()
 
-    wiki_tools = await McpClient.create("wikipedia-mcp", [], {})
+async def load_embed_store():
+    await asyncio.to_thread(importlib.import_module, "chromadb")
+    from src.llm.tools import EmbeddingStore
 
+    return await EmbeddingStore.create()
+
+
+async def load_wiki_tools():
+    from src.llm.tools import McpClient
+
+    return (await McpClient.create("wikipedia-mcp", [], {})).tools
+
+
+async def load_user_agent(startup: Startup, ingestion_queue: IngestionQueue):
+    _, embed_store = await asyncio.gather(
+        startup.get("lm"), startup.get("embed_store")
+    )
+    from llm.cache import CompletionCache
+    from llm.modules import UserSupportAgent
+    from llm.routing import scheduler_stats
 
     user_agent = UserSupportAgent(
         db=db_con,
         embed_store=embed_store,
-        wiki_tools=wiki_tools.tools,
+        wiki_tools=startup.get_nowait("wiki_tools") or [],
+        cache=CompletionCache.from_env(),
+        ingestion_queue=ingestion_queue,
+    )
+    gauge_sources.update(
+        {
+            "llm_scheduler": scheduler_stats,
+            "completion_cache": lambda: {
+                f"{sig}_hit_ratio": stat["hit_ratio"]
+                for sig, stat in user_agent.cache.stats().items()
+            },
+        }
+    )
+    return user_agent
+
+
+async def enable_wiki_tools(startup: Startup):
+    """Wikipedia stays disabled until the MCP server is up, then it is added to the running agent."""
+    user_agent, wiki_tools = await asyncio.gather(
+        startup.get("user_agent"), startup.get("wiki_tools")
     )
+    if wiki_tools and not user_agent.wiki_tools:
+        user_agent.set_wiki_tools(wiki_tools)
+        logging.info("Wikipedia tools enabled")
+
+
+async def start_ingestion_workers(
+    bot: Bot, startup: Startup, ingestion_queue: IngestionQueue, holder: str
+):
+    user_agent = await startup.get("user_agent")
+
+    async def ingest(job, queue):
+        with pipelines.track(job.user_id, "INGEST"):
+            return await user_agent.ingest(job, queue)
+
+    for idx in range(int(getenv("INGEST_WORKERS") or 2)):
+        worker = IngestionWorker(
+            f"{holder}-IngestionWorker-{idx}",
+            ingestion_queue,
+            ingest,
+            lambda user_id, text: bot.send_message(chat_id=user_id, text=text),
+        )
+        asyncio.create_task(worker.run(), name=worker.name)
+
+
+async def run_retention(
+    startup: Startup, lease: typing.Optional[LeaderLease], holder: str
+):
+    try:
+        embed_store = await startup.get("embed_store")
+    except RuntimeError:
+        embed_store = None  # Still archive and compact, the embeddings are just left behind
 
-    asyncio.create_task(cron_manager(bot), name="CronManager")
+    retention = RetentionManager(db_con, embed_store)
+    gauge_sources["retention"] = retention.stats
+    await retention.run(
+        float(getenv("RETENTION_INTERVAL_MINS") or 60) * 60, lease, holder
+    )
+
+
+async def setup_services(bot: Bot, worker_name: typing.Optional[str] = None) -> dict:
+    """Start the background tasks and warm up the agent's dependencies concurrently, without waiting on them.
+    With a worker_name, media group state lives in the shared store and singleton jobs only run in the process
+    holding their lease.
+    """
+    bot.session.middleware(TelegramMetricsMiddleware())
+
+    lease = None
+    if worker_name is None:
+        media_group_queue = MediaGroupQueue(items={}, work_queue={})
+    else:
+        media_group_queue = SharedMediaGroupQueue()
+        QueryStatusManager.registry = SharedStatusRegistry()
+        lease = LeaderLease()
+
+    ingestion_queue = IngestionQueue()
+    media_cache = MediaCache.from_env()
+    holder = worker_name or "main"
+
+    startup = Startup()
+    startup.start("lm", load_agent_stack)
+    startup.start("g_client", load_genai_client)
+    startup.start("embed_store", load_embed_store)
+    startup.start("wiki_tools", load_wiki_tools, optional=True)
+    startup.start("user_agent", lambda: load_user_agent(startup, ingestion_queue))
+    asyncio.create_task(enable_wiki_tools(startup), name="EnableWikiTools")
     asyncio.create_task(
-        media_group_ack(media_group_queue, bot), name="MediaGroupAcknowledger"
+        start_ingestion_workers(bot, startup, ingestion_queue, holder),
+        name="StartIngestionWorkers",
     )
 
-    await dp.start_polling(
-        bot,
-        g_client=g_client,
-        user_agent=user_agent,
-        media_group_queue=media_group_queue,
+    gauge_sources.update(
+        {
+            "media_group_queue": lambda: {
+                "groups": len(media_group_queue.items),
+                "queued_photos": sum(
+                    queue.qsize()
+                    for queue in getattr(media_group_queue, "work_queue", {}).values()
+                ),
+            },
+            "query_status_manager": lambda: {
+                "chats": len(QueryStatusManager._instances),
+                "status_messages": sum(
+                    len(managers) for managers in QueryStatusManager._instances.values()
+                ),
+            },
+            "ingestion_queue": ingestion_queue.depth,
+            "media_cache": media_cache.stats,
+            "startup_seconds": startup.report,
+            "event_loop": loop_lag.stats,
+            "pipelines": pipelines.stats,
+        }
+    )
+    asyncio.create_task(loop_lag.run(), name="LoopLagMonitor")
+    if port := getenv("METRICS_PORT"):
+        # Workers in cluster mode take the ports after the front's
+        offset = int(worker_name.rsplit("-", 1)[1]) + 1 if worker_name else 0
+        asyncio.create_task(
+            serve_metrics(int(port) + offset, routes=debug_routes()), name="MetricsServer"
+        )
+    asyncio.create_task(cron_manager(bot, lease, holder), name="CronManager")
+    asyncio.create_task(run_retention(startup, lease, holder), name="Retention")
+    asyncio.create_task(
+        media_group_ack(media_group_queue, bot, lease, holder),
+        name="MediaGroupAcknowledger",
     )
 
+    return {
+        "startup": startup,
+        "media_group_queue": media_group_queue,
+        "media_cache": media_cache,
+    }
+
+
+async def run_front(bot: Bot):
+    """Long poll Telegram and hand every update to the shared queue, the workers do the rest."""
+    updates = UpdateQueue()
+    offset = updates.next_offset()
+    allowed_updates = dp.resolve_used_update_types()
+
+    # The workers take the ports after this one
+    gauge_sources["update_queue"] = updates.depth
+    if port := getenv("METRICS_PORT"):
+        asyncio.create_task(serve_metrics(int(port)), name="MetricsServer")
+
+    await bot.delete_webhook()
+    failures = 0
+    while True:
+        try:
+            batch = await bot.get_updates(
+                offset=offset, timeout=30, allowed_updates=allowed_updates
+            )
+        except TelegramRetryAfter as e:
+            logging.warning(f"Polling is rate limited, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Exception as e:
+            # Same backoff as aiogram's own polling loop: 1s growing by 1.3x up to 5s, with jitter
+            failures += 1
+            delay = min(5.0, 1.3 ** (failures - 1)) * random.uniform(0.9, 1.1)
+            logging.error(f"Failed to fetch updates ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        failures = 0
+        for update in batch:
+            updates.put(update.update_id, update.model_dump_json(exclude_unset=True))
+            offset = update.update_id + 1
+
+
+async def run_worker(bot: Bot, name: str):
+    updates = UpdateQueue()
+    services = await setup_services(bot, worker_name=name)
+    gauge_sources["update_queue"] = updates.depth
+    slots = asyncio.Semaphore(int(getenv("WORKER_CONCURRENCY") or 8))
+    in_flight: set[int] = set()
+
+    async def heartbeat():
+        # Slow pipelines outlive the claim lease, keep it alive so another worker doesn't answer twice
+        while True:
+            await asyncio.sleep(updates.lease_secs / 3)
+            try:
+                updates.renew(name, in_flight)
+            except Exception:
+                logging.exception(f"{name} could not renew its update leases")
+
+    asyncio.create_task(heartbeat(), name=f"{name}-LeaseHeartbeat")
+
+    async def process(update_id: int, payload: str):
+        in_flight.add(update_id)
+        try:
+            update = Update.model_validate_json(payload, context={"bot": bot})
+            await dp.feed_update(bot, update, **services)
+        except Exception as e:
+            logging.exception(f"{name} failed to process update {update_id}")
+            if updates.fail(update_id, f"{type(e).__name__}: {e}"):
+                logging.error(f"Update {update_id} failed {updates.max_attempts} times, set aside as failed")
+        else:
+            updates.ack(update_id)
+        finally:
+            in_flight.discard(update_id)
+            slots.release()
+
+    while True:
+        await slots.acquire()
+        if claimed := updates.claim(name):
+            asyncio.create_task(process(*claimed), name=f"Update-{claimed[0]}")
+            continue
+
+        slots.release()
+        await asyncio.sleep(0.2)
+
+
+def worker_process(name: str):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(main("worker", name))
+
+
+async def supervise_workers(count: int, check_secs: float = 5.0):
+    """Spawn the worker processes and start a new one whenever one exits, e.g. after a crash."""
+    ctx = multiprocessing.get_context("spawn")
+
+    def spawn(name: str):
+        process = ctx.Process(target=worker_process, args=(name,), name=name, daemon=True)
+        process.start()
+        return process
+
+    workers = [spawn(f"worker-{idx}") for idx in range(count)]
+    while True:
+        await asyncio.sleep(check_secs)
+        for idx, process in enumerate(workers):
+            if not process.is_alive():
+                logging.error(f"{process.name} exited with code {process.exitcode}, restarting it")
+                workers[idx] = spawn(process.name)
+
+
+async def main(mode: str = "single", worker_name: str = "worker-0") -> None:
+    """
+    Modes:
+        single: One process polls and handles everything (default).
+        front: Only poll Telegram and enqueue updates into the shared store.
+        worker: Consume updates from the shared store.
+        cluster: Run the front here and spawn BOT_WORKERS worker processes.
+    """
+    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))  # type: ignore
+
+    match mode:
+        case "front":
+            await run_front(bot)
+        case "worker":
+            await run_worker(bot, worker_name)
+        case "cluster":
+            workers = int(getenv("BOT_WORKERS") or os.cpu_count() or 1)
+            asyncio.create_task(supervise_workers(workers), name="WorkerSupervisor")
+            await run_front(bot)
+        case _:
+            services = await setup_services(bot)
+            await dp.start_polling(bot, **services)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    asyncio.run(main())
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else getenv("BOT_MODE") or "single"))
     db_con.close()
@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import logging
+import os
+import typing
+from io import BytesIO
+from pathlib import Path
+
+from aiogram import Bot
+
+from src.metrics import span
+
+
+class TelegramFile(typing.Protocol):
+    file_id: str
+    file_unique_id: str
+
+
+class MediaCache:
+    """Size bounded LRU cache of Telegram files on disk, keyed by file_unique_id which stays the same when a file
+    is forwarded or sent again. Artefacts derived from a file (rendered PDF pages, transcripts) are cached next to
+    it so repeat media skips both the download and the preprocessing.
+
+    Concurrent requests for the same entry share one download/build. Entries are written to a temporary file and
+    renamed into place, so processes sharing the directory never read a partial file.
+    """
+
+    def __init__(self, root: str = "media_cache", max_bytes: int = 1024 * 1024 * 1024) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.size: typing.Optional[int] = None  # Computed on the first eviction check
+        self.hits = 0
+        self.misses = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._tmp_seq = itertools.count()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            root=os.getenv("MEDIA_CACHE_DIR") or "media_cache",
+            max_bytes=int(os.getenv("MEDIA_CACHE_MAX_MB") or 1024) * 1024 * 1024,
+        )
+
+    def _path(self, name: str) -> Path:
+        return self.root / name[:2] / name
+
+    async def _produce(
+        self, name: str, write: typing.Callable[[Path], typing.Awaitable[None]]
+    ) -> Path:
+        path = self._path(name)
+        if path.exists():
+            self.hits += 1
+            path.touch()  # mtime is the LRU clock
+            return path
+        if (pending := self._inflight.get(name)) is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        fut = self._inflight[name] = asyncio.get_running_loop().create_future()
+        tmp = path.with_name(f"{name}.{os.getpid()}-{next(self._tmp_seq)}.part")
+        try:
+            path.parent.mkdir(exist_ok=True)
+            await write(tmp)
+            os.replace(tmp, path)
+            fut.set_result(path)
+        except BaseException as e:
+            tmp.unlink(missing_ok=True)
+            fut.set_exception(e)
+            fut.exception()  # Nobody else may be waiting, don't log it as never retrieved
+            raise
+        finally:
+            del self._inflight[name]
+
+        if self.size is not None:
+            self.size += path.stat().st_size
+        await self.evict()
+        return path
+
+    async def download(self, bot: Bot, file: TelegramFile) -> BytesIO:
+        """Return the file's contents, streaming it from Telegram straight to disk on a miss."""
+
+        async def write(tmp: Path):
+            with span("media_cache.download"):
+                await bot.download(file, destination=tmp)
+
+        path = await self._produce(file.file_unique_id, write)
+        return BytesIO(await asyncio.to_thread(path.read_bytes))
+
+    async def derived(
+        self,
+        file: TelegramFile,
+        kind: str,
+        build: typing.Callable[[], typing.Awaitable[bytes]],
+    ) -> bytes:
+        """Return the `kind` artefact of a file, running `build` only if it isn't cached yet."""
+
+        async def write(tmp: Path):
+            data = await build()
+            await asyncio.to_thread(tmp.write_bytes, data)
+
+        path = await self._produce(f"{file.file_unique_id}.{kind}", write)
+        return await asyncio.to_thread(path.read_bytes)
+
+    def _scan(self) -> list[tuple[float, int, Path]]:
+        entries = []
+        for directory in self.root.iterdir():
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory):
+                if entry.name.endswith(".part"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        return entries
+
+    async def evict(self):
+        if self.size is not None and self.size <= self.max_bytes:
+            return
+
+        entries = await asyncio.to_thread(self._scan)
+        self.size = sum(size for _, size, _ in entries)
+        # Drop down to 90% so we don't rescan on every new file
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            self.size -= size
+        logging.debug(f"Media cache is at {self.size} bytes after eviction")
+
+    def stats(self) -> dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size or 0}
@@ -0,0 +1,245 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import time
+import typing
+from collections import defaultdict
+from contextlib import contextmanager
+from os import getenv
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import TelegramMethod
+from aiohttp import web
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20)
+
+Labels = tuple[tuple[str, str], ...]
+
+trace_logger = logging.getLogger("sahoo.trace")
+TRACE_ENABLED = bool(getenv("TRACE_LOG"))
+
+# Query category of the request being handled, attached to LLM metrics
+current_category: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_category", default="unknown"
+)
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self.series: dict[Labels, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        if (series := self.series.get(key)) is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_fmt(key + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_fmt(key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, kind: str = "counter") -> None:
+        self.name = name
+        self.doc = doc
+        self.kind = kind
+        self.series: defaultdict[Labels, float] = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels: str):
+        self.series[tuple(sorted(labels.items()))] += value
+
+    def set(self, value: float, **labels: str):
+        self.series[tuple(sorted(labels.items()))] = value
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{_fmt(key)} {value}" for key, value in self.series.items()]
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+SPAN_SECONDS = Histogram("sahoo_span_seconds", "Time spent in an instrumented stage.")
+SPAN_ERRORS = Counter("sahoo_span_errors_total", "Instrumented stages which raised.")
+LLM_TOKENS = Counter("sahoo_llm_tokens_total", "LLM tokens used, by model, kind and query category.")
+LLM_CALLS = Counter("sahoo_llm_calls_total", "LLM completions, by model and query category.")
+REACT_ITERATIONS = Histogram(
+    "sahoo_react_iterations", "Tool calls made by a ReAct agent per run.", COUNT_BUCKETS
+)
+GAUGES = Counter("sahoo_state", "Sizes of in-memory queues and caches.", kind="gauge")
+LOOP_LAG = Histogram(
+    "sahoo_event_loop_lag_seconds", "How late a periodic timer on the event loop fired."
+)
+
+REGISTRY = [SPAN_SECONDS, SPAN_ERRORS, LLM_TOKENS, LLM_CALLS, REACT_ITERATIONS, GAUGES, LOOP_LAG]
+
+# Callables returning {name: value}, sampled into GAUGES whenever metrics are scraped
+gauge_sources: dict[str, typing.Callable[[], dict[str, float]]] = {}
+
+
+@contextmanager
+def span(name: str, **labels: str):
+    """Time a block into sahoo_span_seconds{stage=name}, failures are also counted in sahoo_span_errors_total."""
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_SECONDS.observe(elapsed, stage=name, **labels)
+        if failed:
+            SPAN_ERRORS.inc(stage=name, **labels)
+        if TRACE_ENABLED:
+            trace_logger.info(
+                json.dumps(
+                    {
+                        "span": name,
+                        "ms": round(elapsed * 1000, 3),
+                        "error": failed,
+                        "category": current_category.get(),
+                        **labels,
+                    }
+                )
+            )
+
+
+def instrumented(name: str):
+    """Decorator form of `span` which works on both sync and async functions."""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_methods(prefix: str):
+    """Class decorator wrapping every public method in a span named `prefix.method`."""
+
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("_") or not inspect.isfunction(value):
+                continue
+            setattr(cls, attr, instrumented(f"{prefix}.{attr}")(value))
+        return cls
+
+    return decorator
+
+
+def record_llm_usage(model: str, usage: typing.Any):
+    category = current_category.get()
+    LLM_CALLS.inc(model=model, category=category)
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if tokens := getattr(usage, kind, None):
+            LLM_TOKENS.inc(tokens, model=model, kind=kind, category=category)
+
+
+def record_react_iterations(agent: str, prediction: typing.Any):
+    trajectory = getattr(prediction, "trajectory", None) or {}
+    calls = sum(
+        1
+        for key, tool in trajectory.items()
+        if key.startswith("tool_name_") and tool != "finish"
+    )
+    REACT_ITERATIONS.observe(calls, agent=agent, category=current_category.get())
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Times every Bot API call made through the session."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        with span("telegram", method=type(method).__name__):
+            return await make_request(bot, method)
+
+
+def sample_gauges() -> dict[str, dict[str, float]]:
+    """Sample every gauge source into GAUGES, returns {source: {name: value}}."""
+    sampled = {}
+    for source, sample in gauge_sources.items():
+        try:
+            sampled[source] = sample()
+        except Exception:
+            logging.exception(f"Could not sample gauges from {source}")
+            continue
+        for name, value in sampled[source].items():
+            GAUGES.set(value, source=source, name=name)
+    return sampled
+
+
+def expose() -> str:
+    sample_gauges()
+
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.expose()
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(port: int, routes: typing.Optional[list[web.RouteDef]] = None):
+    """Serve /metrics in Prometheus text format on localhost, along with any extra `routes`."""
+
+    async def metrics(request: web.Request):
+        return web.Response(text=expose(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.add_routes(routes or [])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    logging.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    await asyncio.Event().wait()
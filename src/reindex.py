@@ -0,0 +1,366 @@
+"""Rebuild the Chroma collections from data.db.
+
+Rows are read in primary key order a chunk at a time and embedded in batches on a thread pool. While one
+chunk is being upserted the next one is already embedding. The last key of every upserted chunk is
+checkpointed in REINDEX_STATE (reindex.db), so an interrupted run resumes where it stopped.
+
+With --shadow the rows go into `<collection>-reindex` and, once a target is complete, the live collection is
+swapped for it by renaming both. Without it the live collections are upserted in place.
+
+Messages which data.db can't attribute to a user keep the owner the live collection already has for them. If
+there is none the run stops instead of leaving them out, unless --allow-unowned is passed.
+
+    python src/reindex.py --shadow
+    python src/reindex.py --targets messages --reset
+"""
+
+import argparse
+import asyncio
+import logging
+import sqlite3
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from os import cpu_count, getenv
+
+from dotenv import load_dotenv
+
+if typing.TYPE_CHECKING:
+    from chromadb.api.models.AsyncCollection import AsyncCollection
+
+    from src.llm.tools import EmbeddingStore
+
+
+class UnownedRows(Exception):
+    """Rows with no owner in data.db nor in the live collection, indexing them without one hides them."""
+
+
+@dataclass
+class Target:
+    collection: str
+    key: str
+    # Returns (key, document, metadata) rows with key > ?, ordered by key, at most ? of them
+    sql: str
+    # None when data.db doesn't say who the row belongs to
+    metadata: typing.Callable[[sqlite3.Row], typing.Optional[dict]]
+
+
+def _info_metadata(row: sqlite3.Row) -> typing.Optional[dict]:
+    metadata = {
+        "user_id": int(row["user_id"]),
+        "info_id": row["info_id"],
+        "msg_id": row["message_id"],
+        "has_img": bool(row["has_img"]),
+    }
+    if row["cluster_id"] is not None:
+        metadata["cluster_id"] = row["cluster_id"]
+    return metadata
+
+
+def _message_metadata(row: sqlite3.Row) -> typing.Optional[dict]:
+    if row["user_id"] is None:  # Neither linked to a chat nor to stored information
+        return None
+    return {"user_id": int(row["user_id"]), "msg_id": row["message_id"], "is_llm": False}
+
+
+def _cluster_metadata(row: sqlite3.Row) -> typing.Optional[dict]:
+    return {"user_id": int(row["user_id"]), "cluster_id": row["cluster_id"]}
+
+
+TARGETS = {
+    "info": Target(
+        "bot-infostore",
+        "info_id",
+        """SELECT info.info_id, info.content AS document, info.message_id, info.user_id,
+            m.imgs IS NOT NULL AS has_img, c.cluster_id
+        FROM information info
+        LEFT JOIN messages m ON m.message_id = info.message_id
+        LEFT JOIN info_cluster_members c ON c.info_id = info.info_id
+        WHERE info.info_id > ? ORDER BY info.info_id LIMIT ?""",
+        _info_metadata,
+    ),
+    # Only user messages are searched, archived ones were removed from Chroma by the retention job
+    "messages": Target(
+        "bot-msgstore",
+        "message_id",
+        """SELECT m.message_id, m.content AS document, COALESCE(
+                (SELECT t.chat_id FROM telegram_messages t WHERE t.message_id = m.message_id LIMIT 1),
+                (SELECT i.user_id FROM information i WHERE i.message_id = m.message_id LIMIT 1)
+            ) AS user_id
+        FROM messages m
+        WHERE m.message_id > ? AND m.sender = 'user' AND m.content IS NOT NULL AND m.content != ''
+        ORDER BY m.message_id LIMIT ?""",
+        _message_metadata,
+    ),
+    "clusters": Target(
+        "bot-clusterstore",
+        "cluster_id",
+        """SELECT cluster_id, summary AS document, user_id FROM info_clusters
+        WHERE cluster_id > ? ORDER BY cluster_id LIMIT ?""",
+        _cluster_metadata,
+    ),
+}
+
+
+class Checkpoints:
+    def __init__(self, path: str) -> None:
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS reindex_checkpoints(
+                        target TEXT PRIMARY KEY,
+                        collection TEXT NOT NULL,
+                        last_key INTEGER NOT NULL,
+                        rows INTEGER NOT NULL,
+                        done INTEGER DEFAULT 0 NOT NULL,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        self.db.commit()
+
+    def get(self, target: str, collection: str) -> tuple[int, int, bool]:
+        """Returns (last key, rows written, finished) for a build into `collection`."""
+        row = self.db.execute(
+            "SELECT last_key, rows, done FROM reindex_checkpoints WHERE target = ? AND collection = ?",
+            (target, collection),
+        ).fetchone()
+        return (row[0], row[1], bool(row[2])) if row else (0, 0, False)
+
+    def save(self, target: str, collection: str, last_key: int, rows: int, done: bool = False):
+        self.db.execute(
+            """INSERT OR REPLACE INTO reindex_checkpoints(target, collection, last_key, rows, done, updated_at)
+            VALUES(?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
+            (target, collection, last_key, rows, done),
+        )
+        self.db.commit()
+
+    def reset(self, target: str):
+        self.db.execute("DELETE FROM reindex_checkpoints WHERE target = ?", (target,))
+        self.db.commit()
+
+
+class Reindexer:
+    def __init__(
+        self,
+        store: "EmbeddingStore",
+        source: str = "data.db",
+        checkpoints: typing.Optional[Checkpoints] = None,
+        chunk_size: int = 4096,
+        embed_batch: int = 256,
+        upsert_batch: int = 1000,
+        workers: int = cpu_count() or 4,
+        allow_unowned: bool = False,
+    ) -> None:
+        self.store = store
+        self.db = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+        self.db.row_factory = sqlite3.Row
+        self.checkpoints = checkpoints or Checkpoints(getenv("REINDEX_STATE") or "reindex.db")
+        self.chunk_size = chunk_size
+        self.embed_batch = embed_batch
+        self.upsert_batch = upsert_batch
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reindex-embed")
+        self.allow_unowned = allow_unowned
+
+    async def embed(self, documents: list[str]) -> list:
+        assert self.store.embedding_function is not None
+        loop = asyncio.get_running_loop()
+        batches = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    self.pool, self.store.embedding_function, documents[idx : idx + self.embed_batch]
+                )
+                for idx in range(0, len(documents), self.embed_batch)
+            )
+        )
+        return [vector for batch in batches for vector in batch]
+
+    async def upsert(self, collection: "AsyncCollection", ids, documents, metadatas, embeddings):
+        await asyncio.gather(
+            *(
+                collection.upsert(
+                    ids=ids[idx : idx + self.upsert_batch],
+                    documents=documents[idx : idx + self.upsert_batch],
+                    metadatas=metadatas[idx : idx + self.upsert_batch],
+                    embeddings=embeddings[idx : idx + self.upsert_batch],
+                )
+                for idx in range(0, len(ids), self.upsert_batch)
+            )
+        )
+
+    async def known_metadata(self, target: Target, rows: list[sqlite3.Row]) -> dict[str, dict]:
+        """Metadata the live collection already holds for `rows`, keyed on id. Only entries with an owner."""
+        try:
+            live = await self.store.client.get_collection(name=target.collection)
+        except Exception:  # Never built, or lost
+            return {}
+        found = await live.get(ids=[str(row[target.key]) for row in rows], include=["metadatas"])
+        return {
+            id_: dict(meta)
+            for id_, meta in zip(found["ids"], found["metadatas"] or [])
+            if meta and meta.get("user_id") is not None
+        }
+
+    async def build(self, name: str, target: Target, collection_name: str) -> dict:
+        last_key, written, done = self.checkpoints.get(name, collection_name)
+        if done:
+            logging.info(f"{name}: {collection_name} is already complete, use --reset to rebuild it")
+            return {"rows": 0, "seconds": 0.0}
+        if last_key:
+            logging.info(f"{name}: resuming after {target.key} {last_key} ({written} rows written)")
+        elif collection_name != target.collection:
+            # Leftovers of an abandoned shadow build could hold rows that were deleted since
+            try:
+                await self.store.client.delete_collection(name=collection_name)
+            except Exception:
+                pass
+        collection = await self.store.client.get_or_create_collection(
+            name=collection_name, configuration={"hnsw": {"space": "cosine"}}
+        )
+
+        started = time.perf_counter()
+        rows_done = recovered = skipped = 0
+        embed_secs = wait_secs = 0.0
+        pending: typing.Optional[asyncio.Task] = None
+        pending_key = last_key
+
+        while True:
+            rows = self.db.execute(target.sql, (last_key, self.chunk_size)).fetchall()
+            if not rows:
+                break
+            last_key = rows[-1][target.key]
+
+            chunk = [(row, target.metadata(row)) for row in rows]
+            if missing := [row for row, meta in chunk if meta is None]:
+                known = await self.known_metadata(target, missing)
+                recovered += len(known)
+                chunk = [(row, meta or known.get(str(row[target.key]))) for row, meta in chunk]
+            if unowned := [row[target.key] for row, meta in chunk if meta is None]:
+                if not self.allow_unowned:
+                    if pending is not None:
+                        await pending
+                        self.checkpoints.save(name, collection_name, pending_key, written)
+                    raise UnownedRows(
+                        f"{name}: {len(unowned)} rows have no owner in data.db nor in {target.collection} "
+                        f"({target.key} {', '.join(map(str, unowned[:10]))}{', ...' if len(unowned) > 10 else ''}). "
+                        "Rerun with --allow-unowned to leave them out of the index."
+                    )
+                chunk = [(row, meta) for row, meta in chunk if meta is not None]
+                skipped += len(unowned)
+
+            t0 = time.perf_counter()
+            embeddings = await self.embed([row["document"] for row, _ in chunk]) if chunk else []
+            embed_secs += time.perf_counter() - t0
+
+            # Only checkpoint a chunk once its upsert finished, the next chunk embeds in the meantime
+            if pending is not None:
+                t0 = time.perf_counter()
+                await pending
+                wait_secs += time.perf_counter() - t0
+                self.checkpoints.save(name, collection_name, pending_key, written)
+            pending_key = last_key
+            written += len(chunk)
+            rows_done += len(chunk)
+            pending = None
+            if chunk:
+                pending = asyncio.create_task(
+                    self.upsert(
+                        collection,
+                        [str(row[target.key]) for row, _ in chunk],
+                        [row["document"] for row, _ in chunk],
+                        [meta for _, meta in chunk],
+                        embeddings,
+                    )
+                )
+
+            elapsed = time.perf_counter() - started
+            logging.info(f"{name}: {written} rows, {rows_done / elapsed:.0f} rows/s")
+
+        if pending is not None:
+            t0 = time.perf_counter()
+            await pending
+            wait_secs += time.perf_counter() - t0
+        self.checkpoints.save(name, collection_name, pending_key, written, done=True)
+
+        elapsed = time.perf_counter() - started
+        return {
+            "rows": rows_done,
+            "recovered": recovered,
+            "skipped": skipped,
+            "seconds": round(elapsed, 2),
+            "rows_per_sec": round(rows_done / elapsed, 1) if elapsed else 0.0,
+            "embed_seconds": round(embed_secs, 2),
+            # Time spent waiting on Chroma after the next chunk was already embedded
+            "upsert_wait_seconds": round(wait_secs, 2),
+        }
+
+    async def swap(self, live: str, shadow: str, keep_old: bool = False):
+        """Put the shadow collection in place of the live one. Lookups by name fail for the moment in between
+        the two renames.
+        """
+        old = f"{live}-old-{int(time.time())}"
+        try:
+            current = await self.store.client.get_collection(name=live)
+            await current.modify(name=old)
+        except Exception:  # No live collection yet (e.g. it was lost), nothing to move aside
+            current = None
+        await (await self.store.client.get_collection(name=shadow)).modify(name=live)
+        if current is not None and not keep_old:
+            await self.store.client.delete_collection(name=old)
+        logging.info(f"Swapped {shadow} into {live}")
+
+    async def run(self, targets: list[str], shadow: bool, keep_old: bool = False) -> dict:
+        report = {}
+        for name in targets:
+            target = TARGETS[name]
+            collection = f"{target.collection}-reindex" if shadow else target.collection
+            report[name] = await self.build(name, target, collection)
+            if shadow:
+                await self.swap(target.collection, collection, keep_old)
+                self.checkpoints.reset(name)
+        return report
+
+
+async def main():
+    from src.llm.tools import EmbeddingStore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", default=",".join(TARGETS), help=f"Comma separated, any of {', '.join(TARGETS)}")
+    parser.add_argument("--source", default="data.db")
+    parser.add_argument("--shadow", action="store_true", help="Build into a shadow collection and swap it in")
+    parser.add_argument("--keep-old", action="store_true", help="Keep the replaced collection after a swap")
+    parser.add_argument("--reset", action="store_true", help="Ignore checkpoints and start from the first row")
+    parser.add_argument(
+        "--allow-unowned", action="store_true", help="Leave out messages with no known owner instead of stopping"
+    )
+    parser.add_argument("--chunk-size", type=int, default=4096, help="Rows read from SQLite at a time")
+    parser.add_argument("--embed-batch", type=int, default=256)
+    parser.add_argument("--upsert-batch", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=cpu_count() or 4, help="Embedding threads")
+    args = parser.parse_args()
+
+    targets = [name.strip() for name in args.targets.split(",") if name.strip()]
+    if unknown := set(targets) - set(TARGETS):
+        parser.error(f"Unknown targets: {', '.join(sorted(unknown))}")
+
+    reindexer = Reindexer(
+        await EmbeddingStore.create(),
+        source=args.source,
+        chunk_size=args.chunk_size,
+        embed_batch=args.embed_batch,
+        upsert_batch=args.upsert_batch,
+        workers=args.workers,
+        allow_unowned=args.allow_unowned,
+    )
+    if args.reset:
+        for name in targets:
+            reindexer.checkpoints.reset(name)
+
+    try:
+        report = await reindexer.run(targets, args.shadow, args.keep_old)
+    except UnownedRows as e:
+        parser.exit(1, f"{e}\n")
+    for name, stats in report.items():
+        print(f"{name}: " + ", ".join(f"{key}={value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    load_dotenv(".env")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import typing
+from dataclasses import dataclass
+from os import getenv
+
+from db import DBConn
+from src.ingest import create_ingest_jobs
+from src.metrics import span
+
+if typing.TYPE_CHECKING:
+    from src.llm.tools import EmbeddingStore
+    from src.shared import LeaderLease
+
+
+@dataclass
+class RetentionPolicy:
+    """Rows of `table` older than `days` (by `age_column`) which match `cold` are moved to the archive database,
+    or deleted outright when `archive` is False. A policy with days <= 0 is disabled.
+    """
+
+    table: str
+    key: str
+    age_column: str
+    days: int
+    cold: str = "1"
+    archive: bool = True
+    columns: tuple[str, ...] = ()
+
+
+def policies_from_env() -> list[RetentionPolicy]:
+    return [
+        RetentionPolicy(
+            "messages",
+            "message_id",
+            "timestamp",
+            int(getenv("RETENTION_MESSAGES_DAYS") or 180),
+            # Keep messages which pending work still points at
+            cold="""message_id NOT IN (SELECT message_id FROM main.reminders
+                    WHERE status = 'pending' AND message_id IS NOT NULL)
+                AND message_id NOT IN (SELECT msg_id FROM main.ingest_jobs WHERE status != 'done')""",
+            columns=("message_id", "sender", "content", "imgs", "file_id", "doc_type", "media_group_id", "timestamp"),
+        ),
+        RetentionPolicy(
+            "reminders",
+            "reminder_id",
+            "remind_at",
+            int(getenv("RETENTION_REMINDERS_DAYS") or 30),
+            cold="status != 'pending'",
+            columns=("reminder_id", "user_id", "message_id", "reminder_text", "remind_at", "created_at", "status"),
+        ),
+        RetentionPolicy(
+            "ingest_jobs",
+            "msg_id",
+            "created_at",
+            int(getenv("RETENTION_INGEST_JOBS_DAYS") or 7),
+            cold="status IN ('done', 'failed')",
+            archive=False,
+        ),
+    ]
+
+
+class RetentionManager:
+    """Keeps data.db small: moves cold rows into the attached archive database, drops their message embeddings
+    and compacts the file with incremental vacuum and WAL checkpoints.
+
+    Everything runs on the event loop in small slices (one batch or `vacuum_pages` pages at a time) so a pass
+    never holds the write lock for long.
+    """
+
+    def __init__(
+        self,
+        db: DBConn,
+        embed_store: typing.Optional["EmbeddingStore"] = None,
+        policies: typing.Optional[list[RetentionPolicy]] = None,
+        batch_size: int = 500,
+        vacuum_pages: int = 256,
+        pause_secs: float = 0.05,
+    ) -> None:
+        self.db = db
+        self.embed_store = embed_store
+        self.policies = policies if policies is not None else policies_from_env()
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.pause_secs = pause_secs
+        self.moved: dict[str, int] = {policy.table: 0 for policy in self.policies}
+        # The messages policy keeps rows that unfinished ingestion jobs point at
+        create_ingest_jobs(self.db.db)
+        self.db.db.commit()
+
+    async def sweep(self, policy: RetentionPolicy) -> int:
+        if policy.days <= 0:
+            return 0
+
+        conn = self.db.db
+        total = 0
+        while True:
+            with span("retention.batch", table=policy.table):
+                keys = [
+                    row[0]
+                    for row in conn.execute(
+                        f"""SELECT {policy.key} FROM main.{policy.table}
+                        WHERE {policy.age_column} < datetime('now', ?) AND {policy.cold}
+                        ORDER BY {policy.key} LIMIT ?""",
+                        (f"-{policy.days} days", self.batch_size),
+                    )
+                ]
+                if not keys:
+                    break
+
+                marks = ", ".join("?" * len(keys))
+                if policy.archive:
+                    # Commits across attached WAL databases are only atomic per file. Copy first so a crash
+                    # leaves the row in both places (reads prefer main) and the next pass just replaces it.
+                    columns = ", ".join(policy.columns)
+                    conn.execute(
+                        f"""INSERT OR REPLACE INTO archive.{policy.table}({columns})
+                        SELECT {columns} FROM main.{policy.table} WHERE {policy.key} IN ({marks})""",
+                        keys,
+                    )
+                conn.execute(
+                    f"DELETE FROM main.{policy.table} WHERE {policy.key} IN ({marks})",
+                    keys,
+                )
+                conn.commit()
+
+            if policy.table == "messages" and self.embed_store is not None:
+                try:
+                    await self.embed_store.delete_message_embeddings(keys)
+                except Exception:
+                    logging.exception("Could not delete embeddings of archived messages")
+
+            total += len(keys)
+            self.moved[policy.table] += len(keys)
+            await asyncio.sleep(self.pause_secs)
+
+        if total:
+            logging.info(f"Retention moved {total} rows out of {policy.table}")
+        return total
+
+    async def compact(self):
+        """Release free pages to the OS a slice at a time, then checkpoint so the WAL can be reused."""
+        conn = self.db.db
+        if conn.execute("pragma main.auto_vacuum").fetchone()[0] != 2:
+            logging.warning(
+                "data.db does not use incremental auto_vacuum, rerun `python src/db.py` while the bot is stopped"
+            )
+        else:
+            while conn.execute("pragma main.freelist_count").fetchone()[0] > 0:
+                with span("retention.vacuum"):
+                    conn.execute(f"pragma main.incremental_vacuum({self.vacuum_pages})").fetchall()
+                await asyncio.sleep(self.pause_secs)
+
+        with span("retention.checkpoint"):
+            conn.execute("pragma main.wal_checkpoint(PASSIVE)").fetchall()
+            conn.execute("pragma archive.wal_checkpoint(PASSIVE)").fetchall()
+
+    async def run_once(self):
+        for policy in self.policies:
+            await self.sweep(policy)
+        await self.compact()
+
+    async def run(
+        self,
+        interval_secs: float = 3600,
+        lease: typing.Optional["LeaderLease"] = None,
+        holder: str = "",
+    ):
+        while True:
+            if lease is None or lease.acquire("retention", holder, interval_secs * 2):
+                try:
+                    await self.run_once()
+                except Exception:
+                    logging.exception("Retention pass failed")
+            await asyncio.sleep(interval_secs)
+
+    def stats(self) -> dict[str, int]:
+        conn = self.db.db
+        page_size = conn.execute("pragma main.page_size").fetchone()[0]
+        return {
+            "hot_db_bytes": conn.execute("pragma main.page_count").fetchone()[0] * page_size,
+            "free_pages": conn.execute("pragma main.freelist_count").fetchone()[0],
+            **{f"{table}_moved": moved for table, moved in self.moved.items()},
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(RetentionManager(DBConn()).run_once())
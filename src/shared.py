@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import sqlite3
+import time
+import typing
+from datetime import datetime
+from io import BytesIO
+from os import getenv
+
+
+class SharedStore:
+    """State shared between the front and worker processes, kept in a local SQLite file (SHARED_DB)."""
+
+    def __init__(self, path: typing.Optional[str] = None) -> None:
+        self.db = sqlite3.connect(path or getenv("SHARED_DB") or "shared.db")
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma busy_timeout=5000")
+        self.setup()
+        self.db.commit()
+
+    def setup(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+
+class UpdateQueue(SharedStore):
+    """Telegram updates accepted by the front process and waiting for a worker. An update is only removed once a
+    worker handled it, failed ones are retried and set aside as 'failed' after max_attempts.
+    """
+
+    def __init__(
+        self,
+        path: typing.Optional[str] = None,
+        lease_secs: int = 600,
+        max_attempts: int = 3,
+        retry_secs: float = 10,
+    ) -> None:
+        super().__init__(path)
+        self.lease_secs = lease_secs
+        self.max_attempts = max_attempts
+        self.retry_secs = retry_secs
+
+    def setup(self):
+        # status: 'pending', 'failed'
+        self.db.execute("""CREATE TABLE IF NOT EXISTS updates(
+                        update_id INTEGER PRIMARY KEY,
+                        payload TEXT NOT NULL, -- json fmt
+                        locked_by TEXT,
+                        locked_until REAL DEFAULT 0 NOT NULL,
+                        status TEXT DEFAULT 'pending' NOT NULL,
+                        attempts INTEGER DEFAULT 0 NOT NULL,
+                        error TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        # Stores created before updates could fail
+        columns = {row[1] for row in self.db.execute("pragma table_info(updates)")}
+        for column, definition in (
+            ("status", "TEXT DEFAULT 'pending' NOT NULL"),
+            ("attempts", "INTEGER DEFAULT 0 NOT NULL"),
+            ("error", "TEXT"),
+        ):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE updates ADD COLUMN {column} {definition}")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS update_offset(
+                        id INTEGER PRIMARY KEY CHECK (id = 0),
+                        next_offset INTEGER NOT NULL)""")
+
+    def put(self, update_id: int, payload: str):
+        cur = self.db.cursor()
+        cur.execute(
+            """INSERT OR IGNORE INTO updates(update_id, payload) VALUES(?, ?)""",
+            (update_id, payload),
+        )
+        cur.execute(
+            """INSERT INTO update_offset(id, next_offset) VALUES(0, ?)
+            ON CONFLICT(id) DO UPDATE SET next_offset = MAX(next_offset, excluded.next_offset)""",
+            (update_id + 1,),
+        )
+        self.db.commit()
+
+    def next_offset(self) -> typing.Optional[int]:
+        row = self.db.execute("SELECT next_offset FROM update_offset").fetchone()
+        return row[0] if row else None
+
+    def claim(self, worker: str) -> typing.Optional[tuple[int, str]]:
+        """Lease the oldest update. Updates held by a worker which died become claimable once the lease runs out."""
+        now = time.time()
+        sql = """UPDATE updates SET locked_by = ?, locked_until = ?, attempts = attempts + 1
+                WHERE update_id = (
+                    SELECT update_id FROM updates WHERE status = 'pending' AND locked_until < ?
+                    ORDER BY update_id LIMIT 1)
+                RETURNING update_id, payload"""
+        cur = self.db.cursor()
+        cur.execute(sql, (worker, now + self.lease_secs, now))
+        row = cur.fetchone()
+        self.db.commit()
+        return row
+
+    def renew(self, worker: str, update_ids: typing.Iterable[int]):
+        """Extend the leases of updates this worker is still processing, so nobody else picks them up."""
+        ids = list(update_ids)
+        if not ids:
+            return
+        self.db.execute(
+            f"""UPDATE updates SET locked_until = ? WHERE locked_by = ? AND update_id IN ({",".join("?" * len(ids))})""",
+            (time.time() + self.lease_secs, worker, *ids),
+        )
+        self.db.commit()
+
+    def ack(self, update_id: int):
+        self.db.execute("DELETE FROM updates WHERE update_id = ?", (update_id,))
+        self.db.commit()
+
+    def fail(self, update_id: int, error: str) -> bool:
+        """Release a failed update for a retry after retry_secs * attempts.
+        Returns:
+            True if it ran out of attempts and was set aside as 'failed'.
+        """
+        sql = """UPDATE updates SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    locked_by = NULL, locked_until = ? + ? * attempts, error = ?
+                WHERE update_id = ?
+                RETURNING status"""
+        cur = self.db.cursor()
+        cur.execute(sql, (self.max_attempts, time.time(), self.retry_secs, error, update_id))
+        row = cur.fetchone()
+        self.db.commit()
+        return row is not None and row[0] == "failed"
+
+    def depth(self) -> dict[str, int]:
+        counts = dict(self.db.execute("SELECT status, COUNT(*) FROM updates GROUP BY status").fetchall())
+        # Every status is reported, a gauge whose key disappeared would keep showing its last count
+        return {status: counts.get(status, 0) for status in ("pending", "failed")}
+
+
+class SharedMediaGroupQueue(SharedStore):
+    """MediaGroupQueue for multi-process deployments. Album photos can land on different workers, so the
+    bookkeeping and the photos handed to the album's first handler live in the shared store.
+    """
+
+    def __init__(
+        self,
+        path: typing.Optional[str] = None,
+        max_age_secs: int = 300,
+        poll_secs: float = 0.2,
+    ) -> None:
+        super().__init__(path)
+        self.max_age_secs = max_age_secs
+        self.poll_secs = poll_secs
+
+    def setup(self):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS media_groups(
+                        media_group_id TEXT PRIMARY KEY,
+                        chat_id INTEGER NOT NULL,
+                        in_progress INTEGER NOT NULL,
+                        updated_at TIMESTAMP NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS media_group_items(
+                        item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        media_group_id TEXT NOT NULL,
+                        data BLOB NOT NULL)""")
+
+    @property
+    def items(self) -> dict[str, tuple[datetime, int, int]]:
+        rows = self.db.execute(
+            "SELECT media_group_id, updated_at, chat_id, in_progress FROM media_groups"
+        ).fetchall()
+        return {
+            mg_id: (datetime.fromisoformat(ts), chat_id, in_prog)
+            for mg_id, ts, chat_id, in_prog in rows
+        }
+
+    async def add(self, media_group_id: str, chat_id: int):
+        if not media_group_id:
+            return False
+        sql = """INSERT INTO media_groups(media_group_id, chat_id, in_progress, updated_at) VALUES(?, ?, 1, ?)
+                ON CONFLICT(media_group_id) DO UPDATE SET in_progress = in_progress + 1, updated_at = excluded.updated_at
+                RETURNING in_progress"""
+        cur = self.db.cursor()
+        cur.execute(sql, (media_group_id, chat_id, datetime.now().isoformat()))
+        in_progress = cur.fetchone()[0]
+        self.db.commit()
+
+        if in_progress == 1:
+            logging.info(f"Added media group {media_group_id} to shared queue.")
+        return in_progress > 1
+
+    async def submit_task(self, media_group_id: str, image: typing.BinaryIO):
+        image.seek(0)
+        self.db.execute(
+            "INSERT INTO media_group_items(media_group_id, data) VALUES(?, ?)",
+            (media_group_id, image.read()),
+        )
+        self.db.commit()
+
+    async def next_item(self, media_group_id: str) -> BytesIO:
+        sql = """DELETE FROM media_group_items WHERE item_id = (
+                    SELECT MIN(item_id) FROM media_group_items WHERE media_group_id = ?)
+                RETURNING data"""
+        while True:
+            cur = self.db.cursor()
+            cur.execute(sql, (media_group_id,))
+            row = cur.fetchone()
+            self.db.commit()
+            if row:
+                return BytesIO(row[0])
+            await asyncio.sleep(self.poll_secs)
+
+    async def set_processed(self, media_group_id: str):
+        self.db.execute(
+            "UPDATE media_groups SET in_progress = in_progress - 1 WHERE media_group_id = ?",
+            (media_group_id,),
+        )
+        self.db.commit()
+
+    async def get_unprocessed(self):
+        now = datetime.now()
+        to_remove = [
+            (mg_id, chat_id)
+            for mg_id, (ts, chat_id, in_prog) in self.items.items()
+            if in_prog == 0 and (now - ts).seconds > self.max_age_secs
+        ]
+        self.db.executemany(
+            "DELETE FROM media_groups WHERE media_group_id = ?",
+            [(mg_id,) for mg_id, _ in to_remove],
+        )
+        self.db.commit()
+        return to_remove
+
+
+class SharedStatusRegistry(SharedStore):
+    """Records which status message owns a media group, so every worker resolves the same owner."""
+
+    def setup(self):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS status_messages(
+                        chat_id INTEGER NOT NULL,
+                        media_group_id TEXT NOT NULL,
+                        message_id INTEGER NOT NULL,
+                        PRIMARY KEY (chat_id, media_group_id))""")
+
+    def claim_media_group(self, chat_id: int, media_group_id: str, message_id: int) -> int:
+        """Returns:
+        The message_id of the status message which owns the media group.
+        """
+        cur = self.db.cursor()
+        cur.execute(
+            "INSERT OR IGNORE INTO status_messages(chat_id, media_group_id, message_id) VALUES(?, ?, ?)",
+            (chat_id, media_group_id, message_id),
+        )
+        cur.execute(
+            "SELECT message_id FROM status_messages WHERE chat_id = ? AND media_group_id = ?",
+            (chat_id, media_group_id),
+        )
+        owner = cur.fetchone()[0]
+        self.db.commit()
+        return owner
+
+    def size(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM status_messages").fetchone()[0]
+
+
+class LeaderLease(SharedStore):
+    """Time bound lease so singleton jobs (reminders, album acks) run in exactly one process."""
+
+    def setup(self):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS leases(
+                        name TEXT PRIMARY KEY,
+                        holder TEXT NOT NULL,
+                        expires_at REAL NOT NULL)""")
+
+    def acquire(self, name: str, holder: str, ttl_secs: float) -> bool:
+        now = time.time()
+        sql = """INSERT INTO leases(name, holder, expires_at) VALUES(?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?"""
+        cur = self.db.cursor()
+        cur.execute(sql, (name, holder, now + ttl_secs, now))
+        cur.execute("SELECT holder FROM leases WHERE name = ?", (name,))
+        is_leader = cur.fetchone()[0] == holder
+        self.db.commit()
+        return is_leader
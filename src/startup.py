@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import time
+import typing
+from collections import defaultdict
+
+PROCESS_STARTED = time.perf_counter()
+
+
+class Startup:
+    """Subsystems warming up in the background. The bot starts taking updates straight away and handlers
+    wait on `get` only for the subsystem they actually need.
+    """
+
+    def __init__(self) -> None:
+        self.services: dict[str, typing.Any] = {}
+        self.errors: dict[str, BaseException] = {}
+        self.events: defaultdict[str, asyncio.Event] = defaultdict(asyncio.Event)
+        self.timings: dict[str, float] = {}
+
+    def start(
+        self,
+        name: str,
+        factory: typing.Callable[[], typing.Awaitable[typing.Any]],
+        optional: bool = False,
+    ) -> asyncio.Task:
+        """Run `factory` in the background and publish its result under `name`. Optional subsystems which
+        fail are logged and published as None.
+        """
+
+        async def run():
+            started = time.perf_counter()
+            try:
+                self.services[name] = await factory()
+            except Exception as e:
+                elapsed = time.perf_counter() - started
+                if optional:
+                    logging.warning(
+                        f"Optional subsystem {name} is unavailable after {elapsed:.2f}s: {e}", exc_info=True
+                    )
+                    self.services[name] = None
+                else:
+                    logging.exception(f"Subsystem {name} failed to start after {elapsed:.2f}s")
+                    self.errors[name] = e
+            else:
+                logging.info(
+                    f"{name} ready in {time.perf_counter() - started:.2f}s, "
+                    f"{time.perf_counter() - PROCESS_STARTED:.2f}s after process start"
+                )
+            finally:
+                self.timings[name] = time.perf_counter() - started
+                self.events[name].set()
+
+        return asyncio.create_task(run(), name=f"Startup-{name}")
+
+    async def get(self, name: str) -> typing.Any:
+        await self.events[name].wait()
+        if error := self.errors.get(name):
+            raise RuntimeError(f"{name} failed to start") from error
+        return self.services[name]
+
+    def get_nowait(self, name: str) -> typing.Any:
+        return self.services.get(name)
+
+    def report(self) -> dict[str, float]:
+        return dict(self.timings)
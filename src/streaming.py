@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+
+class TelegramReplyStream:
+    """Shows a streamed LLM reply by progressively editing Telegram messages.
+
+    Edits are throttled to one every `min_interval` seconds and sent as plain text, since a partial reply can
+    contain unclosed HTML tags. `finish` renders the complete reply once more with the default (HTML) parse
+    mode. Text that would go past Telegram's message length limit continues in a new message.
+    """
+
+    SPLIT_AT = 3900  # Leaves headroom under the 4096 character limit
+
+    def __init__(self, event: Message, min_interval: float = 1.0) -> None:
+        self.event = event
+        self.min_interval = min_interval
+        self.messages: list[Message] = []
+        self.segments: list[str] = [""]
+        self.next_edit = 0.0
+
+    @property
+    def started(self) -> bool:
+        return bool(self.messages)
+
+    async def push(self, chunk: str):
+        count = len(self.segments)
+        self.segments[-1] += chunk
+        self._split()
+
+        # Messages before the last one are complete now, bring them up to date regardless of the throttle
+        for idx in range(count - 1, len(self.segments) - 1):
+            await self._render(idx, final=False)
+
+        if time.monotonic() < self.next_edit:
+            return
+        await self._render(len(self.segments) - 1, final=False)
+
+    def reset(self):
+        """Start the text over, e.g. when the answer being streamed was discarded. The messages already sent are
+        reused by the next edits and `finish` deletes any left over.
+        """
+        self.segments = [""]
+        self.next_edit = 0.0
+
+    async def finish(self, text: str):
+        self.segments = [text]
+        self._split()
+
+        for idx in range(len(self.segments)):
+            await self._render(idx, final=True)
+
+        for message in self.messages[len(self.segments) :]:
+            await message.delete()
+
+    def _split(self):
+        while len(self.segments[-1]) > self.SPLIT_AT:
+            text = self.segments.pop()
+            cut = text.rfind("\n", 0, self.SPLIT_AT)
+            if cut <= 0:
+                cut = self.SPLIT_AT
+            self.segments += [text[:cut], text[cut:].lstrip("\n")]
+
+    async def _render(self, idx: int, final: bool):
+        text = self.segments[idx]
+        if not text.strip():
+            return
+
+        # A final render has to reach the user even after falling back from HTML to plain text
+        must_deliver = as_html = final
+        while True:
+            try:
+                if idx < len(self.messages):
+                    await self._edit(self.messages[idx], text, as_html)
+                elif as_html:
+                    self.messages.append(await self.event.answer(text))
+                else:
+                    self.messages.append(await self.event.answer(text, parse_mode=None))
+                break
+            except TelegramRetryAfter as e:
+                self.next_edit = time.monotonic() + e.retry_after
+                if not must_deliver:
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if not as_html or "not modified" in e.message:
+                    if must_deliver and "not modified" not in e.message:
+                        logging.error(f"Could not deliver streamed reply: {e.message}")
+                    return
+                # Reply is not valid HTML, show it as plain text instead
+                logging.warning(f"Could not render streamed reply as HTML: {e.message}")
+                as_html = False
+
+        self.next_edit = time.monotonic() + self.min_interval
+
+    async def _edit(self, message: Message, text: str, as_html: bool):
+        try:
+            if as_html:
+                await message.edit_text(text)
+            else:
+                await message.edit_text(text, parse_mode=None)
+        except TelegramBadRequest as e:
+            if "not modified" not in e.message:
+                raise
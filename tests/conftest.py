@@ -0,0 +1,9 @@
+import os
+import pathlib
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+# Modules import each other both as `src.x` and, from inside src, as `llm.x` / `db`
+sys.path[:0] = [str(ROOT), str(ROOT / "src")]
+# Keep litellm from fetching its model cost map on import
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from llm.cache import CompletionCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.db"), max_bytes=10_000)
+    yield cache
+    cache.close()
+
+
+def stored_size(cache: CompletionCache) -> int:
+    return cache.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+
+def test_get_returns_stored_value(cache):
+    cache.put("a", "ClassifyQuery", {"label": "info"})
+    assert cache.get("a", "ClassifyQuery", ttl=60) == {"label": "info"}
+    assert cache.stats()["ClassifyQuery"]["hits"] == 1
+
+
+def test_expired_entry_is_a_miss(cache):
+    cache.put("a", "ClassifyQuery", {"label": "info"})
+    cache.db.execute("UPDATE completions SET created_at = ?", (time.time() - 120,))
+    assert cache.get("a", "ClassifyQuery", ttl=60) is None
+    assert cache.stats()["ClassifyQuery"]["misses"] == 1
+
+
+def test_replacing_an_entry_keeps_the_size_exact(cache):
+    for idx in range(20):
+        cache.put("a", "ClassifyQuery", {"label": "x" * (100 + idx)})
+    assert cache.size == stored_size(cache)
+
+
+def test_evicts_least_recently_used(cache):
+    for idx in range(5):
+        cache.put(str(idx), "Analyzer", {"text": "x" * 1500})
+        time.sleep(0.001)
+    cache.get("0", "Analyzer", ttl=60)  # Touching it makes "1" the oldest
+
+    for idx in range(5, 8):
+        cache.put(str(idx), "Analyzer", {"text": "x" * 1500})
+        time.sleep(0.001)
+
+    keys = {row[0] for row in cache.db.execute("SELECT key FROM completions")}
+    assert "0" in keys and "1" not in keys and "7" in keys
+    assert cache.size == stored_size(cache) <= cache.max_bytes
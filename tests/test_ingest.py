@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from src.ingest import IngestionQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = IngestionQueue(str(tmp_path / "data.db"), lease_secs=60, max_attempts=3)
+    yield queue
+    queue.close()
+
+
+def test_enqueue_is_idempotent(queue):
+    assert queue.enqueue(1, 10, {"query": "a"})
+    assert not queue.enqueue(1, 10, {"query": "b"})
+    assert queue.depth() == {"pending": 1, "running": 0, "failed": 0}
+
+
+def test_claim_leases_a_job_once(queue):
+    queue.enqueue(1, 10, {"query": "a"})
+    job = queue.claim("w1")
+    assert job is not None and job.attempts == 1 and job.payload == {"query": "a"}
+    assert queue.claim("w2") is None
+
+
+def test_expired_lease_is_claimed_again(queue):
+    queue.enqueue(1, 10, {})
+    queue.claim("w1")
+    queue.db.execute("UPDATE ingest_jobs SET locked_until = ?", (time.time() - 1,))
+    job = queue.claim("w2")
+    assert job is not None and job.attempts == 2
+
+
+def test_checkpoint_resumes_at_the_saved_stage(queue):
+    queue.enqueue(1, 10, {})
+    job = queue.claim("w1")
+    job.payload["summary"] = "notes"
+    queue.checkpoint(job, "index")
+    queue.db.execute("UPDATE ingest_jobs SET locked_until = ?", (time.time() - 1,))
+
+    retried = queue.claim("w2")
+    assert retried.stage == "index" and retried.payload == {"summary": "notes"}
+
+
+def test_failure_backs_off_then_gives_up(queue):
+    queue.enqueue(1, 10, {})
+    for attempt in range(1, 4):
+        job = queue.claim("w1")
+        assert job is not None and job.attempts == attempt
+        terminal = queue.fail(job, "boom")
+        assert terminal == (attempt == 3)
+        if not terminal:
+            # Backs off exponentially, so it isn't runnable straight away
+            assert queue.claim("w1") is None
+            queue.db.execute("UPDATE ingest_jobs SET next_attempt_at = ?", (time.time(),))
+
+    assert queue.depth() == {"pending": 0, "running": 0, "failed": 1}
+    assert queue.claim("w1") is None
+
+
+def test_completed_jobs_leave_the_depth(queue):
+    queue.enqueue(1, 10, {})
+    queue.complete(queue.claim("w1"))
+    assert queue.depth() == {"pending": 0, "running": 0, "failed": 0}
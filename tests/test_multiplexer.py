@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import pytest
+
+from llm.multiplexer import Priority, RequestScheduler, llm_priority
+
+
+async def test_limit_grows_additively_and_halves_on_throttle():
+    scheduler = RequestScheduler(initial_limit=4, max_limit=8)
+    for _ in range(4):
+        scheduler.release(await scheduler.acquire(10), 10, time.monotonic())
+    assert 4.9 < scheduler.limit < 5.1
+
+    scheduler.release(await scheduler.acquire(10), None, time.monotonic(), throttled=True)
+    assert 2.4 < scheduler.limit < 2.6
+    assert scheduler.throttled == 1
+
+
+async def test_limit_stays_within_bounds():
+    scheduler = RequestScheduler(initial_limit=1, max_limit=2)
+    for _ in range(20):
+        scheduler.release(await scheduler.acquire(10), 10, time.monotonic())
+    assert scheduler.limit == 2
+
+    for _ in range(5):
+        scheduler.release(await scheduler.acquire(10), None, time.monotonic(), throttled=True)
+    assert scheduler.limit == 1
+
+
+async def test_slow_calls_shrink_the_limit():
+    scheduler = RequestScheduler(initial_limit=10, latency_target=1.0)
+    scheduler.release(await scheduler.acquire(10), 10, time.monotonic() - 5)
+    assert scheduler.limit == pytest.approx(9.0)
+
+
+async def test_concurrency_limit_queues_requests():
+    scheduler = RequestScheduler(initial_limit=1)
+    first = await scheduler.acquire(10)
+    waiting = asyncio.ensure_future(scheduler.acquire(10))
+    await asyncio.sleep(0)
+    assert not waiting.done() and scheduler.stats()["queued"] == 1
+
+    scheduler.release(first, 10, time.monotonic())
+    await asyncio.wait_for(waiting, 1)
+    assert scheduler.in_flight == 1
+
+
+async def test_interactive_requests_are_admitted_first():
+    scheduler = RequestScheduler(initial_limit=1, max_limit=1)
+    first = await scheduler.acquire(10)
+    with llm_priority(Priority.BACKGROUND):
+        background = asyncio.ensure_future(scheduler.acquire(10))
+        await asyncio.sleep(0)
+    interactive = asyncio.ensure_future(scheduler.acquire(10))
+    await asyncio.sleep(0)
+
+    scheduler.release(first, 10, time.monotonic())
+    await asyncio.sleep(0)
+    assert interactive.done() and not background.done()
+    background.cancel()
+
+
+async def test_token_budget_delays_admission():
+    scheduler = RequestScheduler(tpm=100, initial_limit=4)
+    scheduler.release(await scheduler.acquire(80), 80, time.monotonic())
+    waiting = asyncio.ensure_future(scheduler.acquire(40))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    # Once the first call leaves the one minute window there's room again
+    scheduler.window[0][0] -= 60
+    scheduler._dispatch()
+    await asyncio.wait_for(waiting, 1)
+    assert scheduler.window_tokens == 40
+
+
+async def test_used_tokens_replace_the_estimate():
+    scheduler = RequestScheduler(tpm=1000)
+    scheduler.release(await scheduler.acquire(100), 250, time.monotonic())
+    assert scheduler.window_tokens == 250
+
+
+async def test_cancelled_waiter_does_not_leak_a_slot():
+    scheduler = RequestScheduler(initial_limit=1)
+    first = await scheduler.acquire(10)
+    waiting = asyncio.ensure_future(scheduler.acquire(10))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+
+    scheduler.release(first, 10, time.monotonic())
+    assert scheduler.in_flight == 0 and scheduler.stats()["queued"] == 0
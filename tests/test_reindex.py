@@ -0,0 +1,96 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from src.reindex import TARGETS, Checkpoints, Reindexer, UnownedRows
+
+
+class FakeCollection:
+    def __init__(self, client: "FakeClient", name: str) -> None:
+        self.client = client
+        self.name = name
+        self.rows: dict[str, dict] = {}
+
+    async def modify(self, name):
+        self.client.collections[name] = self.client.collections.pop(self.name)
+        self.name = name
+
+    async def upsert(self, ids, documents, metadatas, embeddings):
+        self.rows.update(zip(ids, metadatas))
+
+    async def get(self, ids, include):
+        found = [id_ for id_ in ids if id_ in self.rows]
+        return {"ids": found, "metadatas": [self.rows[id_] for id_ in found]}
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.collections: dict[str, FakeCollection] = {}
+
+    async def get_collection(self, name):
+        return self.collections[name]
+
+    async def get_or_create_collection(self, name, configuration=None):
+        return self.collections.setdefault(name, FakeCollection(self, name))
+
+    async def delete_collection(self, name):
+        del self.collections[name]
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "data.db")
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE messages(message_id INTEGER PRIMARY KEY, sender TEXT, content TEXT, imgs BLOB);
+        CREATE TABLE telegram_messages(chat_id INTEGER, tg_message_id INTEGER, message_id INTEGER);
+        CREATE TABLE information(info_id INTEGER PRIMARY KEY, content TEXT, message_id INTEGER, user_id TEXT);
+        INSERT INTO messages VALUES(1, 'user', 'from a chat', NULL), (2, 'user', 'old message', NULL);
+        INSERT INTO telegram_messages VALUES(5, 100, 1);
+    """)
+    db.commit()
+    db.close()
+    return path
+
+
+def reindexer(tmp_path, source, client, **kwargs) -> Reindexer:
+    store = SimpleNamespace(client=client, embedding_function=lambda docs: [[0.0] for _ in docs])
+    return Reindexer(store, source, Checkpoints(str(tmp_path / "reindex.db")), workers=1, **kwargs)  # type: ignore
+
+
+async def test_owner_is_recovered_from_the_live_collection(tmp_path, source):
+    client = FakeClient()
+    live = await client.get_or_create_collection("bot-msgstore")
+    live.rows["2"] = {"user_id": 7, "msg_id": 2, "is_llm": False}
+
+    report = await reindexer(tmp_path, source, client).run(["messages"], shadow=True)
+
+    assert report["messages"]["rows"] == 2 and report["messages"]["recovered"] == 1
+    assert client.collections["bot-msgstore"].rows["1"]["user_id"] == 5
+    assert client.collections["bot-msgstore"].rows["2"]["user_id"] == 7
+
+
+async def test_unowned_rows_stop_the_run(tmp_path, source):
+    client = FakeClient()
+    live = await client.get_or_create_collection("bot-msgstore")
+    live.rows["2"] = {"user_id": 7, "msg_id": 2, "is_llm": False}
+    live.rows["3"] = {"user_id": 8, "msg_id": 3, "is_llm": False}
+    db = sqlite3.connect(source)
+    db.execute("INSERT INTO messages VALUES(4, 'user', 'nobody knows', NULL)")
+    db.commit()
+    db.close()
+
+    with pytest.raises(UnownedRows, match="message_id 4"):
+        await reindexer(tmp_path, source, client).run(["messages"], shadow=True)
+    # The live collection wasn't swapped for the incomplete one
+    assert client.collections["bot-msgstore"] is live
+
+
+async def test_unowned_rows_can_be_left_out(tmp_path, source):
+    client = FakeClient()
+
+    report = await reindexer(tmp_path, source, client, allow_unowned=True).run(["messages"], shadow=True)
+
+    assert report["messages"]["skipped"] == 1
+    assert set(client.collections["bot-msgstore"].rows) == {"1"}
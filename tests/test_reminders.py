@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pytest
+
+from db import DBConn
+from llm.modules import UserSupportAgent
+
+REMIND_AT = datetime(2030, 1, 1, 9, 0)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ARCHIVE_DB", str(tmp_path / "archive.db"))
+    DBConn().setup_db()
+    db = DBConn()
+    yield db
+    db.db.close()
+
+
+def reminders(db: DBConn) -> list[tuple]:
+    return db.db.execute(
+        "SELECT user_id, message_id, reminder_text FROM reminders ORDER BY reminder_id"
+    ).fetchall()
+
+
+def test_same_message_sets_a_reminder_once(db):
+    db.insert_reminder("1", "Dentist", REMIND_AT, 7)
+    db.insert_reminder("1", "Dentist appointment", REMIND_AT, 7)
+    assert reminders(db) == [("1", 7, "Dentist")]
+
+
+def test_dedupe_is_per_user(db):
+    db.insert_reminder("1", "Dentist", REMIND_AT, 7)
+    db.insert_reminder("2", "Dentist", REMIND_AT, 7)
+    db.insert_reminder("1", "Dentist", datetime(2030, 1, 2, 9, 0), 7)
+    assert len(reminders(db)) == 3
+
+
+def test_setup_drops_existing_duplicates(db, tmp_path):
+    db.db.execute("DROP INDEX reminders_unique")
+    for text in ("Dentist", "Dentist again"):
+        db.db.execute(
+            "INSERT INTO reminders(user_id, reminder_text, remind_at, message_id) VALUES('1', ?, ?, 7)",
+            (text, REMIND_AT),
+        )
+    db.db.commit()
+
+    DBConn().setup_db()
+    assert reminders(db) == [("1", 7, "Dentist")]
+
+
+async def test_schedule_tools_are_bound_to_the_message(db):
+    agent = UserSupportAgent.__new__(UserSupportAgent)
+    agent.db = db
+    tools = agent.schedule_agent(1, 7).module.tools
+
+    assert set(tools["insert_reminder"].args) == {"content", "remind_at"}
+    await tools["insert_reminder"].acall(content="Dentist", remind_at="2030-01-01T09:00:00")
+    await tools["insert_reminder"].acall(content="Dentist", remind_at="2030-01-01T09:00:00")
+    assert reminders(db) == [("1", 7, "Dentist")]
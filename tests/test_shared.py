@@ -0,0 +1,82 @@
+import sqlite3
+import time
+
+import pytest
+
+from src.shared import LeaderLease, UpdateQueue
+
+
+@pytest.fixture
+def updates(tmp_path):
+    updates = UpdateQueue(str(tmp_path / "shared.db"), lease_secs=60, max_attempts=2, retry_secs=0)
+    yield updates
+    updates.close()
+
+
+def test_updates_are_claimed_in_order_once(updates):
+    updates.put(2, "b")
+    updates.put(1, "a")
+    assert updates.next_offset() == 3
+    assert updates.claim("w1") == (1, "a")
+    assert updates.claim("w2") == (2, "b")
+    assert updates.claim("w1") is None
+
+
+def test_expired_lease_is_claimed_again(updates):
+    updates.put(1, "a")
+    updates.claim("w1")
+    updates.db.execute("UPDATE updates SET locked_until = ?", (time.time() - 1,))
+    assert updates.claim("w2") == (1, "a")
+
+
+def test_renew_only_extends_own_leases(updates):
+    updates.put(1, "a")
+    updates.claim("w1")
+    updates.db.execute("UPDATE updates SET locked_until = 0")
+    updates.renew("w2", [1])
+    assert updates.db.execute("SELECT locked_until FROM updates").fetchone()[0] == 0
+    updates.renew("w1", [1])
+    assert updates.claim("w2") is None
+
+
+def test_ack_removes_the_update(updates):
+    updates.put(1, "a")
+    updates.ack(updates.claim("w1")[0])
+    assert updates.depth() == {"pending": 0, "failed": 0}
+
+
+def test_failed_update_is_retried_then_set_aside(updates):
+    updates.put(1, "a")
+    update_id, _ = updates.claim("w1")
+    assert not updates.fail(update_id, "boom")
+    assert updates.claim("w2") == (1, "a")
+    assert updates.fail(update_id, "boom again")
+
+    assert updates.claim("w1") is None
+    assert updates.depth() == {"pending": 0, "failed": 1}
+
+
+def test_store_without_retry_columns_is_migrated(tmp_path):
+    path = str(tmp_path / "shared.db")
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE updates(update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, locked_by TEXT,
+                locked_until REAL DEFAULT 0 NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+    db.execute("INSERT INTO updates(update_id, payload) VALUES(1, 'a')")
+    db.commit()
+    db.close()
+
+    updates = UpdateQueue(path)
+    assert updates.claim("w1") == (1, "a")
+    updates.close()
+
+
+def test_lease_is_held_until_it_expires(tmp_path):
+    lease = LeaderLease(str(tmp_path / "shared.db"))
+    assert lease.acquire("cron", "a", 60)
+    assert not lease.acquire("cron", "b", 60)
+    assert lease.acquire("cron", "a", 60)  # Renewal by the holder
+
+    lease.db.execute("UPDATE leases SET expires_at = ?", (time.time() - 1,))
+    assert lease.acquire("cron", "b", 60)
+    assert not lease.acquire("cron", "a", 60)
+    lease.close()
@@ -0,0 +1,45 @@
+import logging
+
+import pytest
+
+from src.startup import Startup
+
+
+async def fails():
+    raise ValueError("no key")
+
+
+async def ready():
+    return "service"
+
+
+async def test_ready_subsystem_is_published(caplog):
+    startup = Startup()
+    caplog.set_level(logging.INFO)
+    await startup.start("lm", ready)
+
+    assert await startup.get("lm") == "service"
+    assert "lm ready in" in caplog.text
+    assert "lm" in startup.report()
+
+
+async def test_failed_subsystem_is_logged_not_ready(caplog):
+    startup = Startup()
+    caplog.set_level(logging.INFO)
+    await startup.start("lm", fails)
+
+    with pytest.raises(RuntimeError):
+        await startup.get("lm")
+    [record] = caplog.records
+    assert record.levelno == logging.ERROR and record.exc_info is not None
+    assert "ready" not in caplog.text
+
+
+async def test_failed_optional_subsystem_is_a_warning(caplog):
+    startup = Startup()
+    caplog.set_level(logging.INFO)
+    await startup.start("wiki_tools", fails, optional=True)
+
+    assert await startup.get("wiki_tools") is None
+    [record] = caplog.records
+    assert record.levelno == logging.WARNING and record.exc_info is not None
@@ -0,0 +1,112 @@
+import re
+
+import dspy
+import pytest
+from litellm import ModelResponse, ModelResponseStream
+
+from llm import routing
+from llm.cache import CompletionCache
+from llm.modules import UserSupportAgent
+from llm.signatures import QueryCategory
+
+
+class StreamingLM(dspy.LM):
+    """Streams a canned ResponsePolisher answer a few characters at a time, like LiteLLM does."""
+
+    def __init__(self, model: str, response: str) -> None:
+        super().__init__(model, cache=False)
+        self.response = response
+        self.calls = 0
+
+    async def aforward(self, prompt=None, messages=None, **kwargs):
+        self.calls += 1
+        text = (
+            "[[ ## output_doc ## ]]\nNone\n\n[[ ## document_ids_o ## ]]\n[]\n\n"
+            "[[ ## is_hard_retrieval_o ## ]]\nFalse\n\n"
+            f"[[ ## response ## ]]\n{self.response}\n\n[[ ## completed ## ]]"
+        )
+        if (stream := dspy.settings.send_stream) is not None:
+            predict_id = id(dspy.settings.caller_predict)
+            for piece in re.findall(r".{1,4}", text, re.S):
+                chunk = ModelResponseStream(choices=[{"index": 0, "delta": {"content": piece}}])
+                chunk.predict_id = predict_id
+                await stream.send(chunk)
+        return ModelResponse(
+            model=self.model,
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            usage={"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        )
+
+
+class RecordingStream:
+    def __init__(self) -> None:
+        self.chunks: list[str] = []
+        self.discarded: list[str] = []
+
+    async def push(self, chunk: str):
+        self.chunks.append(chunk)
+
+    def reset(self):
+        self.discarded.append(self.text)
+        self.chunks = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    from db import DBConn
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ARCHIVE_DB", str(tmp_path / "archive.db"))
+    cache = CompletionCache(str(tmp_path / "cache.db"))
+    agent = UserSupportAgent(DBConn(), None, [], cache, None)  # type: ignore
+    yield agent
+    cache.close()
+
+
+@pytest.fixture
+def lms(monkeypatch):
+    lms = {
+        routing.FLASH_LITE: StreamingLM(routing.FLASH_LITE, "Draft answer"),
+        routing.FLASH: StreamingLM(routing.FLASH, "Final answer"),
+    }
+    monkeypatch.setattr(routing, "lm_factory", lambda model, max_tokens: lms[model])
+    monkeypatch.setattr(routing, "_lms", {})
+    return lms
+
+
+POLISHER_INPUTS = {
+    "user_query": "What is on my list?",
+    "category": QueryCategory.INFORMATION,
+    "proposed_answer": "Milk and eggs.",
+    "is_hard_retrieval": False,
+    "document_ids": None,
+}
+
+
+async def test_escalation_restarts_the_streamed_reply(agent, lms):
+    routed = agent.answer_rephraser.module
+    routed.validate = lambda pred: "draft" if pred.response.startswith("Draft") else None
+    stream = RecordingStream()
+
+    polished = await agent.stream_polished(dict(POLISHER_INPUTS), stream)
+
+    assert polished.response == "Final answer"
+    assert lms[routing.FLASH_LITE].calls == lms[routing.FLASH].calls == 1
+    # The lite model's draft was streamed, then dropped when the cascade moved on
+    assert [text.strip() for text in stream.discarded] == ["Draft answer"]
+    assert stream.text.strip() == "Final answer"
+
+
+async def test_accepted_answer_streams_once(agent, lms):
+    stream = RecordingStream()
+
+    polished = await agent.stream_polished(dict(POLISHER_INPUTS), stream)
+
+    assert polished.response == "Draft answer"
+    assert lms[routing.FLASH].calls == 0
+    assert stream.discarded == []
+    assert stream.text.strip() == "Draft answer"